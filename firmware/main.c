@@ -113,7 +113,7 @@ PT_THREAD(inline cmd_task(struct pt* pt)) {
     static uint8_t inout_cfg;
     static uint8_t i;
     
-    static uint8_t loop_start = 3; // loop is always contained in a single packet
+    static uint8_t loop_start = 3; // loop is always contained in a single packet, but may start anywhere in it
     static uint16_t loop_count;
     static uint8_t loop_is_active = 0;
     
@@ -451,6 +451,8 @@ PT_THREAD(inline cmd_task(struct pt* pt)) {
                 GET_BYTE(pt, tmp);
                 loop_count |= ((uint16_t) tmp) << 8;
                 
+                // the body follows in the same packet
+                loop_start = usb_rx_ptr;
                 loop_is_active = 1;
                 
             } else if (cmd == 0x11) {
@@ -1 +1,5 @@
 from .tinyfpgaa import *
+from .emulator import *
+from .cache import *
+from .stats import *
+from .svf import *
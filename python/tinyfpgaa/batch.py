@@ -0,0 +1,316 @@
+"""
+Batch programming of mixed-image panels.
+
+A manifest lists programming jobs: the image to program, optionally the
+port or USB serial number of the programmer it must go to, how many times
+to retry it and its verify policy.  All distinct images are parsed up front
+on a process pool, identical images are parsed once, and the jobs are
+scheduled across every available programmer.  A job that fails on one port
+is retried on another where it is free to move.
+
+    tinyproga --manifest panel.json
+
+A manifest is a JSON list of jobs, or an object with a "jobs" list and
+"defaults" applied to every job:
+
+    {
+        "defaults": {"retries": 1, "verify": "compare"},
+        "jobs": [
+            {"image": "top.jed", "serial": "A51C29"},
+            {"image": "bottom.bit", "bitstream": true, "port": "/dev/ttyACM1"},
+            {"image": "spare.jed", "retries": 3, "verify": "always"}
+        ]
+    }
+
+Image paths are relative to the manifest.
+"""
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from serial.tools.list_ports import comports
+from .tinyfpgaa import JedecFile, BitstreamFile
+from .cache import ImageCache, pack_image, unpack_image
+
+
+# verify policy: (skip_if_identical, fingerprint) arguments of program()
+VERIFY_POLICIES = {
+    "always": (False, False),
+    "compare": (True, False),
+    "fingerprint": (False, True),
+}
+
+_JOB_KEYS = ("image", "bitstream", "port", "serial", "retries", "verify")
+
+
+class ManifestError(Exception):
+    pass
+
+
+class BatchJob(object):
+    """
+    One manifest entry.  port is None if the job may run on any programmer.
+    attempts lists (port, failures) for every run so far, in order.
+    """
+    def __init__(self, index, image, bitstream = False, port = None, serial = None, retries = 0, verify = "always"):
+        if verify not in VERIFY_POLICIES:
+            raise ManifestError("job {}: unknown verify policy {!r}, expected one of {}".format(
+                index, verify, ", ".join(sorted(VERIFY_POLICIES))))
+
+        if port is not None and serial is not None:
+            raise ManifestError("job {}: give either a port or a serial number, not both".format(index))
+
+        self.index = index
+        self.image = image
+        self.bitstream = bool(bitstream)
+        self.port = port
+        self.serial = serial
+        self.retries = int(retries)
+        self.verify = verify
+
+        self.image_key = None
+        self.attempts = []
+        self.ok = False
+
+    @property
+    def skip_if_identical(self):
+        return VERIFY_POLICIES[self.verify][0]
+
+    @property
+    def fingerprint(self):
+        return VERIFY_POLICIES[self.verify][1]
+
+    def failed_ports(self):
+        return set(port for port, failures in self.attempts if failures)
+
+    def fail(self, message):
+        """
+        Fail the job without running it.
+        """
+        self.attempts.append((None, [message]))
+
+    def name(self):
+        return "job {} ({})".format(self.index, os.path.basename(self.image))
+
+
+def parse_manifest(manifest, base_directory = ".", defaults = None):
+    """
+    Return the BatchJobs of a decoded JSON manifest.  defaults fills in job
+    settings that neither the job nor the manifest defaults give.
+    """
+    if isinstance(manifest, dict):
+        entries = manifest.get("jobs")
+        job_defaults = dict(defaults or {}, **manifest.get("defaults", {}))
+    else:
+        entries = manifest
+        job_defaults = dict(defaults or {})
+
+    if not isinstance(entries, list):
+        raise ManifestError("manifest must be a list of jobs or an object with a \"jobs\" list")
+
+    jobs = []
+
+    for index, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {"image": entry}
+
+        settings = dict(job_defaults, **entry)
+        unknown = set(settings) - set(_JOB_KEYS)
+
+        if unknown:
+            raise ManifestError("job {}: unknown setting {}".format(index, ", ".join(sorted(unknown))))
+
+        if "image" not in settings:
+            raise ManifestError("job {}: no image".format(index))
+
+        settings["image"] = os.path.join(base_directory, settings["image"])
+        jobs.append(BatchJob(index, **settings))
+
+    return jobs
+
+
+def load_manifest(filename, defaults = None):
+    with open(filename, "r") as f:
+        try:
+            manifest = json.load(f)
+        except ValueError as e:
+            raise ManifestError("{}: {}".format(filename, e))
+
+    return parse_manifest(manifest, os.path.dirname(os.path.abspath(filename)), defaults)
+
+
+def resolve_serial_numbers(jobs, ports = None):
+    """
+    Pin jobs given by USB serial number to the serial device of that
+    programmer.  ports lists the pyserial port infos to search, all attached
+    ports by default.  Jobs whose programmer is not attached are failed.
+    """
+    if ports is None:
+        ports = comports()
+
+    devices = {}
+    for info in ports:
+        if info.serial_number:
+            devices[info.serial_number] = info.device
+
+    for job in jobs:
+        if job.serial is not None:
+            job.port = devices.get(job.serial)
+
+            if job.port is None:
+                job.fail("no programmer with USB serial number {} is attached".format(job.serial))
+
+
+def _parse_image(filename, bitstream, use_cache):
+    # runs in a worker process: hand the image back packed, which pickles
+    # much faster than the row lists
+    if use_cache:
+        return pack_image(ImageCache().load(filename, bitstream = bitstream))
+
+    if bitstream:
+        with open(filename, "rb") as f:
+            return pack_image(BitstreamFile(f))
+
+    with open(filename, "r") as f:
+        return pack_image(JedecFile(f))
+
+
+def load_images(jobs, use_cache = True, max_workers = None):
+    """
+    Parse the image of every job that has not failed and return a dict of
+    the parsed images by image_key, which is set on each job.  Files with
+    the same contents and format are parsed once, and several distinct
+    images are parsed in parallel worker processes.  Jobs whose image cannot
+    be read or parsed are failed.
+    """
+    sources = {}
+
+    for job in jobs:
+        if job.attempts:
+            continue
+
+        try:
+            with open(job.image, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+        except OSError as e:
+            job.fail(str(e))
+            continue
+
+        job.image_key = (digest, job.bitstream)
+        sources.setdefault(job.image_key, job)
+
+    images = {}
+    errors = {}
+
+    if len(sources) == 1:
+        key, job = next(iter(sources.items()))
+        try:
+            images[key] = unpack_image(_parse_image(job.image, job.bitstream, use_cache))
+        except Exception as e:
+            errors[key] = e
+    elif sources:
+        with ProcessPoolExecutor(max_workers = max_workers) as pool:
+            futures = {key: pool.submit(_parse_image, job.image, job.bitstream, use_cache) for key, job in sources.items()}
+
+            for key, future in futures.items():
+                try:
+                    images[key] = unpack_image(future.result())
+                except Exception as e:
+                    errors[key] = e
+
+    for job in jobs:
+        if job.image_key in errors:
+            job.fail("cannot parse {}: {}".format(job.image, errors[job.image_key]))
+
+    return images
+
+
+class BatchScheduler(object):
+    """
+    Runs jobs on a set of ports, one job per port at a time.  run(job, port)
+    programs the job's board on port and returns a list of failure
+    messages, empty on success.  Each port takes the jobs pinned to it
+    first, then jobs free to run anywhere.  A failed job is retried up to
+    job.retries times; a job free to move goes to a port it has not failed
+    on yet, as long as there is one.
+    """
+    def __init__(self, jobs, ports, run, log = None):
+        self.jobs = jobs
+        self.ports = list(ports)
+        self.run_job = run
+        self.log = log if log is not None else (lambda message: None)
+
+        for job in jobs:
+            if job.port is not None and job.port not in self.ports:
+                self.ports.append(job.port)
+
+        self.condition = threading.Condition()
+        self.pending = [job for job in jobs if not job.attempts]
+        self.running = []
+
+    def _next_job(self, port):
+        for job in self.pending:
+            if job.port == port:
+                return job
+
+        for job in self.pending:
+            if job.port is None:
+                failed = job.failed_ports()
+                if port not in failed or failed.issuperset(self.ports):
+                    return job
+
+        return None
+
+    def _may_get_work(self, port):
+        return any(job.port in (None, port) for job in self.pending + self.running)
+
+    def _worker(self, port):
+        while True:
+            with self.condition:
+                job = self._next_job(port)
+
+                while job is None:
+                    if not self._may_get_work(port):
+                        return
+                    self.condition.wait()
+                    job = self._next_job(port)
+
+                self.pending.remove(job)
+                self.running.append(job)
+
+            try:
+                failures = self.run_job(job, port)
+            except Exception as e:
+                failures = [str(e)]
+
+            with self.condition:
+                self.running.remove(job)
+                job.attempts.append((port, failures))
+
+                if not failures:
+                    job.ok = True
+                elif len(job.attempts) <= job.retries:
+                    self.log("Retrying {} after failure on {}.".format(job.name(), port))
+                    # before fresh jobs, so the retry does not wait for the whole panel
+                    self.pending.insert(0, job)
+
+                self.condition.notify_all()
+
+    def run(self):
+        """
+        Run every job and return the jobs.
+        """
+        if not self.ports:
+            for job in self.pending:
+                job.fail("no programmer to run on")
+            self.pending = []
+
+        threads = [threading.Thread(target = self._worker, args = (port,)) for port in self.ports]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return self.jobs
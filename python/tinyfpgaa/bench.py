@@ -0,0 +1,182 @@
+"""
+End-to-end programming benchmark.
+
+Runs JtagCustomProgrammer.program() under a ProgrammingStats and reports, for
+every programming phase, rows per second, bytes sent and received, blocking
+reads and host CPU time.
+By default synthetic JEDEC and bitstream images sized like each MachXO2
+density are programmed into the offline emulator, so the numbers track host
+side cost from commit to commit.  With -p the given image files are
+programmed into the board attached to a real port instead.
+
+    python -m tinyfpgaa.bench
+    python -m tinyfpgaa.bench -d XO2-1200 XO2-7000 -f jedec --json
+    python -m tinyfpgaa.bench -p /dev/ttyACM0 -i blinky.jed
+"""
+import sys
+import io
+import json
+import random
+import argparse
+import serial
+import tinyfpgaa
+from .emulator import ProgrammerEmulator, MachXO2
+
+
+# name: (idcode, configuration flash rows, UFM rows)
+DEVICES = {
+    "XO2-256":  (0x012B8043,  575,    0),
+    "XO2-640":  (0x012B9043, 1151,  191),
+    "XO2-1200": (0x012BA043, 2175,  511),
+    "XO2-2000": (0x012BB043, 3198,  639),
+    "XO2-4000": (0x012BC043, 5758,  767),
+    "XO2-7000": (0x012BD043, 9212, 2046),
+}
+
+def synthetic_jedec(cfg_rows, ufm_rows, seed = 0):
+    """
+    Build the text of a JEDEC file with random fuse rows.
+    """
+    rnd = random.Random(seed)
+
+    def rows(count):
+        return [format(rnd.getrandbits(128), "0128b") for i in range(count)]
+
+    lines = ["\x02*", "NOTE synthetic benchmark image*", "QF%d*" % ((cfg_rows + ufm_rows) * 128), "G0*", "F0*"]
+    lines += ["L000000"] + rows(cfg_rows) + ["*"]
+
+    if ufm_rows > 0:
+        lines += ["NOTE TAG DATA*", "L000000"] + rows(ufm_rows) + ["*"]
+
+    lines += ["NOTE FEATURE_ROW*", "E" + "0" * 64, "0000010001100000*", "\x03"]
+
+    return "\n".join(lines) + "\n"
+
+
+def synthetic_bitstream(cfg_rows, seed = 0):
+    """
+    Build a compressed bitstream with random frame data that parses into
+    roughly cfg_rows rows.
+    """
+    rnd = random.Random(seed)
+
+    commands = (
+        b"\xff\xff\xbd\xb3" +
+        b"\x3b\x00\x00\x00" +                   # LSC_RESET_CRC
+        b"\xe2\x00\x00\x00\x01\x2b\xa0\x43" +   # VERIFY_ID
+        b"\x22\x00\x00\x00\x00\x00\x00\x00" +   # LSC_PROG_CNTRL0
+        b"\x46\x00\x00\x00" +                   # LSC_INIT_ADDRESS
+        b"\xb8\x00\x00\x00")                    # LSC_PROG_INCR_CMP
+
+    payload = bytes(rnd.getrandbits(8) for i in range(cfg_rows * 16 - len(commands)))
+
+    return b"\xff\x00" + b"LCMXO2 synthetic benchmark\x00" + commands + payload
+
+
+TRANSPORTS = {
+    "sync": tinyfpgaa.SyncSerial,
+    "async": tinyfpgaa.AsyncSerial,
+    "buffered": tinyfpgaa.BufferedSerial,
+    "threaded": tinyfpgaa.ThreadedSerial,
+}
+
+
+def run(ser, image, emulator = None, transport = "buffered"):
+    """
+    Program image through ser and return the ProgrammingStats.report() of
+    the run and a list of failure messages.  Elapsed times are simulated
+    time when running against the emulator and wall time otherwise.
+    """
+    transport = TRANSPORTS[transport](ser)
+
+    pins = tinyfpgaa.JtagTinyFpgaProgrammer(transport)
+    jtag = tinyfpgaa.Jtag(pins)
+    programmer = tinyfpgaa.JtagCustomProgrammer(jtag)
+
+    failures = []
+
+    def progress(v):
+        if isinstance(v, str) and v.endswith("Failed!"):
+            failures.append(v)
+
+    if emulator is not None:
+        stats = tinyfpgaa.ProgrammingStats(clock = lambda: emulator.elapsed)
+    else:
+        stats = tinyfpgaa.ProgrammingStats()
+
+    stats.attach(programmer)
+    programmer.program(image, progress = progress, phase = stats)
+    transport.flush()
+    if isinstance(transport, tinyfpgaa.ThreadedSerial):
+        transport.close()
+    stats.finish()
+
+    return stats.report(), failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "TinyFPGA A programming benchmark.")
+    parser.add_argument("-p", type=str, help="Program a real board on this serial device instead of the emulator.")
+    parser.add_argument("-i", type=str, nargs="+", help="Image files to program instead of synthetic images.")
+    parser.add_argument("-b", action="store_true", help="Image files given with -i are bitstream files.")
+    parser.add_argument("-d", type=str, nargs="+", choices=sorted(DEVICES), help="Device densities to synthesize images for.")
+    parser.add_argument("-f", type=str, choices=["jedec", "bit", "both"], default="both", help="Synthetic image formats.")
+    parser.add_argument("-t", type=str, choices=sorted(TRANSPORTS), default="buffered", help="Serial transport to program through.")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per run instead of tables.")
+    args = parser.parse_args()
+
+    if args.p and not args.i:
+        parser.error("-p requires image files given with -i; synthetic images are for the emulator only.")
+
+    ### collect (title, image, idcode) tuples
+    runs = []
+
+    if args.i:
+        for filename in args.i:
+            if args.b:
+                image = tinyfpgaa.BitstreamFile(open(filename, "rb"))
+            else:
+                image = tinyfpgaa.JedecFile(open(filename, "r"))
+            runs.append((filename, image, DEVICES["XO2-1200"][0]))
+
+    else:
+        for name in (args.d or sorted(DEVICES, key = lambda d: DEVICES[d][1])):
+            idcode, cfg_rows, ufm_rows = DEVICES[name]
+
+            if args.f in ("jedec", "both"):
+                image = tinyfpgaa.JedecFile(io.StringIO(synthetic_jedec(cfg_rows, ufm_rows)))
+                runs.append(("%s JEDEC" % name, image, idcode))
+
+            if args.f in ("bit", "both"):
+                image = tinyfpgaa.BitstreamFile(io.BufferedReader(io.BytesIO(synthetic_bitstream(cfg_rows))))
+                runs.append(("%s bitstream" % name, image, idcode))
+
+    exit_code = 0
+
+    for title, image, idcode in runs:
+        if args.p:
+            with serial.Serial(args.p, 12000000, timeout=10, writeTimeout=5) as ser:
+                results, failures = run(ser, image, transport = args.t)
+            target = args.p
+        else:
+            emulator = ProgrammerEmulator(MachXO2(idcode = idcode))
+            results, failures = run(emulator, image, emulator = emulator, transport = args.t)
+            target = "emulator"
+
+        if failures:
+            exit_code = 2
+
+        if args.json:
+            print(json.dumps(dict(results, image = title, target = target, failures = failures)))
+        else:
+            print("%s on %s (%d rows)" % (title, target, image.numRows()))
+            print(tinyfpgaa.format_report(results))
+            for failure in failures:
+                print(failure)
+            print("")
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,271 @@
+import os
+import struct
+import hashlib
+from . import tinyfpgaa as _parsers
+
+
+# Bump when the packed image layout or the parsers change output.
+CACHE_FORMAT = 1
+
+_MAGIC = b"TFAC"
+_HEADER = struct.Struct("<4sBB")
+_ROWS = struct.Struct("<I")
+_NO_ROWS = 0xffffffff
+_OPTIONAL_INT = struct.Struct("<BI")
+
+_IMAGE_CLASSES = {
+    b"J": _parsers.JedecFile,
+    b"B": _parsers.BitstreamFile,
+}
+
+
+def _pack_rows(rows):
+    if rows is None:
+        return _ROWS.pack(_NO_ROWS)
+
+    return _ROWS.pack(len(rows)) + b"".join(row.to_bytes(16, 'little') for row in rows)
+
+
+def _unpack_rows(view, pos):
+    (count,) = _ROWS.unpack_from(view, pos)
+    pos += _ROWS.size
+
+    if count == _NO_ROWS:
+        return None, pos
+
+    end = pos + count * 16
+    rows = [int.from_bytes(view[i:i + 16], 'little') for i in range(pos, end, 16)]
+    return rows, end
+
+
+def _pack_int(value):
+    if value is None:
+        return _OPTIONAL_INT.pack(0, 0)
+
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'little')
+    return _OPTIONAL_INT.pack(1, len(data)) + data
+
+
+def _unpack_int(view, pos):
+    present, length = _OPTIONAL_INT.unpack_from(view, pos)
+    pos += _OPTIONAL_INT.size
+
+    if not present:
+        return None, pos
+
+    return int.from_bytes(view[pos:pos + length], 'little'), pos + length
+
+
+def pack_image(image):
+    """
+    Serialize the parsed rows of a JedecFile or BitstreamFile into a compact
+    binary string: 16 bytes per flash row plus a small header.
+    """
+    kind = b"B" if isinstance(image, _parsers.BitstreamFile) else b"J"
+    note = image.last_note.encode("utf-8")
+
+    return b"".join([
+        _HEADER.pack(_MAGIC, CACHE_FORMAT, kind[0]),
+        _pack_rows(image.cfg_data),
+        _pack_rows(image.ebr_data),
+        _pack_rows(image.ufm_data),
+        _pack_int(image.feature_row),
+        _pack_int(image.feature_bits),
+        _ROWS.pack(len(note)),
+        note,
+    ])
+
+
+def unpack_image(data):
+    """
+    Rebuild a JedecFile or BitstreamFile from pack_image() output without
+    parsing the original file.
+    """
+    view = memoryview(data)
+    magic, cache_format, kind = _HEADER.unpack_from(view, 0)
+
+    if magic != _MAGIC or cache_format != CACHE_FORMAT:
+        raise ValueError("Not a packed image of this cache format.")
+
+    cls = _IMAGE_CLASSES[bytes([kind])]
+    image = cls.__new__(cls)
+
+    pos = _HEADER.size
+    image.cfg_data, pos = _unpack_rows(view, pos)
+    image.ebr_data, pos = _unpack_rows(view, pos)
+    image.ufm_data, pos = _unpack_rows(view, pos)
+    image.feature_row, pos = _unpack_int(view, pos)
+    image.feature_bits, pos = _unpack_int(view, pos)
+    (note_length,) = _ROWS.unpack_from(view, pos)
+    pos += _ROWS.size
+    image.last_note = bytes(view[pos:pos + note_length]).decode("utf-8")
+
+    return image
+
+
+_library_version = None
+
+
+def library_version():
+    """
+    Version string the cache keys depend on.  The installed version does
+    not change when an editable install or a checkout is edited, so it
+    includes a hash of the parser source as well.  Worked out on first use,
+    so importing the library costs nothing when the cache is not used.
+    """
+    global _library_version
+
+    if _library_version is None:
+        try:
+            from importlib.metadata import version
+            package_version = version("tinyfpgaa")
+        except Exception:
+            package_version = "unknown"
+
+        with open(_parsers.__file__, "rb") as f:
+            _library_version = "%s-src-%s" % (package_version, hashlib.sha256(f.read()).hexdigest()[:16])
+
+    return _library_version
+
+
+def default_cache_directory():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "tinyfpgaa")
+
+
+class ImageCache(object):
+    """
+    Content addressed on-disk cache of parsed images.  Entries are keyed by
+    the SHA-256 of the input file, the input format and the library version,
+    so a changed file or an upgraded parser never hits a stale entry.  The
+    directory is kept under max_bytes by evicting the least recently used
+    entries; every hit refreshes an entry's modification time.
+    """
+    def __init__(self, directory = None, max_bytes = 64 * 1024 * 1024):
+        if directory is None:
+            directory = default_cache_directory()
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+
+    def key(self, contents, kind):
+        digest = hashlib.sha256()
+        digest.update(("%s:%d:%s:" % (library_version(), CACHE_FORMAT, kind)).encode("utf-8"))
+        digest.update(contents)
+        return digest.hexdigest()
+
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, "%s.%s" % (key, suffix))
+
+
+    def get(self, key, suffix = "image"):
+        """
+        Return the cached bytes for key, or None.
+        """
+        path = self._path(key, suffix)
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+
+        return data
+
+
+    def put(self, key, data, suffix = "image"):
+        """
+        Store bytes for key, then evict old entries if the cache is too big.
+        Failures to write are ignored; the cache is only an optimization.
+        """
+        path = self._path(key, suffix)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+
+        try:
+            os.makedirs(self.directory, exist_ok = True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+
+        self.evict()
+
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        total = 0
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+    def load(self, filename, bitstream = False):
+        """
+        Return the parsed JedecFile or BitstreamFile for filename, parsing it
+        only if it is not already cached.
+        """
+        with open(filename, "rb") as f:
+            contents = f.read()
+
+        kind = "bit" if bitstream else "jed"
+        key = self.key(contents, kind)
+
+        data = self.get(key)
+        if data is not None:
+            try:
+                image = unpack_image(data)
+                self.hits += 1
+                return image
+            except (ValueError, KeyError, struct.error):
+                pass
+
+        self.misses += 1
+
+        if bitstream:
+            with open(filename, "rb") as f:
+                image = _parsers.BitstreamFile(f)
+        else:
+            with open(filename, "r") as f:
+                image = _parsers.JedecFile(f)
+
+        try:
+            data = pack_image(image)
+        except (OverflowError, ValueError):
+            # rows wider than the flash, from a malformed file, do not fit
+            # the packed layout; use the image without caching it
+            return image
+
+        self.put(key, data)
+
+        return image
@@ -0,0 +1,561 @@
+"""
+Long-running programming daemon.
+
+Starting tinyproga costs more than a small image takes to program: the
+interpreter and pyserial load, the port is opened and flushed, and the
+programmer is sent configure_io and the SIE configurations again.  The
+daemon pays that once.  It keeps every attached TinyFPGA A Programmer
+open and initialized, opens hot-plugged ones as they appear, and takes
+programming jobs over a local Unix socket:
+
+    python -m tinyfpgaa.daemon serve &
+    python -m tinyfpgaa.daemon program blinky.jed
+    python -m tinyfpgaa.daemon program -p /dev/ttyACM1 -s --stats json blinky.jed
+    python -m tinyfpgaa.daemon list
+    python -m tinyfpgaa.daemon stop
+
+Requests and replies are JSON objects, one per line.  A request is
+{"command": "program", "file": ..., "port": ..., "bitstream": ...,
+"skip_if_identical": ..., "fingerprint": ..., "stats": ..., "progress": ...,
+"wait": ...}, {"command": "list"} or {"command": "shutdown"}.  A program
+request gets {"progress": message} lines while it runs if it asked for
+them, and every request ends with a reply that has "done" set.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import traceback
+import socketserver
+import serial
+from .tinyfpgaa import BufferedSerial, JtagTinyFpgaProgrammer, Jtag, JtagCustomProgrammer
+from .cache import ImageCache
+from .stats import ProgrammingStats, format_report
+from .tinyproga import find_ports
+
+
+def default_socket_path():
+    base = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+    return os.path.join(base, "tinyfpgaa-{}.sock".format(os.getuid()))
+
+
+class Board(object):
+    """
+    A programmer kept open and initialized between jobs.  Programming runs
+    on the caller's thread; the daemon makes sure only one job uses a board
+    at a time.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.open()
+
+        self.busy = False
+        self.jobs = 0
+        self.failed_jobs = 0
+
+    def open(self):
+        ser = serial.Serial(self.port, 12000000, timeout=10, writeTimeout=5)
+
+        try:
+            self.transport = BufferedSerial(ser)
+            self.pins = JtagTinyFpgaProgrammer(self.transport)
+            self.transport.flush()
+        except:
+            ser.close()
+            raise
+
+        self.ser = ser
+        self.broken = False
+
+    def reopen(self):
+        self.close()
+        self.open()
+
+    def program(self, image, skip_if_identical = False, fingerprint = False, progress = None, stats = None):
+        """
+        Program image.  Returns (programmed, failures), where programmed is
+        False if programming was skipped and failures lists the failure
+        messages.  An exception marks the board broken and is raised.
+        """
+        failures = []
+        programmer = JtagCustomProgrammer(Jtag(self.pins))
+        last_message = [None]
+
+        def report(v):
+            # status is polled every few rows; only report changes
+            if isinstance(v, str) and v != last_message[0]:
+                last_message[0] = v
+                if v.endswith("Failed!"):
+                    failures.append(v)
+                if progress is not None:
+                    progress(v)
+
+        # ProgrammingStats wraps the port for the length of the job only
+        ser = self.transport.ser
+
+        if stats is not None:
+            stats.attach(programmer)
+
+        try:
+            programmed = programmer.program(image, progress = report, phase = stats,
+                skip_if_identical = skip_if_identical, fingerprint = fingerprint)
+            self.transport.flush()
+        except Exception:
+            # the programmer may be mid-command; reopen it before reuse
+            self.broken = True
+            raise
+        finally:
+            self.transport.ser = ser
+            self.pins.stats = None
+
+            if stats is not None:
+                stats.finish()
+
+        self.jobs += 1
+        if failures:
+            self.failed_jobs += 1
+
+        return programmed, failures
+
+    def close(self):
+        try:
+            self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
+
+    def to_dict(self):
+        return {
+            "port": self.port,
+            "busy": self.busy,
+            "broken": self.broken,
+            "jobs": self.jobs,
+            "failed_jobs": self.failed_jobs,
+        }
+
+
+class DaemonError(Exception):
+    pass
+
+
+class ProgrammingDaemon(object):
+    """
+    Keeps a Board for every attached programmer and runs jobs on them.
+    ports, if given, is the fixed list of serial devices to manage;
+    otherwise every attached TinyFPGA A Programmer is used.  Ports are
+    rescanned every scan_interval seconds, so boards plugged in later are
+    opened and unplugged or broken ones are closed.  A job that hits an I/O
+    error, as on a board re-plugged between scans, reopens its board and
+    runs once more.  Parsed images are kept
+    in memory, up to max_images of them, on top of the ImageCache.
+    """
+    def __init__(self, ports = None, scan_interval = 1.0, log = None, cache = None, max_images = 8):
+        self.fixed_ports = ports
+        self.scan_interval = scan_interval
+        self.log = log if log is not None else (lambda message: None)
+        self.cache = cache if cache is not None else ImageCache()
+        self.max_images = max_images
+
+        self.boards = {}
+        self.images = {}
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.watcher = None
+
+    ############################################################################
+    ### boards
+
+    def scan(self):
+        """
+        Open boards that appeared and close those that are gone or broken.
+        """
+        ports = self.fixed_ports if self.fixed_ports is not None else find_ports()
+
+        with self.condition:
+            for port, board in list(self.boards.items()):
+                if board.busy:
+                    continue
+
+                if board.broken or port not in ports:
+                    board.close()
+                    del self.boards[port]
+                    self.log("Closed {}.".format(port))
+
+            new_ports = [port for port in ports if port not in self.boards]
+
+        for port in new_ports:
+            try:
+                board = Board(port)
+            except (serial.SerialException, OSError):
+                # not ready yet or not ours; try again on the next scan
+                continue
+
+            with self.condition:
+                self.boards[port] = board
+                self.condition.notify_all()
+
+            self.log("Opened {}.".format(port))
+
+    def _watch(self):
+        while not self.stopping.wait(self.scan_interval):
+            try:
+                self.scan()
+            except Exception:
+                self.log(traceback.format_exc())
+
+    def start(self):
+        self.scan()
+        self.watcher = threading.Thread(target = self._watch, name = "tinyfpgaa-hotplug", daemon = True)
+        self.watcher.start()
+
+    def stop(self):
+        self.stopping.set()
+
+        if self.watcher is not None:
+            self.watcher.join()
+
+        with self.condition:
+            for board in self.boards.values():
+                board.close()
+            self.boards.clear()
+            self.condition.notify_all()
+
+    def acquire(self, port = None, wait = 30.0):
+        """
+        Reserve the board on port, or any idle board, waiting up to wait
+        seconds for it to be attached or to finish its current job.
+        """
+        deadline = time.monotonic() + wait
+
+        with self.condition:
+            while True:
+                if self.stopping.is_set():
+                    raise DaemonError("The daemon is shutting down.")
+
+                if port is not None:
+                    candidates = [self.boards[port]] if port in self.boards else []
+                else:
+                    candidates = [self.boards[p] for p in sorted(self.boards)]
+
+                for board in candidates:
+                    if not board.busy and not board.broken:
+                        board.busy = True
+                        return board
+
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    if port is not None and port not in self.boards:
+                        raise DaemonError("No programmer on {}.".format(port))
+                    if not self.boards:
+                        raise DaemonError("TinyFPGA A not detected! Is it plugged in?")
+                    raise DaemonError("Timed out waiting for a free programmer.")
+
+                self.condition.wait(remaining)
+
+    def release(self, board):
+        with self.condition:
+            board.busy = False
+            self.condition.notify_all()
+
+    ############################################################################
+    ### jobs
+
+    def load_image(self, filename, bitstream = False):
+        st = os.stat(filename)
+        key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size, bitstream)
+
+        with self.condition:
+            image = self.images.pop(key, None)
+
+        if image is None:
+            image = self.cache.load(filename, bitstream = bitstream)
+
+        with self.condition:
+            # most recently used last
+            self.images[key] = image
+
+            while len(self.images) > self.max_images:
+                del self.images[next(iter(self.images))]
+
+        return image
+
+    def program(self, filename, port = None, bitstream = False, skip_if_identical = False,
+            fingerprint = False, stats = False, progress = None, wait = 30.0):
+        """
+        Run a programming job and return its result as a dict.
+        """
+        start = time.perf_counter()
+        result = {"ok": False, "port": port, "programmed": False, "failures": [], "stats": None}
+
+        try:
+            image = self.load_image(filename, bitstream)
+            board = self.acquire(port, wait)
+        except (DaemonError, OSError, ValueError) as e:
+            result["failures"].append(str(e))
+            result["time"] = time.perf_counter() - start
+            return result
+
+        result["port"] = board.port
+        job_stats = ProgrammingStats() if stats else None
+
+        try:
+            self.log("Programming TinyFPGA A on {}...".format(board.port))
+
+            try:
+                programmed, failures = board.program(image, skip_if_identical, fingerprint, progress, job_stats)
+            except (serial.SerialException, OSError):
+                # a board unplugged and plugged back in between two scans
+                # leaves its old port open but dead; reopen it and try again
+                self.log("Reopening {} after an I/O error.".format(board.port))
+                board.reopen()
+                job_stats = ProgrammingStats() if stats else None
+                programmed, failures = board.program(image, skip_if_identical, fingerprint, progress, job_stats)
+
+            result["programmed"] = programmed
+            result["failures"] = failures
+        except Exception:
+            result["failures"].append(traceback.format_exc())
+        finally:
+            self.release(board)
+
+        if board.broken:
+            self.log("Closing {} after an error.".format(board.port))
+
+        result["ok"] = not result["failures"]
+        result["time"] = time.perf_counter() - start
+
+        if job_stats is not None:
+            result["stats"] = job_stats.report()
+
+        self.log("{} on {} in {:.2f}s.".format("Finished" if result["ok"] else "Failed", board.port, result["time"]))
+        return result
+
+    def list(self):
+        with self.condition:
+            return [self.boards[port].to_dict() for port in sorted(self.boards)]
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    # set once the client went away; a running job still finishes
+    disconnected = False
+
+    def _send(self, message):
+        if self.disconnected:
+            return
+
+        try:
+            self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+            self.wfile.flush()
+        except OSError:
+            self.disconnected = True
+
+    def handle(self):
+        daemon = self.server.daemon
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf-8"))
+                command = request["command"]
+            except (ValueError, KeyError, TypeError):
+                self._send({"done": True, "ok": False, "failures": ["Malformed request."]})
+                continue
+
+            if command == "program":
+                progress = None
+                if request.get("progress"):
+                    progress = lambda message: self._send({"progress": message})
+
+                result = daemon.program(request["file"], request.get("port"), request.get("bitstream", False),
+                    request.get("skip_if_identical", False), request.get("fingerprint", False),
+                    request.get("stats", False), progress, request.get("wait", 30.0))
+                self._send(dict(result, done = True))
+
+                if self.disconnected:
+                    return
+
+            elif command == "list":
+                self._send({"done": True, "ok": True, "boards": daemon.list()})
+
+            elif command == "shutdown":
+                self._send({"done": True, "ok": True})
+                # shutdown() waits for serve_forever(), which runs elsewhere
+                threading.Thread(target = self.server.shutdown).start()
+                return
+
+            else:
+                self._send({"done": True, "ok": False, "failures": ["Unknown command {}.".format(command)]})
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        self.path = path
+
+        if os.path.exists(path):
+            # a socket left behind by a daemon that died; refuse a live one
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                raise DaemonError("A daemon is already listening on {}.".format(path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(path)
+            finally:
+                probe.close()
+
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        os.chmod(path, 0o600)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def request(path, message, on_progress = None):
+    """
+    Send one request to the daemon listening on path and return its final
+    reply.  on_progress is called with every progress message.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+        with sock.makefile("rb") as f:
+            for line in f:
+                reply = json.loads(line.decode("utf-8"))
+
+                if reply.get("done"):
+                    return reply
+
+                if on_progress is not None:
+                    on_progress(reply["progress"])
+    finally:
+        sock.close()
+
+    raise DaemonError("The daemon closed the connection.")
+
+
+def serve(args):
+    print_lock = threading.Lock()
+
+    def log(message):
+        if not args.q:
+            with print_lock:
+                print(message)
+                sys.stdout.flush()
+
+    daemon = ProgrammingDaemon(args.p, args.scan_interval, log)
+    server = DaemonServer(args.socket, daemon)
+    daemon.start()
+    log("Listening on {}.".format(args.socket))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+
+    return 0
+
+
+def client(args):
+    if args.command == "program":
+        message = {
+            "command": "program",
+            "file": os.path.abspath(args.jed),
+            "port": args.p,
+            "bitstream": args.b,
+            "skip_if_identical": args.s,
+            "fingerprint": args.u,
+            "stats": args.stats is not None,
+            "progress": not args.q,
+            "wait": args.wait,
+        }
+    elif args.command == "list":
+        message = {"command": "list"}
+    else:
+        message = {"command": "shutdown"}
+
+    try:
+        reply = request(args.socket, message, lambda m: print(m))
+    except (OSError, DaemonError) as e:
+        print("Cannot reach the daemon on {}: {}".format(args.socket, e))
+        return 1
+
+    if args.command == "list":
+        for board in reply["boards"]:
+            state = "broken" if board["broken"] else ("busy" if board["busy"] else "idle")
+            print("{:<24} {:<6} {} jobs, {} failed".format(board["port"], state, board["jobs"], board["failed_jobs"]))
+        return 0
+
+    if args.command == "program":
+        if reply["stats"] is not None:
+            if args.stats == "json":
+                print(json.dumps(dict(reply["stats"], port = reply["port"])))
+            else:
+                print("Statistics for {}:".format(reply["port"]))
+                print(format_report(reply["stats"]))
+
+        if not reply["ok"]:
+            for failure in reply["failures"]:
+                # progress failures were already printed unless silent
+                if args.q or not failure.endswith("Failed!"):
+                    print(failure.rstrip())
+            print("Programming Failed{}!".format(" on " + reply["port"] if reply["port"] else ""))
+            return 2
+
+        if not reply["programmed"]:
+            print("Device already programmed with input file, skipped programming.")
+        print("Programming finished without error.")
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Keep TinyFPGA A programmers open and program boards on request.")
+    parser.add_argument("--socket", type=str, default=default_socket_path(), help="Unix socket of the daemon.")
+    commands = parser.add_subparsers(dest = "command")
+
+    serve_parser = commands.add_parser("serve", help = "Run the daemon.")
+    serve_parser.add_argument("-p", type=str, action="append", help="Serial device to manage.  Repeat for several; default is every attached TinyFPGA A.")
+    serve_parser.add_argument("-q", action="store_true", help="Silent mode.")
+    serve_parser.add_argument("--scan-interval", type=float, default=1.0, help="Seconds between scans for plugged and unplugged programmers.")
+
+    program_parser = commands.add_parser("program", help = "Program a board through the daemon.")
+    program_parser.add_argument("-p", type=str, help="Serial device to use; default is any idle programmer.")
+    program_parser.add_argument("-q", action="store_true", help="Silent mode.")
+    program_parser.add_argument("-b", action="store_true", help="Input is bitstream file.")
+    program_parser.add_argument("-s", action="store_true", help="Skip programming if the flash already matches the input file.")
+    program_parser.add_argument("-u", action="store_true", help="Store an image fingerprint in the USERCODE and skip programming if it already matches.")
+    program_parser.add_argument("--stats", type=str, choices=["text", "json"], help="Report per-phase timing and traffic.")
+    program_parser.add_argument("--wait", type=float, default=30.0, help="Seconds to wait for a free programmer.")
+    program_parser.add_argument("jed", type=str, help="JEDEC or bitstream file to program.")
+
+    commands.add_parser("list", help = "List the programmers the daemon holds open.")
+    commands.add_parser("stop", help = "Stop the daemon.")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        return serve(args)
+    elif args.command in ("program", "list", "stop"):
+        return client(args)
+
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,771 @@
+"""
+Decoder and profiler for programmer wire streams.
+
+Decodes the bytes sent to a TinyFPGA Programmer back into firmware commands
+and, by following the JTAG TAP through every clock they produce, into JTAG
+operations: IR and DR scans, runtests and plain TAP navigation.  Every byte
+of the stream is put in a category, so a capture shows how much of it is
+scan payload and how much goes to command headers, TAP navigation, idle
+clocks, status polling, loops and packet padding.  Given a session log of
+tinyfpgaa.record, the time the host spent on the bytes is attributed the
+same way and drawn as a timeline.
+
+    python -m tinyfpgaa.decode session.log
+    python -m tinyfpgaa.decode --ops --timeline 40 session.log
+    python -m tinyfpgaa.decode --commands blinky.tfw
+"""
+import sys
+import bisect
+import argparse
+from .tinyfpgaa import JtagStateMachine, BufferedSerial
+from .emulator import MachXO2, FirmwarePins
+from . import record
+
+
+CATEGORIES = ("payload", "header", "navigation", "runtest", "status", "loop", "setup", "pad")
+
+# one character per category in timeline bars
+_BAR_CHARS = {
+    "payload": "#",
+    "header": "h",
+    "navigation": "n",
+    "runtest": "r",
+    "status": "s",
+    "loop": "l",
+    "setup": "c",
+    "pad": ".",
+}
+
+INSTRUCTION_NAMES = dict((value, name) for name, value in vars(MachXO2).items()
+    if name.isupper() and isinstance(value, int) and not name.startswith(("STATUS_", "IR_")))
+
+
+def instruction_name(instruction):
+    if instruction is None:
+        return "-"
+    return INSTRUCTION_NAMES.get(instruction, "0x%02X" % instruction)
+
+
+class Command(object):
+    """
+    A firmware command decoded at offset in the stream.  bytes maps
+    categories to how many of its size bytes are in them, clocks is the
+    number of TCK cycles it produces and responses the most bytes the
+    programmer sends back for it.  state is the TAP state after it.
+    Commands of a LOOP body are decoded once and have in_loop set.
+    """
+    def __init__(self, offset, name, in_loop, sie = None):
+        self.offset = offset
+        self.name = name
+        self.sie = sie
+        self.in_loop = in_loop
+        self.size = 0
+        self.bytes = {}
+        self.clocks = 0
+        self.responses = 0
+        self.state = None
+        self.op = None
+
+        # clocks spent shifting and idling, to categorize a SHIFT
+        self.shifted = 0
+        self.idled = 0
+
+    def add(self, category, count):
+        if count > 0:
+            self.bytes[category] = self.bytes.get(category, 0) + count
+            self.size += count
+
+
+class JtagOperation(object):
+    """
+    A JTAG level operation made of consecutive commands: an "ir" or "dr"
+    scan with the TAP navigation around it, a "runtest", navigation alone,
+    a "goto", or a whole firmware "loop".  tdi holds the bits shifted in,
+    LSB first, and instruction is the instruction loaded when it started,
+    or for a loop, when it ended.  loads is the instruction an IR scan
+    loads.
+    Commands that follow without clocking the TAP, such as status requests,
+    are counted with it, but padding is counted with the loop it aligns.
+    Operations end when the TAP rests in IDLE or RESET, and a scan also ends
+    where the next one is captured.
+    """
+    def __init__(self, start_state, instruction, in_loop, kind = "goto"):
+        self.kind = kind
+        self.start_state = start_state
+        self.end_state = start_state
+        self.instruction = instruction
+        self.in_loop = in_loop
+        self.bits = 0
+        self.tdi = 0
+        self.loads = None
+        self.runtest = 0
+        self.commands = []
+        self.bytes = {}
+        self.responses = 0
+        self.closed = False
+
+    @property
+    def offset(self):
+        return self.commands[0].offset if self.commands else None
+
+    @property
+    def size(self):
+        return sum(self.bytes.values())
+
+    def add(self, command):
+        self.commands.append(command)
+        self.responses += command.responses
+
+        for category, count in command.bytes.items():
+            self.bytes[category] = self.bytes.get(category, 0) + count
+
+    def absorb(self, other):
+        for command in other.commands:
+            self.add(command)
+
+        self.runtest += other.runtest
+        self.end_state = other.end_state
+
+
+class WireDecoder(FirmwarePins):
+    """
+    Decodes a command stream as firmware/main.c executes it, following the
+    GPIO outputs, the SIE configurations and the TAP state.  The TAP is
+    assumed to start in state, which does not matter for the usual stream
+    that begins by resetting it.  An IR scan loads the last ir_length bits
+    shifted in.
+    """
+    PAD_BYTE = BufferedSerial.PAD_BYTE
+
+    SHIFT_STATES = ("IRSHIFT", "DRSHIFT")
+    REST_STATES = ("IDLE", "RESET")
+
+    def __init__(self, state = "RESET", ir_length = MachXO2.IR_LENGTH):
+        FirmwarePins.__init__(self)
+        self.states = JtagStateMachine().states
+        self.state = state
+        self.ir_length = ir_length
+        self.instruction = None
+        # bits shifted in by the current IR scan
+        self.ir_value = 0
+        self.ir_bits = 0
+
+        self.in_loop = False
+
+        self.commands = []
+        self.ops = []
+        self.op = None
+        self.command = None
+        self.pending = []
+        self.truncated = 0
+
+
+    ############################################################################
+    ### TAP
+
+    def _operation(self):
+        """
+        Return the operation a TAP command starting now belongs to.
+        """
+        if self.op is None or self.op.closed:
+            self.op = JtagOperation(self.state, self.instruction, self.in_loop)
+            self.ops.append(self.op)
+            self._attach_pending()
+
+        return self.op
+
+
+    def _attach_pending(self):
+        for command in self.pending:
+            command.op = self.op
+            self.op.add(command)
+
+        self.pending = []
+
+
+    def _shift_bits(self, tdi, num_bits):
+        op = self.op
+        if op.kind != "loop":
+            op.kind = "ir" if self.state == "IRSHIFT" else "dr"
+        op.tdi |= tdi << op.bits
+        op.bits += num_bits
+
+        if self.state == "IRSHIFT":
+            self.ir_value |= tdi << self.ir_bits
+            self.ir_bits += num_bits
+        self.command.shifted += num_bits
+
+
+    def _idle(self, num_bits):
+        op = self.op
+        if op.kind == "goto" and op.bits == 0:
+            op.kind = "runtest"
+        op.runtest += num_bits
+        self.command.idled += num_bits
+
+
+    def _tap_rising(self, tms, tdi):
+        state = self.state
+        self.command.clocks += 1
+
+        if state in self.SHIFT_STATES:
+            self._shift_bits(1 if tdi else 0, 1)
+        elif not tms and self.states[state][0] == state:
+            self._idle(1)
+
+        state = self.states[state][1 if tms else 0]
+
+        if state in ("IRCAPTURE", "DRCAPTURE") and self.op.bits > 0 and not self.in_loop:
+            # the previous scan is over, a new one begins
+            self.op.end_state = self.state
+            self.op.closed = True
+            self._operation()
+
+        if state == "IRCAPTURE":
+            self.ir_value = 0
+            self.ir_bits = 0
+        elif state == "IRUPDATE":
+            self.instruction = (self.ir_value >> max(self.ir_bits - self.ir_length, 0)) & ((1 << self.ir_length) - 1)
+
+            if self.op.kind == "ir":
+                self.op.loads = self.instruction
+
+        self.state = state
+
+
+    def _tap_falling(self):
+        pass
+
+
+    def _tap_clock(self, tms, tdi, num_bits):
+        """
+        num_bits clocks with a constant TMS and TDI taken from tdi, LSB
+        first.  Runs that keep the TAP in its state are done at once.  TDO
+        is not known, so it reads as zeros.
+        """
+        while num_bits > 0:
+            state = self.state
+
+            if not tms and state in self.SHIFT_STATES:
+                self.command.clocks += num_bits
+                self._shift_bits(tdi & ((1 << num_bits) - 1), num_bits)
+                return 0
+
+            if self.states[state][1 if tms else 0] == state:
+                self.command.clocks += num_bits
+                if not tms:
+                    self._idle(num_bits)
+                return 0
+
+            self._tap_rising(tms, tdi & 1)
+            tdi >>= 1
+            num_bits -= 1
+
+        return 0
+
+
+    def _portc(self):
+        return self.latc & ~self.gpio_dir & 0x3f
+
+
+    ############################################################################
+    ### commands
+
+    def _begin(self, offset, name, sie = None, tap = False):
+        command = Command(offset, name, self.in_loop, sie)
+        self.command = command
+        # the operation current when a command starts owns its bytes
+        command.op = self._operation() if tap else self.op
+        return command
+
+
+    def _end(self, command):
+        command.state = self.state
+        self.commands.append(command)
+
+        if "pad" in command.bytes:
+            # padding belongs to the loop it aligns
+            command.op = None
+            self.pending.append(command)
+            return
+
+        op = command.op
+
+        if op is None:
+            return
+
+        op.add(command)
+
+        if command.name == "end_loop" or (self.state in self.REST_STATES and command.clocks > 0 and not self.in_loop):
+            current = self.op
+            current.end_state = self.state
+            current.closed = True
+            self._merge_runtest(current)
+
+
+    def _merge_runtest(self, op):
+        """
+        Fold consecutive runtests in the same state into one operation.
+        """
+        if op.kind != "runtest" or len(self.ops) < 2:
+            return
+
+        previous = self.ops[-2]
+
+        if previous.kind == "runtest" and previous.end_state == op.start_state == op.end_state:
+            previous.absorb(op)
+            self.ops.pop()
+            self.op = previous
+
+            for command in op.commands:
+                command.op = previous
+
+
+    def _shift(self, command, data, pos, sie, num_bits, num_bytes):
+        """
+        Decode the payload of a SHIFT command at pos and clock it.  Returns
+        the payload length.
+        """
+        config = self.sie_configs[sie]
+        inout_cfg = config[0] & 0xf
+        overlay = config[6]
+        total = num_bytes * 8 + num_bits
+        value = 0
+
+        if inout_cfg == 0x0C:
+            # DATA COMPARE ONLY
+            size = 2 * (num_bytes + 1)
+        elif inout_cfg == 4:
+            # SHIFT DATA IN ONLY
+            size = 0
+            command.responses = num_bytes + 1
+        elif inout_cfg == 1:
+            # SHIFT DATA OUT ONLY
+            size = num_bytes + 1
+            value = int.from_bytes(data[pos:pos + size], 'little') & ((1 << total) - 1)
+        elif inout_cfg == 0:
+            # RUN PHASE 0 PATTERN ONLY
+            size = 0
+        else:
+            # not handled by the firmware
+            return 0
+
+        if pos + size > len(data):
+            return None
+
+        if inout_cfg == 0:
+            self._clock_bits(sie, 0, total)
+        else:
+            self._clock_bits(sie, value, total - 1)
+            self._clock_bits(sie, value >> (total - 1), 1, overlay)
+
+        return size
+
+
+    def decode(self, data):
+        """
+        Decode data, a bytes-like command stream, appending to commands and
+        ops.  A command cut off at the end of data is counted in truncated.
+        Returns self.
+        """
+        data = bytes(data)
+        pos = 0
+        end = len(data)
+
+        while pos < end:
+            cmd = data[pos]
+            op0 = cmd & 0xc0
+
+            if op0 == 0x40 or op0 == 0x80:
+                # SET and SET_GET
+                value = cmd & ~self.gpio_dir
+                tap = self._clocks_tap(value)
+                changed = (value & 0x3f) != (self.latc & ~self.gpio_dir)
+                command = self._begin(pos, "set" if op0 == 0x40 else "set_get", tap = tap)
+                self._set_latc(value)
+
+                if op0 == 0x80:
+                    command.responses = 1
+
+                size = 1
+
+                if tap or changed or op0 == 0x80:
+                    command.add("navigation", 1)
+                else:
+                    # padding by BufferedSerial.fit_packet(), or no effect;
+                    # a run of it is one command
+                    while pos + size < end and data[pos + size] == cmd:
+                        size += 1
+
+                    command.add("pad", size)
+
+            elif (cmd & 0xf8) == 0x18:
+                # SHIFT
+                if pos + 3 > end:
+                    break
+
+                sie = cmd & 0x7
+                num_bits, num_bytes = data[pos + 1], data[pos + 2]
+                command = self._begin(pos, "shift", sie, tap = True)
+                payload = self._shift(command, data, pos + 3, sie, num_bits, num_bytes)
+
+                if payload is None:
+                    break
+
+                if command.shifted > 0:
+                    command.add("header", 3)
+                    command.add("payload", payload)
+                elif command.clocks > 0 and command.idled == command.clocks:
+                    command.add("runtest", 3 + payload)
+                else:
+                    command.add("navigation", 3 + payload)
+
+                size = 3 + payload
+
+            elif cmd == 0x10:
+                # LOOP
+                if pos + 3 > end:
+                    break
+
+                if self.op is not None and not self.op.closed:
+                    self.op.end_state = self.state
+                    self.op.closed = True
+
+                # the whole body is one operation, with the padding before it
+                self.op = JtagOperation(self.state, self.instruction, True, "loop")
+                self.ops.append(self.op)
+                self._attach_pending()
+
+                self.in_loop = True
+                command = self._begin(pos, "loop")
+                command.add("loop", 3)
+                size = 3
+
+            elif cmd == 0x11:
+                # END_LOOP, which reports FAIL if the count runs out
+                command = self._begin(pos, "end_loop")
+                command.add("loop", 1)
+                command.responses = 1
+                if self.in_loop:
+                    # an instruction scanned before the loop takes effect in it
+                    self.op.instruction = self.instruction
+                    self.op.end_state = self.state
+
+                self.in_loop = False
+                size = 1
+
+            elif (cmd & 0xf8) == 0x08:
+                # CONFIG_SIE
+                if pos + 8 > end:
+                    break
+
+                command = self._begin(pos, "config_sie", cmd & 0x7)
+                command.add("setup", 8)
+                self._config_sie(cmd & 0x7, list(data[pos + 1:pos + 8]))
+                size = 8
+
+            elif cmd == 0x20 or cmd == 0x21:
+                command = self._begin(pos, "clear_status" if cmd == 0x20 else "get_status")
+                command.add("status", 1)
+                command.responses = cmd & 1
+                size = 1
+
+            else:
+                # CONFIG_IO
+                if pos + 2 > end:
+                    break
+
+                command = self._begin(pos, "config_io")
+                command.add("setup", 2)
+                self._config_io(data[pos + 1])
+                size = 2
+
+            self._end(command)
+            pos += size
+
+        if self.op is not None:
+            self._attach_pending()
+
+        # a capture in the last command of an operation, or a command cut
+        # off at the end, can start one that gets no commands
+        self.ops = [op for op in self.ops if op.commands]
+
+        self.truncated = end - pos
+        self.command = None
+        return self
+
+
+def decode(data, state = "RESET", ir_length = MachXO2.IR_LENGTH):
+    """
+    Decode a command stream and return the WireDecoder, which holds the
+    commands and ops.
+    """
+    return WireDecoder(state, ir_length).decode(data)
+
+
+def category_totals(items):
+    """
+    Sum the bytes of Commands or JtagOperations by category.
+    """
+    totals = dict((category, 0) for category in CATEGORIES)
+
+    for item in items:
+        for category, count in item.bytes.items():
+            totals[category] += count
+
+    return totals
+
+
+def summarize_ops(ops):
+    """
+    Group JtagOperations by kind and instruction: IR scans by the
+    instruction they load, DR scans and loops by the instruction they were
+    made under.  Returns a list of dicts in order of first appearance.
+    """
+    groups = {}
+
+    for op in ops:
+        if op.kind == "ir":
+            key = ("ir", op.loads)
+        elif op.kind in ("dr", "loop"):
+            key = (op.kind, op.instruction)
+        else:
+            key = (op.kind, None)
+
+        group = groups.get(key)
+
+        if group is None:
+            group = groups[key] = {"kind": key[0], "instruction": key[1], "count": 0, "bits": 0,
+                "runtest": 0, "bytes": 0, "responses": 0, "categories": dict((c, 0) for c in CATEGORIES)}
+
+        group["count"] += 1
+        group["bits"] += op.bits
+        group["runtest"] += op.runtest
+        group["bytes"] += op.size
+        group["responses"] += op.responses
+
+        for category, count in op.bytes.items():
+            group["categories"][category] += count
+
+    return list(groups.values())
+
+
+class SessionTimes(object):
+    """
+    Timing of the writes and reads of a recorded session.  The time from
+    the previous logged call to the end of a write is spread evenly over
+    the bytes written; the time spent in reads is waiting for answers.
+    """
+    def __init__(self, events):
+        self.starts = []
+        self.writes = []
+        self.reads = []
+        self.wait = 0.0
+
+        offset = 0
+        last = 0.0
+
+        for event in events:
+            duration = max(0.0, event.time - last)
+            last = event.time
+
+            if event.kind == record.WRITE and event.data:
+                self.starts.append(offset)
+                self.writes.append((offset, len(event.data), event.time, duration))
+                offset += len(event.data)
+            elif event.kind == record.READ:
+                self.reads.append((event.time, duration))
+                self.wait += duration
+
+        self.length = offset
+        self.end = last
+
+    def locate(self, offset):
+        """
+        Return (time, seconds per byte) of the write holding offset.
+        """
+        index = bisect.bisect_right(self.starts, offset) - 1
+        start, length, time, duration = self.writes[max(index, 0)]
+        return time, duration / length
+
+    def command_time(self, command):
+        time, per_byte = self.locate(command.offset)
+        return per_byte * command.size
+
+    def category_times(self, commands):
+        totals = dict((category, 0.0) for category in CATEGORIES)
+
+        for command in commands:
+            time, per_byte = self.locate(command.offset)
+
+            for category, count in command.bytes.items():
+                totals[category] += per_byte * count
+
+        return totals
+
+    def timeline(self, commands, buckets):
+        """
+        Split the session into buckets of equal time.  Returns a list of
+        (start time, bytes by category, reads, read wait) per bucket.
+        """
+        span = self.end / buckets if self.end > 0 else 1.0
+        rows = [(i * span, dict((c, 0) for c in CATEGORIES), [0], [0.0]) for i in range(buckets)]
+
+        for command in commands:
+            time, per_byte = self.locate(command.offset)
+            row = rows[min(int(time / span), buckets - 1)]
+
+            for category, count in command.bytes.items():
+                row[1][category] += count
+
+        for time, duration in self.reads:
+            row = rows[min(int(time / span), buckets - 1)]
+            row[2][0] += 1
+            row[3][0] += duration
+
+        return [(start, counts, reads[0], wait[0]) for start, counts, reads, wait in rows]
+
+
+def load_stream(filename):
+    """
+    Read a session log, a wire stream or a raw capture.  Returns the bytes
+    sent and the session events, None unless it was a session log.
+    """
+    with open(filename, "rb") as f:
+        raw = f.read()
+
+    if raw.startswith(b"TFAR"):
+        with open(filename, "rb") as f:
+            events = record.read_session(f).events
+        return b"".join(event.data for event in events if event.kind == record.WRITE), events
+
+    if raw.startswith(b"TFAW"):
+        from .wire import WireStream
+        return WireStream.unpack(raw).data, None
+
+    return raw, None
+
+
+def format_categories(decoder, times = None):
+    totals = category_totals(decoder.commands)
+    total = sum(totals.values()) or 1
+    category_times = times.category_times(decoder.commands) if times is not None else None
+    lines = ["{:<12} {:>10} {:>7}".format("category", "bytes", "share") +
+        (" {:>10} {:>7}".format("host time", "share") if times is not None else "")]
+
+    time_total = sum(category_times.values()) if category_times else 0.0
+
+    for category in CATEGORIES:
+        line = "{:<12} {:>10} {:>6.1f}%".format(category, totals[category], 100.0 * totals[category] / total)
+
+        if category_times is not None:
+            line += " {:>9.3f}s {:>6.1f}%".format(category_times[category],
+                100.0 * category_times[category] / time_total if time_total else 0.0)
+
+        lines.append(line)
+
+    lines.append("{:<12} {:>10}".format("total", sum(totals.values())))
+
+    if times is not None:
+        lines.append("{} reads waited {:.3f}s of {:.3f}s".format(len(times.reads), times.wait, times.end))
+
+    if decoder.truncated:
+        lines.append("{} bytes at the end are a cut off command".format(decoder.truncated))
+
+    return "\n".join(lines)
+
+
+def format_op_summary(ops):
+    columns = ("payload", "header", "navigation", "runtest", "status", "loop", "pad")
+    lines = ["{:<8} {:<22} {:>6} {:>9} {:>9} {:>9} {:>8}".format("kind", "instruction", "count", "bits", "idle clk", "bytes", "per op") +
+        "".join(" {:>10}".format(c) for c in columns)]
+
+    for group in summarize_ops(ops):
+        lines.append("{:<8} {:<22} {:>6} {:>9} {:>9} {:>9} {:>8.1f}".format(
+            group["kind"], instruction_name(group["instruction"]), group["count"], group["bits"],
+            group["runtest"], group["bytes"], float(group["bytes"]) / group["count"]) +
+            "".join(" {:>10}".format(group["categories"][c]) for c in columns))
+
+    return "\n".join(lines)
+
+
+def format_commands(commands):
+    lines = []
+
+    for command in commands:
+        sie = "sie {}".format(command.sie) if command.sie is not None else ""
+        lines.append("{:>9} {:<1}{:<12} {:<6} {:>6} clk {:>5} B {:<28} {}".format(
+            command.offset, "*" if command.in_loop else " ", command.name, sie, command.clocks, command.size,
+            " ".join("{}={}".format(c, n) for c, n in command.bytes.items()), command.state))
+
+    return "\n".join(lines)
+
+
+def format_ops(ops):
+    lines = []
+
+    for op in ops:
+        if op.kind in ("ir", "dr"):
+            detail = "{} bits tdi=0x{:X}".format(op.bits, op.tdi)
+        elif op.kind == "runtest":
+            detail = "{} clocks".format(op.runtest)
+        else:
+            detail = ""
+
+        lines.append("{:>9} {:<1}{:<8} {:<22} {:<40} {:>5} B  {} -> {}".format(
+            op.offset, "*" if op.in_loop else " ", op.kind, instruction_name(op.loads if op.kind == "ir" else op.instruction),
+            detail[:40], op.size, op.start_state, op.end_state))
+
+    return "\n".join(lines)
+
+
+def format_timeline(rows, width = 60):
+    most = max(sum(counts.values()) for start, counts, reads, wait in rows) or 1
+    lines = ["{:>9} {:>9} {:>6} {:>8}  one character is about {} bytes: {}".format(
+        "time", "bytes", "reads", "waited", max(1, most // width),
+        " ".join("{}={}".format(_BAR_CHARS[c], c) for c in CATEGORIES))]
+
+    for start, counts, reads, wait in rows:
+        bar = ""
+
+        for category in CATEGORIES:
+            bar += _BAR_CHARS[category] * int(round(float(counts[category]) * width / most))
+
+        lines.append("{:>8.3f}s {:>9} {:>6} {:>7.3f}s  {}".format(start, sum(counts.values()), reads, wait, bar))
+
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Decode and profile TinyFPGA A programmer wire streams.")
+    parser.add_argument("input", type=str, help="Session log of tinyproga --record, wire stream or raw capture of the bytes sent.")
+    parser.add_argument("--commands", action="store_true", help="List every firmware command.")
+    parser.add_argument("--ops", action="store_true", help="List every JTAG operation.")
+    parser.add_argument("--timeline", type=int, default=20, metavar="N", help="Rows of the timeline of a session log.")
+    args = parser.parse_args()
+
+    data, events = load_stream(args.input)
+    decoder = decode(data)
+    times = SessionTimes(events) if events else None
+
+    if args.commands:
+        print(format_commands(decoder.commands))
+        print("")
+
+    if args.ops:
+        print(format_ops(decoder.ops))
+        print("")
+
+    print(format_categories(decoder, times))
+    print("")
+    print(format_op_summary(decoder.ops))
+
+    if times is not None and args.timeline > 0 and times.writes:
+        print("")
+        print(format_timeline(times.timeline(decoder.commands, args.timeline)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
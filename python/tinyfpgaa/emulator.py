@@ -0,0 +1,805 @@
+import threading
+from .tinyfpgaa import JtagStateMachine
+
+
+class MachXO2(object):
+    """
+    Behavioural model of the JTAG TAP, status register and non-volatile
+    memories of a Lattice MachXO2.  Only the instructions used by the
+    TinyFPGA A programming flow are modelled; anything else behaves like
+    BYPASS.
+
+    The model keeps its own simulated clock in seconds.  Every rising TCK
+    edge advances it by tck_period, and erase or program operations keep the
+    device busy for erase_time or program_time of simulated time.  Erased
+    flash reads back as all zeros.
+    """
+
+    ### instruction opcodes
+    ISC_ERASE = 0x0E
+    SAMPLE = 0x1C
+    ISC_DISABLE = 0x26
+    LSC_READ_STATUS = 0x3C
+    LSC_INIT_ADDRESS = 0x46
+    LSC_INIT_ADDR_UFM = 0x47
+    ISC_PROGRAM_DONE = 0x5E
+    LSC_PROG_INCR_NV = 0x70
+    LSC_READ_INCR_NV = 0x73
+    ISC_ENABLE_X = 0x74
+    LSC_REFRESH = 0x79
+    USERCODE = 0xC0
+    ISC_PROGRAM_USERCODE = 0xC2
+    ISC_ENABLE = 0xC6
+    IDCODE = 0xE0
+    LSC_PROG_FEATURE = 0xE4
+    LSC_READ_FEATURE = 0xE7
+    LSC_CHECK_BUSY = 0xF0
+    LSC_PROG_FEABITS = 0xF8
+    LSC_READ_FEABITS = 0xFB
+    BYPASS = 0xFF
+
+    ### status register bits
+    STATUS_DONE = 1 << 8
+    STATUS_ENABLED = 1 << 9
+    STATUS_BUSY = 1 << 12
+    STATUS_FAIL = 1 << 13
+
+    IR_LENGTH = 8
+    IR_CAPTURE = 0x01
+
+    def __init__(self,
+        idcode = 0x012BA043,
+        usercode = 0,
+        boundary_length = 208,
+        tck_period = 1e-6,
+        erase_time = 0.1,
+        program_time = 0.0002
+    ):
+        self.idcode = idcode
+        self.usercode = usercode
+        self.boundary_length = boundary_length
+        self.tck_period = tck_period
+        self.erase_time = erase_time
+        self.program_time = program_time
+
+        self.states = JtagStateMachine().states
+
+        ### non-volatile state
+        self.cfg_flash = {}
+        self.ufm_flash = {}
+        self.feature_row = 0
+        self.feature_bits = 0
+        self.done_fuse = False
+
+        ### volatile state
+        self.enabled = False
+        self.done = False
+        self.fail = False
+        self.busy_until = 0.0
+        self.address_space = self.cfg_flash
+        self.address = 0
+
+        ### TAP state
+        self.state = "RESET"
+        self.ir = self.IDCODE
+        self.ir_shift = 0
+        self.dr = 0
+        self.dr_length = 1
+        self.tdo = 1
+
+        ### simulated clock and counters
+        self.now = 0.0
+        self.tck_cycles = 0
+        self.rows_programmed = 0
+        self.rows_read = 0
+
+
+    @property
+    def busy(self):
+        return self.now < self.busy_until
+
+
+    @property
+    def status(self):
+        status = 0
+        if self.done:    status |= self.STATUS_DONE
+        if self.enabled: status |= self.STATUS_ENABLED
+        if self.busy:    status |= self.STATUS_BUSY
+        if self.fail:    status |= self.STATUS_FAIL
+        return status
+
+
+    def _start_operation(self, duration):
+        """
+        Begin an erase or program operation.  Starting one while disabled or
+        while a previous operation is still running sets the FAIL bit.
+        """
+        if not self.enabled or self.busy:
+            self.fail = True
+            return False
+
+        self.busy_until = self.now + duration
+        return True
+
+
+    def _reset(self):
+        self.ir = self.IDCODE
+
+
+    def _capture_dr(self):
+        ir = self.ir
+
+        if ir == self.IDCODE:
+            self.dr, self.dr_length = self.idcode, 32
+        elif ir == self.USERCODE:
+            self.dr, self.dr_length = self.usercode, 32
+        elif ir == self.LSC_READ_STATUS:
+            self.dr, self.dr_length = self.status, 32
+        elif ir == self.LSC_CHECK_BUSY:
+            self.dr, self.dr_length = int(self.busy), 1
+        elif ir == self.LSC_READ_INCR_NV:
+            self.dr, self.dr_length = self.address_space.get(self.address, 0), 128
+            self.address += 1
+            self.rows_read += 1
+        elif ir == self.LSC_READ_FEATURE:
+            self.dr, self.dr_length = self.feature_row, 64
+        elif ir == self.LSC_READ_FEABITS:
+            self.dr, self.dr_length = self.feature_bits, 16
+        elif ir == self.SAMPLE:
+            self.dr, self.dr_length = 0, self.boundary_length
+        elif ir in (self.ISC_ENABLE, self.ISC_ENABLE_X, self.ISC_ERASE, self.LSC_INIT_ADDRESS):
+            self.dr, self.dr_length = 0, 8
+        elif ir == self.LSC_PROG_INCR_NV:
+            self.dr, self.dr_length = 0, 128
+        elif ir == self.LSC_PROG_FEATURE:
+            self.dr, self.dr_length = 0, 64
+        elif ir == self.LSC_PROG_FEABITS:
+            self.dr, self.dr_length = 0, 16
+        elif ir == self.ISC_PROGRAM_USERCODE:
+            self.dr, self.dr_length = 0, 32
+        else:
+            self.dr, self.dr_length = 0, 1
+
+
+    def _update_dr(self):
+        ir = self.ir
+        dr = self.dr
+
+        if ir in (self.ISC_ENABLE, self.ISC_ENABLE_X):
+            self.enabled = True
+
+        elif ir == self.ISC_ERASE:
+            # an SRAM-only erase completes within the following runtest
+            if not self._start_operation(self.erase_time if dr & 0x0E else 0):
+                return
+            if dr & 0x01:
+                self.done = False
+            if dr & 0x02:
+                self.feature_row = 0
+                self.feature_bits = 0
+            if dr & 0x04:
+                self.cfg_flash.clear()
+                self.usercode = 0
+                self.done_fuse = False
+            if dr & 0x08:
+                self.ufm_flash.clear()
+
+        elif ir == self.LSC_INIT_ADDRESS:
+            self.address = 0
+            if dr & 0x08:
+                self.address_space = self.ufm_flash
+            else:
+                self.address_space = self.cfg_flash
+
+        elif ir == self.LSC_PROG_INCR_NV:
+            if self._start_operation(self.program_time):
+                self.address_space[self.address] = self.address_space.get(self.address, 0) | dr
+                self.rows_programmed += 1
+            self.address += 1
+
+        elif ir == self.LSC_PROG_FEATURE:
+            if self._start_operation(self.program_time):
+                self.feature_row |= dr
+
+        elif ir == self.LSC_PROG_FEABITS:
+            if self._start_operation(self.program_time):
+                self.feature_bits |= dr
+
+        elif ir == self.ISC_PROGRAM_USERCODE:
+            if self._start_operation(self.program_time):
+                self.usercode |= dr
+
+
+    def _update_ir(self):
+        ir = self.ir
+
+        if ir == self.LSC_INIT_ADDR_UFM:
+            self.address_space = self.ufm_flash
+            self.address = 0
+
+        elif ir == self.ISC_PROGRAM_DONE:
+            if self._start_operation(self.program_time):
+                self.done_fuse = True
+
+        elif ir == self.ISC_DISABLE:
+            self.enabled = False
+            self.done = self.done_fuse
+
+        elif ir == self.LSC_REFRESH:
+            self.done = self.done_fuse
+
+
+    def falling(self):
+        """
+        Falling TCK edge.  TDO changes on the falling edge while shifting.
+        """
+        if self.state == "DRSHIFT":
+            self.tdo = self.dr & 1
+        elif self.state == "IRSHIFT":
+            self.tdo = self.ir_shift & 1
+
+
+    def rising(self, tms, tdi):
+        """
+        Rising TCK edge.  TMS and TDI are sampled and the TAP advances.
+        """
+        self.now += self.tck_period
+        self.tck_cycles += 1
+
+        state = self.state
+        tdi = 1 if tdi else 0
+
+        if state == "DRSHIFT":
+            self.dr = (self.dr >> 1) | (tdi << (self.dr_length - 1))
+        elif state == "IRSHIFT":
+            self.ir_shift = (self.ir_shift >> 1) | (tdi << (self.IR_LENGTH - 1))
+
+        state = self.states[state][1 if tms else 0]
+        self.state = state
+
+        if state == "DRCAPTURE":
+            self._capture_dr()
+        elif state == "IRCAPTURE":
+            self.ir_shift = self.IR_CAPTURE
+        elif state == "DRUPDATE":
+            self._update_dr()
+        elif state == "IRUPDATE":
+            self.ir = self.ir_shift
+            self._update_ir()
+        elif state == "RESET":
+            self._reset()
+
+
+    def clock_bits(self, tms, tdi, num_bits):
+        """
+        Apply num_bits full TCK cycles (falling edge, then rising edge) with a
+        constant TMS and TDI taken LSB first from the tdi integer.  Returns
+        the TDO value sampled after each rising edge, LSB first.  Long runs
+        in SHIFT, PAUSE, IDLE and RESET are handled without iterating per
+        bit.
+        """
+        if num_bits <= 0:
+            return 0
+
+        state = self.state
+
+        if not tms and state in ("DRSHIFT", "IRSHIFT"):
+            if state == "DRSHIFT":
+                reg, length = self.dr, self.dr_length
+            else:
+                reg, length = self.ir_shift, self.IR_LENGTH
+
+            out = 0
+            pos = 0
+            while pos < num_bits:
+                count = min(num_bits - pos, length)
+                mask = (1 << count) - 1
+                out |= (reg & mask) << pos
+                reg = (reg >> count) | (((tdi >> pos) & mask) << (length - count))
+                pos += count
+
+            if state == "DRSHIFT":
+                self.dr = reg
+            else:
+                self.ir_shift = reg
+
+            self.tdo = (out >> (num_bits - 1)) & 1
+            self.now += num_bits * self.tck_period
+            self.tck_cycles += num_bits
+            return out
+
+        if self.states[state][1 if tms else 0] == state and state not in ("DRSHIFT", "IRSHIFT"):
+            self.now += num_bits * self.tck_period
+            self.tck_cycles += num_bits
+            return ((1 << num_bits) - 1) if self.tdo else 0
+
+        out = 0
+        for i in range(num_bits):
+            self.falling()
+            self.rising(tms, (tdi >> i) & 1)
+            out |= self.tdo << i
+
+        return out
+
+
+
+class FirmwarePins(object):
+    """
+    GPIO and SIE state of the programmer firmware, stepped the way
+    firmware/main.c drives its pins.  Subclasses follow the TAP through
+    _tap_rising(tms, tdi), _tap_falling() and _tap_clock(tms, tdi, num_bits),
+    which applies num_bits full TCK cycles with a constant TMS and returns
+    the TDO bits, and give the pins read back with _portc().
+    """
+    TDO_PIN = 0x04
+    TDI_PIN = 0x08
+    TCK_PIN = 0x10
+    TMS_PIN = 0x20
+
+    def __init__(self):
+        self.gpio_dir = 0x3f
+        self.latc = 0
+        self._tck = 0
+        self.sie_configs = [[0] * 7 for i in range(8)]
+        self.sie_bulk = [None] * 8
+
+
+    def _config_io(self, value):
+        self.gpio_dir = value & 0x3f
+
+
+    def _config_sie(self, sie, config):
+        self.sie_configs[sie] = config
+        self.sie_bulk[sie] = self._bulk_params(sie)
+
+
+    def _clocks_tap(self, value):
+        """
+        True if setting the GPIO outputs to value gives a rising TCK edge.
+        """
+        return bool(value & ~self.gpio_dir & self.TCK_PIN and not self._tck)
+
+
+    def _set_latc(self, value):
+        self.latc = value & 0x3f
+        pins = self.latc & ~self.gpio_dir
+        tck = pins & self.TCK_PIN
+        old_tck = self._tck
+
+        if tck and not old_tck:
+            self._tap_rising(pins & self.TMS_PIN, pins & self.TDI_PIN)
+        elif old_tck and not tck:
+            self._tap_falling()
+
+        self._tck = tck
+
+
+    def _bulk_params(self, sie):
+        """
+        Work out whether an SIE configuration is a plain JTAG clock pattern
+        (TCK low then high, TMS constant, TDI constant or following the data)
+        so shifts can be handed to the TAP in one call.
+        """
+        config_byte, input_mask, do0p0, do0p1, do1p0, do1p1, overlay = self.sie_configs[sie]
+        tck, tms, tdi = self.TCK_PIN, self.TMS_PIN, self.TDI_PIN
+
+        if (do0p0 | do1p0) & tck or not (do0p1 & do1p1 & tck):
+            return None
+        if len(set(p & tms for p in (do0p0, do0p1, do1p0, do1p1))) != 1:
+            return None
+        if (do0p0 & tdi) != (do0p1 & tdi) or (do1p0 & tdi) != (do1p1 & tdi):
+            return None
+        if input_mask not in (0, self.TDO_PIN):
+            return None
+
+        return (bool(do0p0 & tms), bool(do0p0 & tdi), bool(do1p0 & tdi))
+
+
+    def _clock_bits(self, sie, data, num_bits, overlay = 0):
+        """
+        Clock num_bits through an SIE, choosing the do1 phases for one bits of
+        data and the do0 phases for zero bits.  Returns the bits sampled with
+        the SIE input mask.
+        """
+        if num_bits <= 0:
+            return 0
+
+        config_byte, input_mask, do0p0, do0p1, do1p0, do1p1, last_overlay = self.sie_configs[sie]
+        bulk = self.sie_bulk[sie]
+        outputs_driven = (self.gpio_dir & (self.TCK_PIN | self.TMS_PIN | self.TDI_PIN)) == 0
+
+        if bulk is not None and overlay == 0 and self._tck and outputs_driven:
+            tms, tdi0, tdi1 = bulk
+            mask = (1 << num_bits) - 1
+
+            if tdi0 == tdi1:
+                tdi = mask if tdi0 else 0
+            elif tdi1:
+                tdi = data & mask
+            else:
+                tdi = ~data & mask
+
+            out = self._tap_clock(tms, tdi, num_bits)
+            self.latc = do1p1 if (data >> (num_bits - 1)) & 1 else do0p1
+
+            if input_mask & self.gpio_dir:
+                return out
+            return mask if (self.latc & input_mask) else 0
+
+        result = 0
+        for i in range(num_bits):
+            if (data >> i) & 1:
+                self._set_latc(do1p0 | overlay)
+                self._set_latc(do1p1 | overlay)
+            else:
+                self._set_latc(do0p0 | overlay)
+                self._set_latc(do0p1 | overlay)
+
+            if self._portc() & input_mask:
+                result |= 1 << i
+
+        return result
+
+
+
+class ProgrammerEmulator(FirmwarePins):
+    """
+    Offline stand-in for a TinyFPGA A Programmer with a MachXO2 attached.  It
+    implements the subset of the pyserial interface used by SyncSerial and
+    AsyncSerial and executes the command stream exactly as firmware/main.c
+    does, including 64 byte USB packetization, in-packet LOOP replay and the
+    unsolicited FAIL status byte.
+
+    Wire activity is counted so that a programming run can be profiled
+    without hardware.  Simulated wall time is modelled with three clocks: the
+    host clock only advances while the host waits for data (read or flush),
+    OUT packets take usb_packet_time each on the link, and the device
+    processes a packet once it has arrived and its previous work is done.
+    Read data becomes visible to the host usb_turnaround after the device
+    produced it.
+    """
+    MAX_PKT_SIZE = 64
+
+    def __init__(self,
+        device = None,
+        usb_packet_time = 1e-3 / 19,
+        usb_turnaround = 1e-3,
+        timeout = 10
+    ):
+        if device is None:
+            device = MachXO2()
+
+        FirmwarePins.__init__(self)
+        self.device = device
+        self.usb_packet_time = usb_packet_time
+        self.usb_turnaround = usb_turnaround
+        self.timeout = timeout
+        self.is_open = True
+
+        ### firmware state
+        self.loop_count = 0
+        self.loop_start = 3
+        self.loop_is_active = False
+        self.status = 0
+        self.status_sent = False
+
+        self._rx_buf = b""
+        self._rx_ptr = 0
+        self._tx = bytearray()
+        self._tx_times = []
+        self._polled = 0
+
+        ### clocks
+        self.host_time = 0.0
+        self.link_time = 0.0
+
+        ### counters
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.write_calls = 0
+        self.read_calls = 0
+        self.packets = 0
+        self.round_trips = 0
+        self.flushes = 0
+        self.loop_iterations = 0
+
+        self._task = self._cmd_task()
+        next(self._task)
+
+        # lets a threaded transport write and read from different threads
+        self._lock = threading.RLock()
+
+
+    @property
+    def elapsed(self):
+        """
+        Simulated wall time in seconds since the emulator was created.
+        """
+        return max(self.host_time, self.link_time, self.device.now)
+
+
+    def stats(self):
+        return {
+            "bytes_written": self.bytes_written,
+            "bytes_read": self.bytes_read,
+            "write_calls": self.write_calls,
+            "read_calls": self.read_calls,
+            "packets": self.packets,
+            "round_trips": self.round_trips,
+            "flushes": self.flushes,
+            "loop_iterations": self.loop_iterations,
+            "tck_cycles": self.device.tck_cycles,
+            "elapsed": self.elapsed,
+        }
+
+
+    ############################################################################
+    ### pyserial interface
+
+    def write(self, data):
+        with self._lock:
+            if isinstance(data, int):
+                data = bytes([data])
+            data = bytes(data)
+
+            self.write_calls += 1
+            self.bytes_written += len(data)
+
+            for offset in range(0, len(data), self.MAX_PKT_SIZE):
+                self.packets += 1
+                self.link_time = max(self.link_time, self.host_time) + self.usb_packet_time
+                self.device.now = max(self.device.now, self.link_time)
+
+                self._rx_buf = data[offset:offset + self.MAX_PKT_SIZE]
+                self._rx_ptr = 0
+                next(self._task)
+
+            return len(data)
+
+
+    def read(self, size = 1):
+        with self._lock:
+            self.read_calls += 1
+
+            count = min(size, len(self._tx))
+            data = bytes(self._tx[:count])
+
+            if count > 0:
+                ready = self._tx_times[count - 1] + self.usb_turnaround
+                if size > self._polled and ready > self.host_time:
+                    self.host_time = ready
+                    self.round_trips += 1
+
+            if count < size:
+                # a real port would block until the timeout expires
+                self.host_time += self.timeout
+
+            del self._tx[:count]
+            del self._tx_times[:count]
+            self._polled = max(0, self._polled - count)
+            self.bytes_read += count
+
+            return data
+
+
+    def inWaiting(self):
+        with self._lock:
+            self._polled = len(self._tx)
+            return self._polled
+
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+
+    def flush(self):
+        with self._lock:
+            self.flushes += 1
+            self.host_time = max(self.host_time, self.link_time)
+
+
+    def flushInput(self):
+        with self._lock:
+            del self._tx[:]
+            del self._tx_times[:]
+            self._polled = 0
+
+
+    def flushOutput(self):
+        pass
+
+
+    def reset_input_buffer(self):
+        self.flushInput()
+
+
+    def reset_output_buffer(self):
+        self.flushOutput()
+
+
+    def close(self):
+        self.is_open = False
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    ############################################################################
+    ### firmware model
+
+    def _portc(self):
+        value = self.latc & ~self.gpio_dir & 0x3f
+        if self.device.tdo:
+            value |= self.TDO_PIN & self.gpio_dir
+        return value
+
+
+    def _tap_rising(self, tms, tdi):
+        self.device.rising(tms, tdi)
+
+
+    def _tap_falling(self):
+        self.device.falling()
+
+
+    def _tap_clock(self, tms, tdi, num_bits):
+        return self.device.clock_bits(tms, tdi, num_bits)
+
+
+    def _send_byte(self, value):
+        self._tx.append(value & 0xff)
+        self._tx_times.append(self.device.now)
+
+
+    def _get_byte(self):
+        while self._rx_ptr >= len(self._rx_buf):
+            yield
+        value = self._rx_buf[self._rx_ptr]
+        self._rx_ptr += 1
+        return value
+
+
+    def _cmd_task(self):
+        """
+        Mirror of cmd_task() in firmware/main.c.  Yields whenever the current
+        USB packet has been consumed.
+        """
+        get_byte = self._get_byte
+
+        while True:
+            cmd = yield from get_byte()
+            op0 = cmd & 0xc0
+
+            if op0 == 0x40:
+                # SET CMD
+                self._set_latc(cmd & ~self.gpio_dir)
+
+            elif op0 == 0x80:
+                # SET_GET CMD
+                byte_to_send = self._portc() & self.gpio_dir
+                self._set_latc(cmd & ~self.gpio_dir)
+                self._send_byte(byte_to_send)
+
+            elif (cmd & 0xf8) == 0x18:
+                # SHIFT CMD
+                sie = cmd & 0x7
+                num_bits = yield from get_byte()
+                num_bytes = yield from get_byte()
+
+                config = self.sie_configs[sie]
+                inout_cfg = config[0] & 0xf
+                last_phase_overlay = config[6]
+
+                if inout_cfg == 0x0C:
+                    # DATA COMPARE ONLY
+                    compare_data_matches = True
+
+                    for i in range(num_bytes):
+                        actual_data = self._clock_bits(sie, 0, 8)
+                        expected_data = yield from get_byte()
+                        mask = yield from get_byte()
+
+                        if (expected_data & mask) != (actual_data & mask):
+                            compare_data_matches = False
+
+                    actual_data = self._clock_bits(sie, 0, num_bits - 1)
+                    if self._clock_bits(sie, 0, 1, last_phase_overlay):
+                        actual_data |= 1 << max(num_bits - 1, 0)
+
+                    expected_data = yield from get_byte()
+                    mask = yield from get_byte()
+
+                    if (expected_data & mask) != (actual_data & mask & 0xff):
+                        compare_data_matches = False
+
+                    if self.loop_is_active:
+                        if compare_data_matches:
+                            self.loop_is_active = False
+                    elif not compare_data_matches:
+                        self.status = 1
+                        if not self.status_sent:
+                            self._send_byte(1)
+                            self.status_sent = True
+
+                elif inout_cfg == 4:
+                    # SHIFT DATA IN ONLY
+                    for i in range(num_bytes):
+                        self._send_byte(self._clock_bits(sie, 0, 8))
+
+                    data = self._clock_bits(sie, 0, num_bits - 1)
+                    if self._clock_bits(sie, 0, 1, last_phase_overlay):
+                        data |= 1 << max(num_bits - 1, 0)
+
+                    self._send_byte(data)
+
+                elif inout_cfg == 1:
+                    # SHIFT DATA OUT ONLY
+                    for i in range(num_bytes):
+                        data = yield from get_byte()
+                        self._clock_bits(sie, data, 8)
+
+                    data = yield from get_byte()
+                    self._clock_bits(sie, data, num_bits - 1)
+                    self._clock_bits(sie, data >> max(num_bits - 1, 0), 1, last_phase_overlay)
+
+                elif inout_cfg == 0:
+                    # RUN PHASE 0 PATTERN ONLY
+                    self._clock_bits(sie, 0, num_bytes * 8 + num_bits)
+
+            elif cmd == 0x10:
+                # LOOP CMD
+                low = yield from get_byte()
+                high = yield from get_byte()
+                self.loop_count = low | (high << 8)
+                # the body follows in the same packet
+                self.loop_start = self._rx_ptr
+                self.loop_is_active = True
+
+            elif cmd == 0x11:
+                # END_LOOP CMD
+                self.loop_count = (self.loop_count - 1) & 0xffff
+                self.loop_iterations += 1
+
+                if self.loop_count > 0:
+                    if self.loop_is_active:
+                        # loop is always contained in a single packet
+                        self._rx_ptr = self.loop_start
+
+                else:
+                    if self.loop_is_active:
+                        self.status = 1
+                        self.status_sent = True
+                        self._send_byte(1)
+
+                    self.loop_is_active = False
+
+            elif (cmd & 0xf8) == 0x08:
+                # CONFIG_SIE CMD
+                sie = cmd & 0x7
+                config = []
+                for i in range(7):
+                    value = yield from get_byte()
+                    config.append(value)
+
+                self._config_sie(sie, config)
+
+            elif cmd == 0x20:
+                # CLEAR STATUS CMD
+                self.status = 0
+                self.status_sent = False
+
+            elif cmd == 0x21:
+                # GET STATUS CMD
+                self._send_byte(self.status)
+                self.status_sent = True
+
+            else:
+                # CONFIG_IO CMD
+                value = yield from get_byte()
+                self._config_io(value)
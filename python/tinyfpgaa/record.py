@@ -0,0 +1,396 @@
+"""
+Recording and replay of programmer sessions.
+
+RecordingSerial wraps the pyserial object under any transport and logs
+every write, read, flush and inWaiting() call with a timestamp, after a
+header naming the transport.  ReplaySerial plays such a log back: it answers reads with the recorded
+responses and, optionally, checks that every byte written matches the
+recording.  A slow session captured on a production station can then be
+reproduced offline to profile host-side overhead, and wire streams of two
+library versions can be compared byte for byte.
+
+    tinyproga --record session.log blinky.jed
+    python -m tinyfpgaa.record replay session.log blinky.jed
+    python -m tinyfpgaa.record show session.log
+"""
+import sys
+import time
+import struct
+import argparse
+import threading
+import tinyfpgaa
+from .bench import TRANSPORTS
+
+
+LOG_FORMAT = 2
+
+_MAGIC = b"TFAR"
+# followed by the name of the transport, of the given length
+_HEADER = struct.Struct("<4sBB")
+_EVENT = struct.Struct("<cdII")
+
+# event kinds
+WRITE = b"W"
+READ = b"R"
+FLUSH = b"F"
+IN_WAITING = b"I"
+FLUSH_INPUT = b"X"
+FLUSH_OUTPUT = b"Y"
+STATUS_WINDOW = b"N"
+
+
+class SessionEvent(object):
+    """
+    One logged call.  time is in seconds since recording started.  data
+    holds the bytes written or read; arg is the size requested by a read,
+    the count returned by inWaiting() or the size of a status window.
+    """
+    def __init__(self, kind, time, arg = 0, data = b""):
+        self.kind = kind
+        self.time = time
+        self.arg = arg
+        self.data = data
+
+
+class Session(object):
+    """
+    A recorded session: the name of the transport it ran through, one of
+    bench.TRANSPORTS, and its SessionEvents.
+    """
+    def __init__(self, transport, events):
+        self.transport = transport
+        self.events = events
+
+
+def read_session(f):
+    """
+    Read a log written by RecordingSerial and return its Session.
+    """
+    header = f.read(_HEADER.size)
+
+    if len(header) < _HEADER.size or _HEADER.unpack(header)[:2] != (_MAGIC, LOG_FORMAT):
+        raise ValueError("Not a session log of this format.")
+
+    transport = f.read(_HEADER.unpack(header)[2]).decode("ascii")
+    events = []
+
+    while True:
+        raw = f.read(_EVENT.size)
+
+        if len(raw) < _EVENT.size:
+            return Session(transport, events)
+
+        kind, timestamp, arg, length = _EVENT.unpack(raw)
+        events.append(SessionEvent(kind, timestamp, arg, f.read(length)))
+
+
+def load_session(filename):
+    with open(filename, "rb") as f:
+        return read_session(f)
+
+
+class RecordingSerial(object):
+    """
+    Pass-through wrapper around a pyserial object that logs every call to
+    log_file, an open binary file.  transport is the name of the transport
+    in bench.TRANSPORTS that drives the port, which a replay needs to send
+    the same bytes.  Every other attribute is forwarded to the wrapped
+    object.  Pass status_window() to the programmer as its
+    status_window_resized, so the status window sizes it picks from its
+    timing are logged too, as they decide where it waits for status.
+    """
+    def __init__(self, ser, log_file, transport):
+        assert transport in TRANSPORTS
+
+        self.ser = ser
+        self.log_file = log_file
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        name = transport.encode("ascii")
+        log_file.write(_HEADER.pack(_MAGIC, LOG_FORMAT, len(name)) + name)
+
+    def _log(self, kind, arg = 0, data = b""):
+        with self.lock:
+            self.log_file.write(_EVENT.pack(kind, time.perf_counter() - self.start, arg, len(data)))
+            self.log_file.write(data)
+
+    def write(self, data):
+        count = self.ser.write(data)
+        self._log(WRITE, data = bytes(data))
+        return count
+
+    def read(self, size = 1):
+        data = self.ser.read(size = size)
+        self._log(READ, size, bytes(data))
+        return data
+
+    def inWaiting(self):
+        count = self.ser.inWaiting()
+        self._log(IN_WAITING, count)
+        return count
+
+    def flush(self):
+        self.ser.flush()
+        self._log(FLUSH)
+
+    def flushInput(self):
+        self.ser.flushInput()
+        self._log(FLUSH_INPUT)
+
+    def flushOutput(self):
+        self.ser.flushOutput()
+        self._log(FLUSH_OUTPUT)
+
+    def status_window(self, size):
+        self._log(STATUS_WINDOW, size)
+        return size
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+
+class ReplayMismatch(Exception):
+    """
+    A replayed session wrote different bytes than the recording at offset.
+    """
+    def __init__(self, offset, expected, actual):
+        Exception.__init__(self, "write at byte %d differs: recorded %s, replayed %s" % (
+            offset, bytes(expected).hex(), bytes(actual).hex()))
+        self.offset = offset
+        self.expected = expected
+        self.actual = actual
+
+
+class ReplaySerial(object):
+    """
+    Stand-in for a pyserial object that answers reads from a recorded
+    session.  Reads return the recorded responses in order, and successive
+    inWaiting() calls return the recorded counts in order, so a transport
+    that polls sees the same answers at the same points as in the recording
+    and the programmer makes the same decisions.  Passed to the programmer
+    as its status_window_resized, status_window() replays the status window
+    sizes the same way, in place of the sizes the replay's own timing would
+    give.  Once the recorded counts run out, inWaiting() reports every
+    response left.  With compare set, every byte written must match
+    the recorded wire stream or ReplayMismatch is raised.
+
+    A compared replay must run through the transport that was recorded,
+    as each transport writes the same commands in its own way.  Only
+    sessions of transports that read from the caller's thread replay
+    deterministically.  Under ThreadedSerial, which reads complete before
+    a wait depends on thread timing, and with it where packets are padded,
+    so its sessions can only be replayed without compare.
+    """
+    def __init__(self, events, compare = True):
+        self.compare = compare
+        self.timeout = None
+
+        self.expected = bytearray()
+        self.responses = bytearray()
+        self.waiting = []
+        self.windows = []
+
+        for event in events:
+            if event.kind == WRITE:
+                self.expected.extend(event.data)
+            elif event.kind == READ:
+                self.responses.extend(event.data)
+            elif event.kind == IN_WAITING:
+                self.waiting.append(event.arg)
+            elif event.kind == STATUS_WINDOW:
+                self.windows.append(event.arg)
+
+        self.written = 0
+        self.read_pos = 0
+        self.next_waiting = 0
+        self.next_window = 0
+
+        self.writes = 0
+        self.reads = 0
+
+    def write(self, data):
+        data = bytes(data)
+
+        if self.compare:
+            expected = self.expected[self.written:self.written + len(data)]
+
+            if expected != data:
+                offset = next((i for i, (a, b) in enumerate(zip(expected, data)) if a != b), len(expected))
+                raise ReplayMismatch(self.written + offset, expected[offset:offset + 16], data[offset:offset + 16])
+
+        self.written += len(data)
+        self.writes += 1
+        return len(data)
+
+    def inWaiting(self):
+        left = len(self.responses) - self.read_pos
+
+        if self.next_waiting < len(self.waiting):
+            self.next_waiting += 1
+            return min(self.waiting[self.next_waiting - 1], left)
+
+        return left
+
+    def status_window(self, size):
+        if self.next_window < len(self.windows):
+            self.next_window += 1
+            return self.windows[self.next_window - 1]
+
+        return size
+
+    def read(self, size = 1):
+        # a blocking read waits for the answer, which always comes
+        end = min(self.read_pos + size, len(self.responses))
+        data = bytes(self.responses[self.read_pos:end])
+        self.read_pos = end
+        self.reads += 1
+        return data
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    def finished(self):
+        """
+        True if everything recorded was written and read.
+        """
+        return self.written == len(self.expected) and self.read_pos == len(self.responses)
+
+
+def summarize(session):
+    """
+    Return a dict of totals over a recorded session.
+    """
+    events = session.events
+    summary = {"transport": session.transport, "events": len(events), "writes": 0, "bytes_written": 0,
+        "reads": 0, "bytes_read": 0, "flushes": 0, "in_waiting": 0, "time": events[-1].time if events else 0.0}
+
+    for event in events:
+        if event.kind == WRITE:
+            summary["writes"] += 1
+            summary["bytes_written"] += len(event.data)
+        elif event.kind == READ:
+            summary["reads"] += 1
+            summary["bytes_read"] += len(event.data)
+        elif event.kind == FLUSH:
+            summary["flushes"] += 1
+        elif event.kind == IN_WAITING:
+            summary["in_waiting"] += 1
+
+    return summary
+
+
+def replay_transport(session, transport = None, compare = True):
+    """
+    Return the name of the transport to replay session through: transport,
+    or the recorded one if None.  Raises ValueError if a compared replay
+    could not send the recorded bytes, see ReplaySerial.
+    """
+    if transport is None:
+        transport = session.transport
+
+    if compare and transport != session.transport:
+        raise ValueError("The session was recorded through the {} transport; a replay through {} sends different bytes and cannot be compared.".format(
+            session.transport, transport))
+
+    if compare and TRANSPORTS[transport] is tinyfpgaa.ThreadedSerial:
+        raise ValueError("A threaded replay pads packets depending on thread timing and cannot be compared.")
+
+    return transport
+
+
+def replay(session, image, transport = None, compare = True, skip_if_identical = False, fingerprint = False):
+    """
+    Program image against a replay of session, through transport or the
+    recorded one, and return a dict with the host CPU and wall time spent
+    and the replay counters.  Raises ReplayMismatch if compare is set and
+    the wire stream differs, and ValueError if the transport cannot be
+    compared, see replay_transport().
+    """
+    transport = replay_transport(session, transport, compare)
+
+    ser = ReplaySerial(session.events, compare = compare)
+    transport = TRANSPORTS[transport](ser)
+    programmer = tinyfpgaa.JtagCustomProgrammer(tinyfpgaa.Jtag(tinyfpgaa.JtagTinyFpgaProgrammer(transport)))
+    programmer.status_window_resized = ser.status_window
+
+    start = time.perf_counter()
+    cpu = time.process_time()
+
+    programmer.program(image, skip_if_identical = skip_if_identical, fingerprint = fingerprint)
+    transport.flush()
+    if isinstance(transport, tinyfpgaa.ThreadedSerial):
+        transport.close()
+
+    return {
+        "cpu": time.process_time() - cpu,
+        "time": time.perf_counter() - start,
+        "writes": ser.writes,
+        "reads": ser.reads,
+        "bytes_written": ser.written,
+        "finished": ser.finished(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Inspect and replay recorded TinyFPGA A programmer sessions.")
+    commands = parser.add_subparsers(dest = "command")
+
+    show_parser = commands.add_parser("show", help = "Print totals of a recorded session.")
+    show_parser.add_argument("log", type=str, help="Session log written by tinyproga --record.")
+
+    replay_parser = commands.add_parser("replay", help = "Program an image against a recorded session.")
+    replay_parser.add_argument("log", type=str, help="Session log written by tinyproga --record.")
+    replay_parser.add_argument("jed", type=str, help="JEDEC or bitstream file the session programmed.")
+    replay_parser.add_argument("-b", action="store_true", help="Input is bitstream file.")
+    replay_parser.add_argument("-s", action="store_true", help="The session skipped programming if the flash matched.")
+    replay_parser.add_argument("-u", action="store_true", help="The session used an image fingerprint.")
+    replay_parser.add_argument("-t", type=str, choices=sorted(TRANSPORTS), help="Serial transport to replay through, by default the recorded one.")
+    replay_parser.add_argument("--no-compare", action="store_true", help="Do not check the written bytes against the recording.")
+
+    args = parser.parse_args()
+
+    if args.command == "show":
+        for name, value in summarize(load_session(args.log)).items():
+            print("{:<14} {}".format(name, value))
+
+    elif args.command == "replay":
+        session = load_session(args.log)
+
+        try:
+            transport = replay_transport(session, args.t, not args.no_compare)
+        except ValueError as e:
+            parser.error("{}  Use --no-compare to replay anyway.".format(e))
+
+        if args.b:
+            image = tinyfpgaa.BitstreamFile(open(args.jed, "rb"))
+        else:
+            image = tinyfpgaa.JedecFile(open(args.jed, "r"))
+
+        try:
+            result = replay(session, image, transport, not args.no_compare, args.s, args.u)
+        except ReplayMismatch as e:
+            print("Wire stream differs from the recording: {}".format(e))
+            return 2
+
+        print("host cpu {:.3f}s, wall {:.3f}s, {} writes, {} reads, {} bytes".format(
+            result["cpu"], result["time"], result["writes"], result["reads"], result["bytes_written"]))
+
+        if not result["finished"] and not args.no_compare:
+            print("Replay ended before the end of the recording.")
+            return 2
+
+    else:
+        parser.print_help()
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import time
+import json
+import threading
+
+
+COUNTERS = (
+    "bytes_written",
+    "bytes_read",
+    "writes",
+    "reads",
+    "blocking_reads",
+    "flushes",
+    "shifts",
+    "loops",
+    "status_reads",
+    "rows",
+    "ops_eliminated",
+    "bytes_eliminated",
+)
+
+
+class StatsSerial(object):
+    """
+    Pass-through wrapper around a pyserial object that counts bytes, write
+    and read calls and flushes into a ProgrammingStats, along with the CPU
+    time spent inside them, which is not host cost when the serial object
+    is an emulator.  That time is measured on the thread making the call,
+    as ThreadedSerial writes and reads on two threads at once.  Every other
+    attribute is forwarded to the wrapped object.
+    """
+    def __init__(self, ser, stats):
+        self.ser = ser
+        self.stats = stats
+
+    def write(self, data):
+        start = time.thread_time()
+        count = self.ser.write(data)
+        self.stats.count("io_cpu", time.thread_time() - start)
+        self.stats.count("writes")
+        self.stats.count("bytes_written", len(data))
+        return count
+
+    def read(self, size = 1):
+        start = time.thread_time()
+        data = self.ser.read(size = size)
+        self.stats.count("io_cpu", time.thread_time() - start)
+        self.stats.count("reads")
+        self.stats.count("bytes_read", len(data))
+        return data
+
+    def inWaiting(self):
+        return self.ser.inWaiting()
+
+    def flush(self):
+        start = time.thread_time()
+        self.ser.flush()
+        self.stats.count("io_cpu", time.thread_time() - start)
+        self.stats.count("flushes")
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+
+class PhaseStats(object):
+    """
+    Counters, elapsed time and host CPU time of a single programming phase.
+    Elapsed time is taken from clock.
+    """
+    def __init__(self, name, clock):
+        self.name = name
+        self.clock = clock
+        self.start = clock()
+        self.end = None
+        self.cpu_start = time.process_time()
+        self.cpu_end = None
+        self.io_cpu = 0.0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def close(self):
+        self.end = self.clock()
+        self.cpu_end = time.process_time()
+
+    @property
+    def time(self):
+        return (self.end if self.end is not None else self.clock()) - self.start
+
+    @property
+    def cpu(self):
+        """
+        Host CPU seconds, excluding the time spent inside the serial port.
+        """
+        end = self.cpu_end if self.cpu_end is not None else time.process_time()
+        return end - self.cpu_start - self.io_cpu
+
+    @property
+    def rows_per_second(self):
+        if self.counters["rows"] == 0 or self.time <= 0:
+            return None
+        return self.counters["rows"] / self.time
+
+    def to_dict(self):
+        result = {"phase": self.name, "time": self.time, "cpu": self.cpu, "rows_per_second": self.rows_per_second}
+        result.update(self.counters)
+        return result
+
+
+class ProgrammingStats(object):
+    """
+    Per-phase instrumentation of a programming run.  attach() it to a
+    JtagCustomProgrammer and pass it to program() as the phase hook:
+
+        stats = ProgrammingStats()
+        stats.attach(programmer)
+        programmer.program(image, phase = stats)
+        print(stats.format())
+
+    Traffic is counted by wrapping the transport's serial port, and the
+    programmer counts shifts, firmware loops, status reads, blocking reads
+    and flash rows through count().  The transport is flushed at every
+    phase switch, so the bytes a phase sends are counted in that phase.
+    on_update, if given, is called with this object whenever a row
+    completes, e.g. to display eta().  Elapsed times are wall time unless
+    another clock is given, such as the simulated time of an emulator.
+    """
+    def __init__(self, on_update = None, clock = time.perf_counter):
+        self.on_update = on_update
+        self.clock = clock
+        self.transport = None
+        self.phases = [PhaseStats("setup", clock)]
+        self.rows_expected = 0
+        # the threads of ThreadedSerial count concurrently
+        self.lock = threading.Lock()
+
+    @property
+    def current(self):
+        return self.phases[-1]
+
+    def attach(self, programmer):
+        """
+        Hook into a JtagCustomProgrammer, its TinyFpgaProgrammer and the
+        serial port under its transport.
+        """
+        pins = programmer.jtag.pins
+        pins.stats = self
+        pins.ser.ser = StatsSerial(pins.ser.ser, self)
+        self.transport = pins.ser
+
+    def count(self, name, amount = 1):
+        with self.lock:
+            if name == "rows_expected":
+                self.rows_expected += amount
+            elif name == "io_cpu":
+                self.current.io_cpu += amount
+            else:
+                self.current.counters[name] += amount
+
+        if name == "rows" and self.on_update is not None:
+            self.on_update(self)
+
+    def __call__(self, name):
+        """
+        Start a new phase.  Called by program() with each phase name.
+        """
+        if self.transport is not None:
+            getattr(self.transport, "wait_written", self.transport.flush)()
+
+        self.current.close()
+
+        if name is not None:
+            self.phases.append(PhaseStats(name, self.clock))
+
+    def finish(self):
+        """
+        End the last phase.  The transport is not flushed, as the port may
+        already be closed.
+        """
+        if self.current.end is None:
+            self.current.close()
+
+    def rows_done(self):
+        return sum(phase.counters["rows"] for phase in self.phases)
+
+    def eta(self):
+        """
+        Estimated seconds until every expected row has been written and
+        verified, from the rows per second measured so far, or None.
+        """
+        rows = 0
+        seconds = 0.0
+
+        for phase in self.phases:
+            if phase.counters["rows"] > 0:
+                rows += phase.counters["rows"]
+                seconds += phase.time
+
+        if rows == 0 or self.rows_expected == 0:
+            return None
+
+        return max(self.rows_expected - rows, 0) * seconds / rows
+
+    def report(self):
+        """
+        Return the measurements as a dict of plain values, ready for JSON.
+        """
+        total = dict.fromkeys(COUNTERS, 0)
+        total["time"] = 0.0
+        total["cpu"] = 0.0
+
+        for phase in self.phases:
+            total["time"] += phase.time
+            total["cpu"] += phase.cpu
+            for name in COUNTERS:
+                total[name] += phase.counters[name]
+
+        return {
+            "phases": [phase.to_dict() for phase in self.phases],
+            "total": total,
+        }
+
+    def to_json(self):
+        return json.dumps(self.report())
+
+    def format(self):
+        """
+        Return the measurements as a text table, one row per phase.
+        """
+        return format_report(self.report())
+
+
+def format_report(report):
+    """
+    Format a ProgrammingStats.report() as a text table, one row per phase.
+    """
+    header = "{:<13} {:>6} {:>8} {:>9} {:>7} {:>7} {:>6} {:>6} {:>7} {:>6} {:>8} {:>8}"
+    lines = [header.format(
+        "phase", "rows", "rows/s", "sent B", "recv B", "writes", "reads",
+        "block", "flushes", "loops", "host ms", "time s")]
+
+    for phase in report["phases"] + [dict(report["total"], phase = "total", rows_per_second = None)]:
+        rate = phase["rows_per_second"]
+        lines.append(header.format(
+            phase["phase"], phase["rows"], "-" if rate is None else "%.0f" % rate,
+            phase["bytes_written"], phase["bytes_read"], phase["writes"], phase["reads"],
+            phase["blocking_reads"], phase["flushes"], phase["loops"], "%.1f" % (phase["cpu"] * 1000), "%.3f" % phase["time"]))
+
+    total = report["total"]
+    if total["ops_eliminated"] or total["bytes_eliminated"]:
+        lines.append("optimizer eliminated {} operations and {} command bytes".format(
+            total["ops_eliminated"], total["bytes_eliminated"]))
+
+    return "\n".join(lines)
@@ -0,0 +1,487 @@
+import re
+from .tinyfpgaa import BufferedSerial
+
+
+class SvfError(Exception):
+    """
+    An SVF statement that could not be parsed or executed.  line is the
+    line number the statement starts on.
+    """
+    def __init__(self, line, message):
+        Exception.__init__(self, "line %d: %s" % (line, message))
+        self.line = line
+
+
+class SvfMismatch(SvfError):
+    """
+    A TDO check failed.  expected, actual and mask are ints over the whole
+    scan including header and trailer bits; actual is None if the check ran
+    in a firmware loop, which only reports whether it ever matched.
+    """
+    def __init__(self, line, statement, expected, actual, mask):
+        if actual is None:
+            message = "%s never matched 0x%x (mask 0x%x)" % (statement, expected, mask)
+        else:
+            message = "%s read 0x%x, expected 0x%x (mask 0x%x)" % (statement, actual, expected, mask)
+
+        SvfError.__init__(self, line, message)
+        self.statement = statement
+        self.expected = expected
+        self.actual = actual
+        self.mask = mask
+
+
+# Hex data in parentheses, which may span lines, or a single word.
+_TOKEN_RE = re.compile(r"\(([^)]*)\)|([^\s()]+)")
+
+
+def _strip_comment(line):
+    for marker in ("!", "//"):
+        index = line.find(marker)
+        if index >= 0:
+            line = line[:index]
+    return line
+
+
+def _tokenize(text):
+    tokens = []
+
+    for match in _TOKEN_RE.finditer(text):
+        if match.group(1) is not None:
+            # keep data apart from keywords with a leading parenthesis
+            tokens.append("(" + "".join(match.group(1).split()))
+        else:
+            tokens.append(match.group(2).upper())
+
+    return tokens
+
+
+def svf_statements(svf_file):
+    """
+    Yield (line number, tokens) for every statement of an SVF file.  The
+    file is read line by line, so only the statement being parsed is held
+    in memory.  Keywords are upper-cased, and hex data is returned as a
+    single token starting with "(" with all whitespace removed.
+    """
+    parts = []
+    start_line = None
+
+    for line_number, line in enumerate(svf_file, 1):
+        line = _strip_comment(line)
+
+        while True:
+            end = line.find(";")
+
+            if end < 0:
+                break
+
+            parts.append(line[:end])
+            tokens = _tokenize(" ".join(parts))
+
+            if tokens:
+                yield (start_line or line_number), tokens
+
+            parts = []
+            start_line = None
+            line = line[end + 1:]
+
+        if line.strip():
+            if start_line is None:
+                start_line = line_number
+            parts.append(line)
+
+    if parts and _tokenize(" ".join(parts)):
+        raise SvfError(start_line, "statement not terminated by ';'")
+
+
+class _Pattern(object):
+    """
+    Current TDI, MASK and SMASK of one of the SIR, SDR, HIR, HDR, TIR and
+    TDR statements.  They are sticky: a statement that leaves one out
+    reuses the previous value unless the length changed.  TDO is only
+    sticky for headers and trailers.
+    """
+    def __init__(self, sticky_tdo = False):
+        self.length = 0
+        self.tdi = 0
+        self.tdo = None
+        self.mask = 0
+        self.sticky_tdo = sticky_tdo
+
+    def update(self, line, tokens):
+        try:
+            length = int(tokens[1])
+        except (IndexError, ValueError):
+            raise SvfError(line, "%s needs a length" % tokens[0])
+
+        if length != self.length:
+            self.length = length
+            self.tdi = 0
+            self.tdo = None
+            self.mask = (1 << length) - 1
+
+        if not self.sticky_tdo:
+            self.tdo = None
+
+        fields = tokens[2:]
+
+        if len(fields) % 2 != 0:
+            raise SvfError(line, "%s has a field without a value" % tokens[0])
+
+        for name, value in zip(fields[0::2], fields[1::2]):
+            if not value.startswith("("):
+                raise SvfError(line, "%s %s needs a value in parentheses" % (tokens[0], name))
+
+            try:
+                value = int(value[1:] or "0", 16) & ((1 << length) - 1)
+            except ValueError:
+                raise SvfError(line, "%s %s is not hex data" % (tokens[0], name))
+
+            if name == "TDI":
+                self.tdi = value
+            elif name == "TDO":
+                self.tdo = value
+            elif name == "MASK":
+                self.mask = value
+            elif name == "SMASK":
+                # all TDI bits are driven anyway
+                pass
+            else:
+                raise SvfError(line, "unknown %s field %s" % (tokens[0], name))
+
+
+class SvfPlayer(object):
+    """
+    Streams an SVF file to a Jtag.  Statements are executed as they are
+    read, so the file is never held in memory as a whole.  HIR, HDR, TIR
+    and TDR are applied to every scan.
+
+    TDO checks outside loops are read back without waiting for them; a
+    mismatch is raised as SvfMismatch with the statement's line number as
+    soon as its data arrives.  LOOP bodies with a single TDO check that
+    fit in one USB packet run as firmware loops, so polling a busy bit
+    costs one status byte per loop instead of a round trip per iteration.
+    Other loops are iterated on the host, unless host_loops_allowed is
+    cleared.
+
+    RUNTEST times are converted to TCK cycles at tck_frequency.
+    """
+    def __init__(self, jtag, tck_frequency = 100000):
+        self.jtag = jtag
+        self.pins = jtag.pins
+        self.tck_frequency = tck_frequency
+
+        self.sir = _Pattern()
+        self.sdr = _Pattern()
+        self.hir = _Pattern(sticky_tdo = True)
+        self.hdr = _Pattern(sticky_tdo = True)
+        self.tir = _Pattern(sticky_tdo = True)
+        self.tdr = _Pattern(sticky_tdo = True)
+
+        self.endir = "IDLE"
+        self.enddr = "IDLE"
+        self.run_state = "IDLE"
+        self.run_end_state = "IDLE"
+
+        self.errors = []
+        self.line = 0
+        self.firmware_loops = 0
+        self.host_loops = 0
+        self.host_loops_allowed = True
+
+        # None outside loops, otherwise "firmware" or "host"
+        self.loop_mode = None
+        self.loop_matches = None
+
+    def play(self, svf_file):
+        """
+        Execute every statement of svf_file, a text file object.  Raises
+        SvfError or SvfMismatch on the first problem.
+        """
+        self.pins.clear_status()
+
+        statements = svf_statements(svf_file)
+
+        for line, tokens in statements:
+            if tokens[0] == "LOOP":
+                self._loop(line, tokens, self._loop_body(line, statements))
+            else:
+                self._execute(line, tokens)
+
+            self._check()
+
+        # wait for every outstanding check
+        self.pins.get_status(self._loop_status(self.line, None, None, None), blocking = True)
+        self._check()
+
+    def _check(self):
+        self.pins.ser.task()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def _loop_body(self, line, statements):
+        body = []
+
+        for body_line, tokens in statements:
+            if tokens[0] == "ENDLOOP":
+                return body
+            if tokens[0] == "LOOP":
+                raise SvfError(body_line, "LOOP cannot be nested")
+            body.append((body_line, tokens))
+
+        raise SvfError(line, "LOOP without ENDLOOP")
+
+    def _execute(self, line, tokens):
+        self.line = line
+        name = tokens[0]
+
+        if name in ("SIR", "SDR"):
+            self._scan(line, tokens)
+
+        elif name in ("HIR", "HDR", "TIR", "TDR"):
+            getattr(self, name.lower()).update(line, tokens)
+
+        elif name in ("ENDIR", "ENDDR"):
+            if len(tokens) != 2:
+                raise SvfError(line, "%s needs a state" % name)
+            setattr(self, name.lower(), self._state(line, tokens[1]))
+
+        elif name == "STATE":
+            for state in tokens[1:]:
+                self.jtag.goto_state(self._state(line, state))
+
+        elif name == "RUNTEST":
+            self._runtest(line, tokens)
+
+        elif name in ("FREQUENCY", "TRST"):
+            # the programmer has a fixed TCK rate and no TRST pin
+            pass
+
+        elif name == "ENDLOOP":
+            raise SvfError(line, "ENDLOOP without LOOP")
+
+        else:
+            raise SvfError(line, "unsupported statement %s" % name)
+
+    def _state(self, line, state):
+        if state not in self.jtag.sm.states:
+            raise SvfError(line, "unknown state %s" % state)
+        return state
+
+    def _runtest(self, line, tokens):
+        args = tokens[1:]
+
+        if args and args[0] in self.jtag.sm.states:
+            self.run_state = args.pop(0)
+            self.run_end_state = self.run_state
+
+        if len(args) >= 2 and args[-2] == "ENDSTATE":
+            self.run_end_state = self._state(line, args[-1])
+            args = args[:-2]
+
+        clocks = 0
+        seconds = 0.0
+
+        try:
+            if len(args) >= 2 and args[1] in ("TCK", "SCK"):
+                if args[1] == "TCK":
+                    clocks = int(float(args[0]))
+                args = args[2:]
+
+            if len(args) >= 2 and args[1] == "SEC":
+                seconds = float(args[0])
+                # MAXIMUM is an upper bound we always stay under
+                args = args[2:]
+                if len(args) >= 3 and args[0] == "MAXIMUM":
+                    args = args[3:]
+        except ValueError:
+            raise SvfError(line, "bad RUNTEST time")
+
+        if args:
+            raise SvfError(line, "unexpected RUNTEST arguments %s" % " ".join(args))
+
+        clocks = max(clocks, int(seconds * self.tck_frequency + 0.999999))
+
+        self.jtag.goto_state(self.run_state)
+        if clocks > 0:
+            self.pins.run_tck(clocks)
+        self.jtag.goto_state(self.run_end_state)
+
+    def _scan(self, line, tokens):
+        if tokens[0] == "SIR":
+            pattern, header, trailer = self.sir, self.hir, self.tir
+            shift_state, end_state = "IRSHIFT", self.endir
+        else:
+            pattern, header, trailer = self.sdr, self.hdr, self.tdr
+            shift_state, end_state = "DRSHIFT", self.enddr
+
+        pattern.update(line, tokens)
+
+        ### assemble header, data and trailer; the header is shifted first
+        num_bits = 0
+        tdi = 0
+        tdo = 0
+        mask = 0
+
+        for part in (header, pattern, trailer):
+            tdi |= part.tdi << num_bits
+            if part.tdo is not None:
+                tdo |= part.tdo << num_bits
+                mask |= part.mask << num_bits
+            num_bits += part.length
+
+        if num_bits == 0:
+            return
+
+        self.jtag.goto_state(shift_state)
+
+        if mask == 0:
+            self.jtag.shift(num_bits, tdi)
+        elif self.loop_mode == "firmware":
+            self.jtag.shift(num_bits, tdi, tdo, mask, poll = True)
+        else:
+            self.jtag.shift(num_bits, tdi, tdo, mask, read_callback = self._compare(line, tokens[0], tdo, mask))
+
+        self.jtag.goto_state(end_state)
+
+    def _compare(self, line, statement, tdo, mask):
+        loop_matches = self.loop_matches
+
+        def compare_callback(actual):
+            if loop_matches is not None:
+                loop_matches.append((actual & mask) == (tdo & mask))
+
+            elif (actual & mask) != (tdo & mask):
+                self.errors.append(SvfMismatch(line, statement, tdo, actual, mask))
+
+        return compare_callback
+
+    def _loop_status(self, line, statement, tdo, mask):
+        def status_callback(status):
+            if len(status) > 0 and status[0] != 0 and not self.errors:
+                if statement is None:
+                    self.errors.append(SvfError(line, "programmer reported a failed check"))
+                else:
+                    self.errors.append(SvfMismatch(line, statement, tdo, None, mask))
+
+        return status_callback
+
+    def _loop(self, line, tokens, body):
+        try:
+            count = int(tokens[1])
+        except (IndexError, ValueError):
+            raise SvfError(line, "LOOP needs a count")
+
+        checks = [(body_line, body_tokens) for body_line, body_tokens in body
+            if body_tokens[0] in ("SIR", "SDR") and "TDO" in body_tokens[2::2]]
+
+        if count <= 0:
+            return
+
+        if not checks:
+            # an iteration without checks always passes
+            for body_line, body_tokens in body:
+                self._execute(body_line, body_tokens)
+            return
+
+        if len(checks) == 1 and self._firmware_loop(count, body):
+            self.firmware_loops += 1
+            check_line, check_tokens = checks[0]
+            pattern = self.sir if check_tokens[0] == "SIR" else self.sdr
+            # a failed firmware loop sends an extra status byte, which this
+            # read consumes; that is fine since playing stops there
+            self.pins.get_status(self._loop_status(check_line, check_tokens[0], pattern.tdo, pattern.mask), blocking = False)
+            return
+
+        if not self.host_loops_allowed:
+            raise SvfError(line, "LOOP cannot run in the programmer firmware")
+
+        self.host_loops += 1
+
+        for i in range(count):
+            self.loop_mode = "host"
+            self.loop_matches = []
+
+            try:
+                for body_line, body_tokens in body:
+                    self._execute(body_line, body_tokens)
+            finally:
+                matches = self.loop_matches
+                self.loop_mode = None
+                self.loop_matches = None
+
+            # wait for this iteration's checks
+            self.pins.get_status(self._loop_status(line, None, None, None), blocking = True)
+            self._check()
+
+            if all(matches):
+                return
+
+        raise SvfError(line, "LOOP %d never passed its checks" % count)
+
+    def _firmware_loop(self, count, body):
+        """
+        Try to send body as a firmware loop.  Returns False, having sent
+        nothing, if it does not fit in a single USB packet.
+        """
+        jtag = self.jtag
+        pins = self.pins
+
+        if count > 0xffff:
+            return False
+
+        ### start every iteration in the state the body leaves the TAP in,
+        ### found with a dry run
+        start_state = jtag.current_state
+        saved = [(p, p.length, p.tdi, p.tdo, p.mask) for p in (self.sir, self.sdr)]
+        saved_states = (self.endir, self.enddr, self.run_state, self.run_end_state)
+
+        def restore():
+            for p, length, tdi, tdo, mask in saved:
+                p.length, p.tdi, p.tdo, p.mask = length, tdi, tdo, mask
+            self.endir, self.enddr, self.run_state, self.run_end_state = saved_states
+
+        pins.loop(count)
+        self.loop_mode = "firmware"
+        fits = False
+
+        try:
+            for body_line, body_tokens in body:
+                self._execute(body_line, body_tokens)
+            loop_state = jtag.current_state
+
+            restore()
+            pins.loop_body = []
+            pins.loop_byte_count = 0
+            jtag.current_state = loop_state
+
+            for body_line, body_tokens in body:
+                self._execute(body_line, body_tokens)
+
+            fits = (jtag.current_state == loop_state and
+                pins.loop_byte_count + 4 <= BufferedSerial.PACKET_SIZE)
+
+        finally:
+            self.loop_mode = None
+
+            if not fits:
+                restore()
+                pins.in_loop_body = False
+                pins.loop_body = []
+                pins.loop_byte_count = 0
+                jtag.current_state = start_state
+
+        if not fits:
+            return False
+
+        ### move into the loop state outside the loop, then send the loop
+        body_bytes = pins.loop_body
+        pins.in_loop_body = False
+        jtag.current_state = start_state
+        jtag.goto_state(loop_state)
+        pins.in_loop_body = True
+        pins.loop_body = body_bytes
+        pins.end_loop(None)
+
+        return True
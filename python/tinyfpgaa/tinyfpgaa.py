@@ -1,10 +1,17 @@
 import serial
 import array
+import mmap
+import io
 import time
 import re
 import math
 import itertools
 import traceback
+import hashlib
+import asyncio
+import queue
+import threading
+import contextlib
 
 class SyncSerial(object):
     def __init__(self, ser, write_buffer_size = 64, write_flush_timeout = 0.001):
@@ -29,7 +36,7 @@ class SyncSerial(object):
             self.ser.flush()
 
 
-    def read(self, num_bytes, callback, blocking = False):
+    def read(self, num_bytes, callback, blocking = False, expected = None):
         self.flush()
         read_data = [x for x in array.array('B', self.ser.read(size = num_bytes)).tolist()]
         callback(read_data)
@@ -45,6 +52,17 @@ class SyncSerial(object):
 
         self.ser.flush()
 
+    def fit_packet(self, num_bytes):
+        self.flush()
+
+    def discard_input(self):
+        """
+        Read and return the data waiting on the port that no read asked
+        for.  Meant for the start of a session, with no reads outstanding.
+        """
+        waiting = self.ser.inWaiting()
+        return self.ser.read(size = waiting) if waiting > 0 else b""
+
 
 
 class AsyncSerial(object):
@@ -88,7 +106,7 @@ class AsyncSerial(object):
             self.task()
 
 
-    def read(self, num_bytes, callback, blocking = False):
+    def read(self, num_bytes, callback, blocking = False, expected = None):
         """
         Issue an asynchronous read.  This read callback is inserted into the
         read queue in the order it was issued.  Once all previous read requests
@@ -97,6 +115,12 @@ class AsyncSerial(object):
         """
         if blocking:
             self.flush()
+
+            # earlier reads are answered first
+            while len(self.pending_reads) > 0:
+                pending_num_bytes, pending_callback = self.pending_reads.pop(0)
+                pending_callback([x for x in array.array('B', self.ser.read(size = pending_num_bytes)).tolist()])
+
             read_data = [x for x in array.array('B', self.ser.read(size = num_bytes)).tolist()]
             callback(read_data)
 
@@ -167,6 +191,518 @@ class AsyncSerial(object):
         #    self.pending_write_data = []
         #    self.ser.flush()
 
+    def fit_packet(self, num_bytes):
+        self.flush()
+
+    def discard_input(self):
+        """
+        Read and return the data waiting on the port that no read asked
+        for.  Meant for the start of a session, with no reads outstanding.
+        """
+        waiting = self.ser.inWaiting()
+        return self.ser.read(size = waiting) if waiting > 0 else b""
+
+
+
+class BufferedSerial(object):
+    """
+    Buffered wrapper class for serial objects.  Writes accept ints, lists of
+    ints or any bytes-like object and are copied into a preallocated buffer
+    that is handed to the serial port in large multi-packet writes.  The tty
+    is only drained by an explicit sync().  Reads behave like AsyncSerial:
+    non-blocking reads are queued and serviced in FIFO order by task(), and a
+    blocking read services every queued read before its own.
+
+    The buffer is kept aligned to USB packets: offset 0 of the buffer is
+    always the start of a packet, so fit_packet() can keep a firmware loop
+    within one packet by padding instead of issuing a write.  It only pads
+    when the loop would otherwise straddle two packets.  A pad byte costs
+    as much wire and firmware time as a command byte, while a write per
+    loop would cost a USB transfer each, so the fewest bytes and the fewest
+    writes both come from leaving loops where they fall.  This needs a
+    firmware that restarts a loop at its own body rather than at the start
+    of the packet.
+    """
+    PACKET_SIZE = 64
+
+    # Set Outputs with only TCK high.  Every command leaves TCK high, so this
+    # produces no clock edge and does nothing to the JTAG target.
+    PAD_BYTE = 0x50
+
+    def __init__(self, ser, buffer_size = 4096):
+        assert buffer_size >= self.PACKET_SIZE and buffer_size % self.PACKET_SIZE == 0
+
+        self.ser = ser
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.pending_reads = []
+
+        ser.flushInput()
+        ser.flushOutput()
+
+
+    def _write_packets(self):
+        """
+        Write every complete packet in the buffer and move the partial packet
+        that remains to the front.
+        """
+        count = self.length - (self.length % self.PACKET_SIZE)
+
+        if count > 0:
+            self._transmit(self.view[0:count])
+            remaining = self.length - count
+            self.buffer[0:remaining] = self.view[count:self.length]
+            self.length = remaining
+
+
+    def write(self, data):
+        if isinstance(data, int):
+            if self.length == self.buffer_size:
+                self._write_packets()
+            self.buffer[self.length] = data
+            self.length += 1
+            return
+
+        if isinstance(data, list):
+            data = bytes(data)
+
+        data = memoryview(data).cast('B')
+        num_bytes = len(data)
+        offset = 0
+
+        while offset < num_bytes:
+            if self.length == self.buffer_size:
+                self._write_packets()
+
+            count = min(self.buffer_size - self.length, num_bytes - offset)
+            self.buffer[self.length:self.length + count] = data[offset:offset + count]
+            self.length += count
+            offset += count
+
+
+    def fit_packet(self, num_bytes):
+        """
+        Make sure the next num_bytes written are sent in a single USB packet.
+        """
+        partial = self.length % self.PACKET_SIZE
+
+        if partial + num_bytes > self.PACKET_SIZE:
+            pad = self.PACKET_SIZE - partial
+            self.buffer[self.length:self.length + pad] = bytes([self.PAD_BYTE]) * pad
+            self.length += pad
+
+
+    def _transmit(self, data):
+        self.ser.write(data)
+
+
+    def flush(self):
+        """
+        Hand all buffered data to the serial port without draining the tty.
+        """
+        if self.length > 0:
+            self._transmit(self.view[0:self.length])
+            self.length = 0
+
+
+    def wait_written(self):
+        """
+        Hand all buffered data to the serial port and return once the port
+        has it, which for this transport is right away.
+        """
+        self.flush()
+
+
+    def sync(self):
+        """
+        Write all buffered data and wait until the tty has transmitted it.
+        """
+        self.wait_written()
+        self.ser.flush()
+
+
+    def discard_input(self):
+        """
+        Read and return the data waiting on the port that no read asked
+        for.  Meant for the start of a session, with no reads outstanding.
+        """
+        waiting = self.ser.inWaiting()
+        return self.ser.read(size = waiting) if waiting > 0 else b""
+
+
+    def _read_pending(self, num_bytes, callback):
+        callback(list(self.ser.read(size = num_bytes)))
+
+
+    def read(self, num_bytes, callback, blocking = False, expected = None):
+        """
+        Issue a read.  Non-blocking reads are queued until task() finds their
+        data waiting.  Blocking reads write out buffered data and wait for
+        the data of all earlier reads and then their own.
+        """
+        if not blocking:
+            self.pending_reads.append((num_bytes, callback))
+            return
+
+        self.flush()
+
+        while len(self.pending_reads) > 0:
+            self._read_pending(*self.pending_reads.pop(0))
+
+        self._read_pending(num_bytes, callback)
+
+
+    def task(self):
+        """
+        Call periodically in the thread you want read callbacks to execute in.
+        """
+        while len(self.pending_reads) > 0:
+            num_bytes = self.pending_reads[0][0]
+
+            if self.ser.inWaiting() < num_bytes:
+                break
+
+            self._read_pending(*self.pending_reads.pop(0))
+
+        return len(self.pending_reads) + self.length
+
+
+
+class ThreadedSerial(BufferedSerial):
+    """
+    BufferedSerial that overlaps command encoding with USB transfers.  Full
+    packets are handed to a writer thread through a bounded queue, and a
+    reader thread collects the data of queued reads in FIFO order as it
+    arrives.  Read callbacks run in order on the caller's thread, from
+    task() and blocking reads, so they need no locking.  The caller only
+    waits when the write queue is full or on a blocking read, which returns
+    once its own and every earlier read have completed.  Call close() when
+    done to stop the threads.
+    """
+    def __init__(self, ser, buffer_size = 4096, queue_size = 16):
+        BufferedSerial.__init__(self, ser, buffer_size)
+
+        self.write_queue = queue.Queue(queue_size)
+        self.cond = threading.Condition(threading.RLock())
+        self.bytes_queued = 0
+        self.bytes_written = 0
+        self.reads_queued = 0
+        self.reads_completed = 0
+        # (callback, data) of reads whose callbacks have not run yet
+        self.completed = []
+        self.error = None
+        self.closed = False
+
+        self.writer = threading.Thread(target = self._write_task, daemon = True)
+        self.reader = threading.Thread(target = self._read_task, daemon = True)
+        self.writer.start()
+        self.reader.start()
+
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+
+    def _transmit(self, data):
+        self._check()
+        data = bytes(data)
+        self.bytes_queued += len(data)
+        self.write_queue.put(data)
+
+
+    def _write_task(self):
+        while True:
+            data = self.write_queue.get()
+
+            if data is None:
+                break
+
+            try:
+                if self.error is None:
+                    self.ser.write(data)
+            except Exception as e:
+                self.error = e
+
+            with self.cond:
+                self.bytes_written += len(data)
+                self.cond.notify_all()
+
+
+    def _read_task(self):
+        while True:
+            with self.cond:
+                # a read's data cannot arrive before the commands queued
+                # ahead of it have been written
+                while not self.closed and (len(self.pending_reads) == 0 or self.pending_reads[0][2] > self.bytes_written):
+                    self.cond.wait()
+
+                if self.closed:
+                    break
+
+                num_bytes, callback, ticket = self.pending_reads[0]
+
+            try:
+                data = list(self.ser.read(size = num_bytes))
+            except Exception as e:
+                data = []
+                self.error = e
+
+            with self.cond:
+                self.pending_reads.pop(0)
+                self.completed.append((callback, data))
+                self.reads_completed += 1
+                self.cond.notify_all()
+
+
+    def _run_callbacks(self):
+        # one at a time, so a callback that makes a blocking read still
+        # sees the earlier callbacks run first
+        while True:
+            with self.cond:
+                if len(self.completed) == 0:
+                    return
+                callback, data = self.completed.pop(0)
+
+            if callback is not None:
+                callback(data)
+
+
+    def read(self, num_bytes, callback, blocking = False, expected = None):
+        """
+        Queue a read for the reader thread.  Blocking reads write out
+        buffered data, wait until this read has completed and run the
+        callbacks of all completed reads.
+        """
+        self._check()
+
+        if blocking:
+            self.flush()
+
+        with self.cond:
+            # the read's data follows everything written so far, buffered
+            # or queued
+            self.pending_reads.append((num_bytes, callback, self.bytes_queued + self.length))
+            self.reads_queued += 1
+            ticket = self.reads_queued
+            self.cond.notify_all()
+
+            if blocking:
+                while self.reads_completed < ticket and self.error is None:
+                    self.cond.wait()
+
+        self._check()
+
+        if blocking:
+            self._run_callbacks()
+
+
+    def task(self):
+        """
+        Run the callbacks of the reads the reader thread has completed, and
+        return the number of outstanding reads plus buffered bytes.
+        """
+        self._check()
+        self._run_callbacks()
+        return len(self.pending_reads) + self.length
+
+
+    def wait_written(self):
+        """
+        Hand all buffered data to the writer thread and wait until it has
+        written it to the serial port.
+        """
+        self.flush()
+
+        with self.cond:
+            while self.bytes_written < self.bytes_queued and self.error is None:
+                self.cond.wait()
+
+        self._check()
+
+
+    def discard_input(self):
+        """
+        Wait for outstanding reads, then read and return the data waiting on
+        the port that no read asked for.
+        """
+        self.flush()
+
+        with self.cond:
+            # the reader thread only touches the port for queued reads
+            while self.reads_completed < self.reads_queued and self.error is None:
+                self.cond.wait()
+
+            self._check()
+            data = BufferedSerial.discard_input(self)
+
+        self._run_callbacks()
+        return data
+
+
+    def close(self):
+        """
+        Write out buffered data, wait for outstanding reads and stop the
+        writer and reader threads.
+        """
+        if self.closed:
+            return
+
+        self.flush()
+
+        with self.cond:
+            while self.reads_completed < self.reads_queued and self.error is None:
+                self.cond.wait()
+
+        self._run_callbacks()
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        self.write_queue.put(None)
+        self.writer.join()
+        self.reader.join()
+        self._check()
+
+
+
+class AsyncioRead(object):
+    """
+    Awaitable result of an AsyncioSerial read.  Awaiting it writes out
+    buffered commands and services the read queue until this read's data
+    has arrived, then returns the data.
+    """
+    def __init__(self, serial, future):
+        self.serial = serial
+        self.future = future
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        return self.future.result()
+
+    def __await__(self):
+        yield from self.serial.wait_until(self.future.done).__await__()
+        return self.future.result()
+
+
+
+class AsyncioSerial(BufferedSerial):
+    """
+    BufferedSerial for use from an asyncio event loop.  Every read returns
+    an AsyncioRead that resolves to the read data, after the callback, if
+    any, has been called with it.  Reads never block the event loop, not even
+    blocking ones; await a read, or drain() for all queued reads.  Read data
+    is picked up by a reader on the port's file descriptor where the event
+    loop supports it and by polling every poll_interval seconds otherwise.
+    Unless a loop is given, the running loop at the first read is used.
+    """
+    def __init__(self, ser, buffer_size = 4096, loop = None, poll_interval = 0.001):
+        BufferedSerial.__init__(self, ser, buffer_size)
+
+        self._loop = loop
+        self.poll_interval = poll_interval
+
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+
+        return self._loop
+
+
+    def _read_pending(self, num_bytes, callback, future):
+        data = list(self.ser.read(size = num_bytes))
+
+        if callback is not None:
+            callback(data)
+
+        if not future.done():
+            future.set_result(data)
+
+
+    def read(self, num_bytes, callback = None, blocking = False, expected = None):
+        """
+        Queue a read and return an AsyncioRead for its data.
+        """
+        future = self.loop.create_future()
+        self.pending_reads.append((num_bytes, callback, future))
+        return AsyncioRead(self, future)
+
+
+    async def _readable(self):
+        """
+        Wait until the port may have more data to read.
+        """
+        # the descriptor stays readable while too few bytes for the oldest
+        # read are waiting, so poll until the rest has arrived
+        if self.ser.inWaiting() > 0:
+            await asyncio.sleep(self.poll_interval)
+            return
+
+        try:
+            fd = self.ser.fileno()
+            readable = self.loop.create_future()
+            self.loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            await asyncio.sleep(self.poll_interval)
+            return
+
+        try:
+            await readable
+        finally:
+            self.loop.remove_reader(fd)
+
+
+    async def wait_until(self, done):
+        """
+        Write out buffered data and service queued reads until done()
+        returns True.  Once the port's read timeout expires without progress,
+        the oldest read is completed with whatever data is waiting, just like
+        a pyserial read that times out.
+        """
+        self.flush()
+
+        timeout = getattr(self.ser, "timeout", None)
+        deadline = None
+
+        while not done() and len(self.pending_reads) > 0:
+            count = len(self.pending_reads)
+            self.task()
+
+            if len(self.pending_reads) < count:
+                deadline = None
+                continue
+
+            if timeout is not None:
+                if deadline is None:
+                    deadline = self.loop.time() + timeout
+                elif self.loop.time() >= deadline:
+                    num_bytes, callback, future = self.pending_reads.pop(0)
+                    self._read_pending(min(num_bytes, self.ser.inWaiting()), callback, future)
+                    deadline = None
+                    continue
+
+                try:
+                    await asyncio.wait_for(self._readable(), max(deadline - self.loop.time(), 0))
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self._readable()
+
+
+    async def drain(self):
+        """
+        Write out buffered data and wait until every queued read has been
+        serviced.
+        """
+        await self.wait_until(lambda: len(self.pending_reads) == 0)
+
 
 
 class Pin(object):
@@ -191,6 +727,9 @@ class Pin(object):
         self.sie_does_output = {}
 
 
+# Most bits a single SHIFT command can carry: up to 8 bits plus 255 bytes.
+MAX_SHIFT_BITS = 8 + 255 * 8
+
 
 class TinyFpgaProgrammer(object):
     """
@@ -212,6 +751,16 @@ class TinyFpgaProgrammer(object):
         self.sie_gets_input = {}
         self.sie_sends_output = {}
         self.sie_has_mask = {}
+        # SIE used for all but the last command of a long scan
+        self.sie_continue = {}
+
+        # optional ProgrammingStats, see stats.py
+        self.stats = None
+
+
+    def _count(self, name, amount = 1):
+        if self.stats is not None:
+            self.stats.count(name, amount)
 
 
     def _cmd(self, cmd, data):
@@ -224,11 +773,17 @@ class TinyFpgaProgrammer(object):
             self.ser.write(byte)
 
 
-    def send(self, num_read_bytes = None, read_callback = None, blocking = False):
+    def send(self, num_read_bytes = None, read_callback = None, blocking = False, expected = None):
         """
         Asynchronously sends any pending commands.  If you sent a series
         of GPIO commands expecting read data you must also send a read_callback
-        that will process the read data when it arrives.
+        that will process the read data when it arrives.  Returns whatever the
+        transport's read returns, an awaitable for AsyncioSerial.
+
+        expected, if known, is a (data, mask) pair of bytes with the value
+        the read should return.  It is passed on to the transport, where
+        WireRecorder records it and transports talking to a programmer
+        ignore it.
         """
         self.ser.task()
 
@@ -238,9 +793,12 @@ class TinyFpgaProgrammer(object):
             num_bytes_to_read = num_read_bytes
 
         if num_bytes_to_read > 0:
+            if blocking:
+                self._count("blocking_reads")
             self.ser.flush()
-            self.ser.read(num_bytes = num_bytes_to_read, callback = read_callback, blocking = blocking)
+            read = self.ser.read(num_bytes = num_bytes_to_read, callback = read_callback, blocking = blocking, expected = expected)
             self.pending_input = 0
+            return read
 
 
     def set_direction(self, pin, new_direction):
@@ -284,8 +842,11 @@ class TinyFpgaProgrammer(object):
         self.ser.write(0x20)
 
     def get_status(self, status_callback, blocking = True):
+        self._count("status_reads")
+        if blocking:
+            self._count("blocking_reads")
         self.ser.write(0x21)
-        self.ser.read(1, status_callback, blocking = blocking)
+        return self.ser.read(1, status_callback, blocking = blocking)
 
 
 
@@ -302,16 +863,6 @@ class TinyFpgaProgrammer(object):
         else:
             self.ser.write(CONFIG_IO_CMD)
 
-    def _int_to_byte_list(self, num_bytes, data):
-        byte_list = []
-
-        for i in range(0, num_bytes):
-            byte_list.append(data & 0xff)
-            data = data >> 8
-
-        return byte_list
-
-
     def _encode(self, number):
         num_bytes = int(number / 8)
         num_bits = number % 8
@@ -323,40 +874,104 @@ class TinyFpgaProgrammer(object):
         return [num_bits, num_bytes]
 
 
-    def shift(self, sie_id, num_bits, data = 0, mask = 0, read_callback = None, blocking = False):
+    def shift(self, sie_id, num_bits, data = 0, mask = 0, read_callback = None, blocking = False, expected = None):
         """
         Issue an accelerated shift operation.  For shifting serial data in
         and out of the TinyFPGA Programmer, this is the prefered method.  It
-        is much faster than GPIO bit-bang.
+        is much faster than GPIO bit-bang.  data and mask are ints; see
+        shift_bytes().
+        """
+        num_bytes = (num_bits + 7) // 8
+        data_bytes = b""
+        mask_bytes = b""
+
+        if self.sie_sends_output[sie_id]:
+            data_bytes = (data & ((1 << (num_bytes * 8)) - 1)).to_bytes(num_bytes, 'little')
+
+        if self.sie_has_mask[sie_id]:
+            mask_bytes = (mask & ((1 << (num_bytes * 8)) - 1)).to_bytes(num_bytes, 'little')
+
+        return self.shift_bytes(sie_id, num_bits, data_bytes, mask_bytes, read_callback, blocking, expected)
+
+
+    def shift_bytes(self, sie_id, num_bits, data = b"", mask = b"", read_callback = None, blocking = False, expected = None):
+        """
+        Same as shift(), but data and mask are bytes-like objects holding
+        the bits LSB first; missing trailing bytes are zero.  Scans longer
+        than a single SHIFT command can carry are split into several
+        commands.  All but the last use the continuation SIE from
+        sie_continue, which has no last phase overlay, so e.g. a JTAG scan
+        stays in its SHIFT state until the last bit.  The read data of all
+        commands is passed to read_callback at once.  expected is the
+        (data, mask) pair of bytes the scan should read, see send().
         """
         assert sie_id >= 0 and sie_id <= 7
 
-        SHIFT_CMD = 0x18 + sie_id
+        if num_bits <= 0:
+            return None
+
+        if num_bits > MAX_SHIFT_BITS and sie_id not in self.sie_continue:
+            raise ValueError("SIE %d cannot continue a scan longer than %d bits." % (sie_id, MAX_SHIFT_BITS))
+
+        num_bytes = (num_bits + 7) // 8
+
+        if self.sie_sends_output[sie_id] and len(data) < num_bytes:
+            data = bytes(data) + bytes(num_bytes - len(data))
+
+        if self.sie_has_mask[sie_id] and len(mask) < num_bytes:
+            mask = bytes(mask) + bytes(num_bytes - len(mask))
+
+        if num_bits <= MAX_SHIFT_BITS:
+            return self._shift_command(sie_id, num_bits, data, mask, read_callback, blocking, expected)
+
+        data = memoryview(data).cast('B') if data else data
+        mask = memoryview(mask).cast('B') if mask else mask
+        read_data = bytearray()
+
+        def last_callback(chunk):
+            read_data.extend(chunk)
+            if read_callback is not None:
+                read_callback(read_data)
+
+        def expected_part(start, end = None):
+            if expected is None:
+                return None
+            return (expected[0][start:end], expected[1][start:end])
+
+        offset = 0
+        continue_sie = self.sie_continue[sie_id]
+
+        while num_bits - offset * 8 > MAX_SHIFT_BITS:
+            end = offset + MAX_SHIFT_BITS // 8
+            self._shift_command(continue_sie, MAX_SHIFT_BITS, data[offset:end], mask[offset:end], read_data.extend, expected = expected_part(offset, end))
+            offset = end
+
+        return self._shift_command(sie_id, num_bits - offset * 8, data[offset:], mask[offset:], last_callback, blocking, expected_part(offset))
+
+
+    def _shift_command(self, sie_id, num_bits, data, mask, read_callback, blocking = False, expected = None):
+        self._count("shifts")
 
         do_input = self.sie_gets_input[sie_id]
         do_output = self.sie_sends_output[sie_id]
         do_mask = self.sie_has_mask[sie_id]
 
-        num_bytes = int(math.ceil(num_bits / 8.0))
-
-        shift_cmd_bytes = [SHIFT_CMD] + self._encode(num_bits)
+        num_bytes = (num_bits + 7) // 8
 
         if do_output and do_mask:
-            iters = [
-                iter(self._int_to_byte_list(num_bytes, data)),
-                iter(self._int_to_byte_list(num_bytes, mask))]
+            shift_cmd_bytes = bytearray(3 + 2 * num_bytes)
+            shift_cmd_bytes[3::2] = data
+            shift_cmd_bytes[4::2] = mask
 
-            payload_bytes = list()
-            for it in itertools.cycle(iters):
-                try:
-                    payload_bytes.append(next(it))
-                except StopIteration:
-                    break
+        elif do_output:
+            shift_cmd_bytes = bytearray(3 + num_bytes)
+            shift_cmd_bytes[3:] = data
 
-            shift_cmd_bytes += payload_bytes
+        else:
+            shift_cmd_bytes = bytearray(3)
 
-        elif do_output:
-            shift_cmd_bytes += self._int_to_byte_list(num_bytes, data)
+        shift_cmd_bytes[0] = 0x18 + sie_id
+        shift_cmd_bytes[1:3] = self._encode(num_bits)
 
         if self.in_loop_body:
             self.loop_byte_count += len(shift_cmd_bytes)
@@ -366,13 +981,13 @@ class TinyFpgaProgrammer(object):
             self.ser.write(shift_cmd_bytes)
 
             if do_input:
-                self.send(num_read_bytes = num_bytes, read_callback = read_callback, blocking = blocking)
+                return self.send(num_read_bytes = num_bytes, read_callback = read_callback, blocking = blocking, expected = expected)
 
             elif do_output and do_mask:
                 if read_callback is None:
                     self.send()
                 else:
-                    self.send(num_read_bytes = 1, read_callback = read_callback, blocking = blocking)
+                    return self.send(num_read_bytes = 1, read_callback = read_callback, blocking = blocking)
 
 
     def configure_sie(self,
@@ -398,6 +1013,9 @@ class TinyFpgaProgrammer(object):
         self.sie_sends_output[sie_id] = sends_output or has_input_mask
         self.sie_has_mask[sie_id] = has_input_mask
 
+        if last_phase_overlay == 0:
+            self.sie_continue[sie_id] = sie_id
+
         CONFIG_SIE_CMD = 8 + sie_id
 
         config_byte = 0
@@ -446,7 +1064,7 @@ class TinyFpgaProgrammer(object):
 
         # FW doesn't have another buffer for loops, so we need to make sure
         # the entire loop encoding fits in one packet.
-        self.ser.flush()
+        self.ser.fit_packet(3 + self.loop_byte_count + 1)
 
         LOOP_CMD = 0x10
         END_LOOP_CMD = 0x11
@@ -459,6 +1077,7 @@ class TinyFpgaProgrammer(object):
         )
 
         self.in_loop_body = False
+        self._count("loops")
 
         #self.send(num_read_bytes = 1, read_callback = status_callback)
         self.send()
@@ -549,8 +1168,54 @@ class JtagTinyFpgaProgrammer(TinyFpgaProgrammer):
             do1p1 = 0x10,
             last_phase_overlay = 0x20)
 
-
-    def run_tck(self, num_clks):
+        ### continuation engines for long scans: same as shift_tdi,
+        ### shift_tdo and shift_tdo_poll, but TMS stays low on the last bit
+        # shift_tdi, continued
+        self.configure_sie(
+            sie_id = 5,
+            sends_output = 1,
+            input_on_phase0 = 0,
+            input_on_phase1 = 0,
+            has_input_mask = 0,
+            input_mask = 0,
+            do0p0 = 0x00,
+            do0p1 = 0x10,
+            do1p0 = 0x08,
+            do1p1 = 0x18,
+            last_phase_overlay = 0x00)
+
+        # shift_tdo, continued
+        self.configure_sie(
+            sie_id = 6,
+            sends_output = 0,
+            input_on_phase0 = 0,
+            input_on_phase1 = 1,
+            has_input_mask = 0,
+            input_mask = 0x04,
+            do0p0 = 0x00,
+            do0p1 = 0x10,
+            do1p0 = 0x00,
+            do1p1 = 0x10,
+            last_phase_overlay = 0x00)
+
+        # shift_tdo_poll, continued
+        self.configure_sie(
+            sie_id = 7,
+            sends_output = 0,
+            input_on_phase0 = 0,
+            input_on_phase1 = 1,
+            has_input_mask = 1,
+            input_mask = 0x04,
+            do0p0 = 0x00,
+            do0p1 = 0x10,
+            do1p0 = 0x00,
+            do1p1 = 0x10,
+            last_phase_overlay = 0x00)
+
+        self.sie_continue.update({2: 5, 3: 6, 4: 7})
+
+
+    def run_tck(self, num_clks):
         self.shift(sie_id = 0, num_bits = num_clks)
 
 
@@ -562,8 +1227,8 @@ class JtagTinyFpgaProgrammer(TinyFpgaProgrammer):
         self.shift(sie_id = 2, num_bits = num_bits, data = data)
 
 
-    def shift_tdo(self, num_bits, read_callback, blocking = False):
-        self.shift(sie_id = 3, num_bits = num_bits, read_callback = read_callback, blocking = blocking)
+    def shift_tdo(self, num_bits, read_callback, blocking = False, expected = None):
+        return self.shift(sie_id = 3, num_bits = num_bits, read_callback = read_callback, blocking = blocking, expected = expected)
 
 
     def shift_tdo_poll(self, num_bits, data, mask, status_callback):
@@ -571,11 +1236,6 @@ class JtagTinyFpgaProgrammer(TinyFpgaProgrammer):
         # FIXME: need to enable mode to send data without mask
 
 
-def ntuples(lst, n):
-    return list(zip(*[lst[i:]+lst[:i] for i in range(n)]))
-
-
-
 class JtagStateMachine(object):
     def __init__(self):
         self.states = {
@@ -599,69 +1259,46 @@ class JtagStateMachine(object):
             "IRUPDATE": ("IDLE", "DRSELECT")
         }
 
-        self.memo = {}
-
-    def shortest_path(self, source, target):
-        """
-        This function implements Dijkstra's Algorithm almost exactly as it is
-        written on Wikipedia.
-
-        https://en.wikipedia.org/wiki/Dijkstra%27s_algorithm
-        """
-        INFINITY = 1000
-        UNDEFINED = None
-
-        q = set()
-        dist = {}
-        prev = {}
-
-        for v in self.states:
-            dist[v] = INFINITY
-            prev[v] = UNDEFINED
-            q.add(v)
+    def get_tms_sequence(self, source, target):
+        return TMS_TABLE[(source, target)][2]
 
-        dist[source] = 0
 
-        while len(q) != 0:
-            u = min(q, key = lambda x: dist[x])
-            q.remove(u)
 
-            for v in self.states[u]:
-                alt = dist[u] + 1
-                if alt < dist[v]:
-                    dist[v] = alt
-                    prev[v] = u
+def build_tms_table():
+    """
+    Shortest TMS sequence between every pair of TAP states, found by a
+    breadth first search from each state.  Maps (source, target) to
+    (num_bits, tms, tms_sequence), with the bits of the tms integer in the
+    order they are clocked out, LSB first.
+    """
+    states = JtagStateMachine().states
+    table = {}
 
-        s = []
-        u = target
-        while prev[u] is not None:
-            s.insert(0, u)
-            u = prev[u]
+    for source in states:
+        paths = {source: []}
+        frontier = [source]
 
-        s.insert(0, u)
+        while frontier:
+            next_frontier = []
 
-        return s
+            for state in frontier:
+                for tms_bit, next_state in enumerate(states[state]):
+                    if next_state not in paths:
+                        paths[next_state] = paths[state] + [tms_bit]
+                        next_frontier.append(next_state)
 
+            frontier = next_frontier
 
-    def get_tms_sequence(self, source, target):
-        memo_key = (source, target)
-        if memo_key in self.memo:
-            return self.memo[memo_key]
+        for target, tms_sequence in paths.items():
+            tms = 0
+            for i, v in enumerate(tms_sequence):
+                tms |= v << i
+            table[(source, target)] = (len(tms_sequence), tms, tms_sequence)
 
-        def get_tms(pair):
-            (src, dst) = pair
-            if self.states[src][0] == dst:
-                return 0
-            elif self.states[src][1] == dst:
-                return 1
-            else:
-                return None
+    return table
 
-        path = self.shortest_path(source, target)
-        tms_sequence = [get_tms(p) for p in ntuples(path, 2)][:-1]
-        self.memo[memo_key] = tms_sequence
 
-        return tms_sequence
+TMS_TABLE = build_tms_table()
 
 
 
@@ -734,17 +1371,31 @@ class Jtag(object):
         # self.pins.send()
 
 
+    def shift_tms(self, num_bits, tms):
+        """
+        Clock out num_bits TMS values, LSB first.  Uses the shift_tms SIE,
+        which sends the whole sequence as one command, unless bit-banging a
+        single bit is shorter.
+        """
+        if num_bits == 1:
+            self.run_tms([tms & 1])
+        elif num_bits > 1:
+            self.pins.shift_tms(num_bits, tms)
+
+
     def goto_state(self, target_state):
-        tms_sequence = []
+        num_bits = 0
+        tms = 0
 
         if self.current_state is None:
             # we don't know what state we're in, so we will force ourselves
             # into the Reset state before we start moving anywhere
             self.current_state = "RESET"
-            tms_sequence = [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1] + tms_sequence
+            num_bits = 25
+            tms = (1 << 25) - 1
 
-        tms_sequence = tms_sequence + self.sm.get_tms_sequence(self.current_state, target_state)
-        self.run_tms(tms_sequence)
+        path_bits, path_tms, path = TMS_TABLE[(self.current_state, target_state)]
+        self.shift_tms(num_bits + path_bits, tms | (path_tms << num_bits))
         self.current_state = target_state
 
 
@@ -753,86 +1404,60 @@ class Jtag(object):
     #tdi = Pin(3, direction=0)
     #tdo = Pin(2, direction=1)
 
-    def shift(self, num_bits, tdi, tdo = 0, mask = 0, status_callback = None):
-        self.pins.tms = 0
-        self.pins.update()
-
-        out_data_shift_reg = tdi
-        read_back = mask > 0
-
-        if num_bits > 0:
-            if read_back:
-                def check_read_data(read_data):
-                    #print "  check_read_data(" + str(read_data) + ")"
-
-                    read_bits = 0
-
-                    for i, v in enumerate(read_data):
-                        read_bits |= v << (i * 8)
-
-                    match = (tdo & mask) == (read_bits & mask)
-
-                    if status_callback is not None:
-                        if not match:
-                            print("")
-                            print("        read data: 0x%032x" % read_bits)
-                            print("    expected data: 0x%032x" % tdo)
-                            print("        mask data: 0x%032x" % mask)
-                        status_callback(match)
-
-                self.pins.shift_tdo(num_bits, check_read_data)
-                self.current_state = self.sm.states[self.current_state][1]
-                return
-                #pass
-
-            else:
-                self.pins.shift_tdi(num_bits, tdi)
-                self.current_state = self.sm.states[self.current_state][1]
-                return
-
-
-        for i in range(num_bits - 1):
-            self.pins.tdi = out_data_shift_reg & 1
-            self.pins.tck = 0
-            self.pins.update()
+    def shift(self, num_bits, tdi, tdo = 0, mask = 0, status_callback = None, read_callback = None, poll = False):
+        """
+        Shift num_bits of tdi into the IR or DR, starting in IRSHIFT or
+        DRSHIFT and leaving with TMS high on the last bit, so the TAP ends
+        in the matching EXIT1 state.  If mask is non-zero the bits shifted
+        out are compared with tdo under mask.  Once they arrive,
+        read_callback is called with them as an int and status_callback with
+        whether they matched.  tdo and mask also go to the transport as the
+        read's expected value, see TinyFpgaProgrammer.send().  With poll the comparison runs in the
+        programmer firmware instead, which reports a mismatch through its
+        status and sends nothing back.
+
+        Every scan goes through the SIE shift engines.  They cannot drive
+        TDI and sample TDO in the same scan, so a compare with non-zero tdi
+        first reads the register while shifting in zeros, then returns to
+        the shift state through PAUSE and EXIT2, which neither captures nor
+        updates, and shifts tdi in.
+        """
+        if num_bits <= 0:
+            return None
 
-            self.pins.tck = 1
-            self.pins.update(read_back)
+        if mask == 0:
+            self.pins.shift_tdi(num_bits, tdi)
+            self.current_state = self.sm.states[self.current_state][1]
+            return None
 
-            out_data_shift_reg = out_data_shift_reg >> 1
+        def check_read_data(read_data):
+            read_bits = int.from_bytes(bytes(read_data), 'little')
 
+            if read_callback is not None:
+                read_callback(read_bits)
 
+            if status_callback is not None:
+                status_callback((tdo & mask) == (read_bits & mask))
 
-        # last shift
-        self.pins.tdi = out_data_shift_reg & 1
-        self.pins.tck = 0
-        self.pins.tms = 1
-        self.pins.update()
+        shift_state = self.current_state
 
-        self.pins.tck = 1
-        self.pins.update(read_back)
+        if poll:
+            read = self.pins.shift_tdo_poll(num_bits, tdo, mask, None)
+        else:
+            num_bytes = (num_bits + 7) // 8
+            limit = (1 << (num_bytes * 8)) - 1
+            expected = ((tdo & limit).to_bytes(num_bytes, 'little'), (mask & limit).to_bytes(num_bytes, 'little'))
+            read = self.pins.shift_tdo(num_bits, check_read_data, expected = expected)
 
         self.current_state = self.sm.states[self.current_state][1]
 
-        if read_back:
-            def check_read_data(read_data):
-                #print "  check_read_data(" + str(read_data) + ")"
-                read_bits = 0
-                index = 0
-                for b in read_data:
-                    bit = 0
-                    if (b & 4) > 0:
-                        bit = 1
-
-                    read_bits = read_bits | (bit << index)
-                    index += 1
-
-                match = (tdo & mask) == (read_bits & mask)
-
-                if status_callback is not None:
-                    status_callback(match)
+        if tdi != 0:
+            self.goto_state(shift_state.replace("SHIFT", "PAUSE"))
+            self.goto_state(shift_state)
+            self.pins.shift_tdi(num_bits, tdi)
+            self.current_state = self.sm.states[self.current_state][1]
 
-            self.pins.send(read_callback = check_read_data)
+        return read
 
 
 
@@ -847,178 +1472,48 @@ class JtagSvfParser(object):
     def __init__(self, jtag, svf_file):
         self.jtag = jtag
         self.svf_file = svf_file
-        self.hdr = ["hdr", 0]
-        self.hir = ["hir", 0]
-        self.tdr = ["tdr", 0]
-        self.tir = ["tir", 0]
-        self.enddr = "DRPAUSE"
-        self.endir = "IRPAUSE"
-        self.loop_count = [0]
 
     def run(self):
-        def field(cmd, name):
-            num_bits = int(cmd[1])
-            for k, v in ntuples(cmd, 2):
-                if k == name:
-                    return int(v, 16)
-
-            if name == "mask" and "tdo" in cmd:
-                return (2 ** num_bits) - 1
-            else:
-                return 0
-
-        def runtest_field(cmd, name):
-            for v, k in ntuples(cmd, 2):
-                if k == name:
-                    return v
-
-            return None
-
-        raw_svf_string = self.svf_file.read()
-        no_comment_svf_string = re.sub('!.*?\r?\n', ' ', raw_svf_string)
-        no_lines_string = re.sub(r'\s+', ' ', no_comment_svf_string)
-        raw_cmd_strings = no_lines_string.lower().split(';')
-        cmds = [re.sub(r'\(|\)', '', x).strip().split(' ') for x in raw_cmd_strings]
-
-        loop_index = None
-        self.loop_count = [0]
-        cmd_index = 0
-
-        while cmd_index < len(cmds):
-            cmd = cmds[cmd_index]
-            cmd_index = cmd_index + 1
-
-            #print str(cmd)
-
-            name = cmd[0]
-
-            if name == "hdr":
-                self.hdr = cmd
-
-            if name == "hir":
-                self.hir = cmd
-
-            if name == "tdr":
-                self.tdr = cmd
-
-            if name == "tir":
-                self.tir = cmd
-
-            if name == "enddr":
-                self.enddr = cmd[1].upper()
-
-            if name == "endir":
-                self.endir = cmd[1].upper()
-
-            if name == "state":
-                self.jtag.goto_state(cmd[1].upper())
-
-            if name == "loop":
-                self.loop_count = [int(cmd[1])] * 1000
-                #print "loop (loop_count: %d)" % self.loop_count[0]
-                loop_index = cmd_index
-
-            if name == "endloop":
-                #print "endloop (loop_count: %d)" % self.loop_count[0]
-                if self.loop_count[0] is None:
-                    loop_index = None
-                else:
-                    self.loop_count[0] = self.loop_count[0] - 1
-
-                    if self.loop_count[0] > 0:
-                        cmd_index = loop_index
-                    else:
-                        self.loop_count[0] = None
-                        loop_index = None
-
-
-            if name == "runtest":
-                self.jtag.goto_state(cmd[1].upper())
-
-                sleep_time = runtest_field(cmd, "sec")
-                tck_count = runtest_field(cmd, "tck")
-
-                if tck_count is None:
-                    tck_count = 0
-                else:
-                    tck_count = int(tck_count)
-
-                if sleep_time is not None:
-                    tck_count = max(float(sleep_time) / 0.00001, tck_count)
-
-                self.jtag.run(int(tck_count), 0)
-
-            if name == "sir":
-                self.jtag.goto_state("IRSHIFT")
-
-                #tr_loc = int(self.hir[1]) + int(cmd[1])
-                #r_loc = int(self.hir[1])
-                #hr_loc = 0
-                loop_count = self.loop_count
-                def status_callback(match):
-                    if loop_count[0] is not None:
-                        if not match and loop_count[0] <= 1:
-                            print("MISMATCH!")
-                            print("cmd %d: %s" % (cmd_index, str(cmd)))
-                            print("")
-                            exit()
-
-                        if match:
-                            #print "SIR MATCH! " + str(loop_count)
-                            loop_count[0] = 0
-
-                self.jtag.shift(
-                    int(cmd[1]),
-                    #tdi =  (field(self.tir, "tdi")  << tr_loc) | (field(cmd, "tdi")  << r_loc) | (field(self.hir, "tdi")  << hr_loc),
-                    #tdo =  (field(self.tir, "tdo")  << tr_loc) | (field(cmd, "tdo")  << r_loc) | (field(self.hir, "tdo")  << hr_loc),
-                    #mask = (field(self.tir, "mask") << tr_loc) | (field(cmd, "mask") << r_loc) | (field(self.hir, "mask") << hr_loc)
-                    tdi  = field(cmd, "tdi"),
-                    tdo  = field(cmd, "tdo"),
-                    mask = field(cmd, "mask"),
-                    status_callback = status_callback
-                )
-
-                self.jtag.goto_state(self.endir)
+        """
+        Play the SVF file with an SvfPlayer.  Raises SvfMismatch if a TDO
+        check fails.
+        """
+        from .svf import SvfPlayer
 
-            if name == "sdr":
-                self.jtag.goto_state("DRSHIFT")
+        SvfPlayer(self.jtag).play(self.svf_file)
 
-                shift_count = int(cmd[1])
 
-                tr_loc = int(self.hdr[1]) + shift_count
-                r_loc = int(self.hdr[1])
-                hr_loc = 0
 
-                loop_count = self.loop_count
-                def status_callback(match):
-                    if loop_count[0] is not None:
-                        if not match and loop_count[0] <= 1:
-                            print("MISMATCH!")
-                            print("cmd %d: %s" % (cmd_index, str(cmd)))
-                            print("")
-                            exit()
+# A JEDEC field is everything up to the next '*'.
+JEDEC_FIELD_RE = re.compile(rb"([^*]*)\*")
 
-                        if match:
-                            #print "SDR MATCH! " + str(loop_count)
-                            loop_count[0] = None
 
-                self.jtag.shift(
-                    int(cmd[1]),
-                    #tdi =  (field(self.tdr, "tdi")  << tr_loc) | (field(cmd, "tdi")  << r_loc) | (field(self.hdr, "tdi")  << hr_loc),
-                    #tdo =  (field(self.tdr, "tdo")  << tr_loc) | (field(cmd, "tdo")  << r_loc) | (field(self.hdr, "tdo")  << hr_loc),
-                    #mask = (field(self.tdr, "mask") << tr_loc) | (field(cmd, "mask") << r_loc) | (field(self.hdr, "mask") << hr_loc)
-                    tdi  = field(cmd, "tdi"),
-                    tdo  = field(cmd, "tdo"),
-                    mask = field(cmd, "mask"),
-                    status_callback = status_callback
-                )
+def fuse_rows_to_ints(rows):
+    """
+    Convert a list of JEDEC fuse strings (bytes of '0' and '1', first fuse
+    first) into integers with the first fuse in the LSB.  When every row has
+    the same whole number of bytes the rows are converted together with one
+    int() call and unpacked from the little endian packed buffer.
+    """
+    if len(rows) == 0:
+        return []
 
-                self.jtag.goto_state(self.enddr)
+    width = len(rows[0])
+    blob = b"".join(rows)
 
-            self.jtag.pins.ser.task()
+    if width % 8 == 0 and len(blob) == width * len(rows) and len(blob.translate(None, b"01")) == 0:
+        row_bytes = width // 8
+        packed = memoryview(int(blob[::-1], 2).to_bytes(len(blob) // 8, 'little'))
+        return [int.from_bytes(packed[i:i + row_bytes], 'little') for i in range(0, len(packed), row_bytes)]
 
+    data = []
+    for row in rows:
+        try:
+            data.append(int(row[::-1], 2))
+        except ValueError:
+            traceback.print_exc()
 
-        self.jtag.pins.send()
+    return data
 
 
 
@@ -1049,24 +1544,13 @@ class JedecFile(object):
                 traceback.print_exc()
                 return None
 
-        def line_is_end_of_field(line):
-            return "*" in line
-
-        def line_is_end_of_file(line):
-            return r"\x03" in line
-
         def process_field(field):
-            if field[0][0:4] == "NOTE":
-                self.last_note = field[0][5:-1]
-
-            elif field[0][0] == "L":
-                data = []
+            if field[0:4] == b"NOTE":
+                self.last_note = field[5:].decode("latin-1")
 
-                for fuse_string in field[1:-1]:
-                    fuse_data = line_to_int(fuse_string)
-
-                    if fuse_data is not None:
-                        data.append(fuse_data)
+            elif field[0:1] == b"L":
+                # the first token is the fuse address
+                data = fuse_rows_to_ints(field.split()[1:])
 
                 if "EBR_INIT DATA" in self.last_note:
                     self.ebr_data = data
@@ -1080,32 +1564,39 @@ class JedecFile(object):
                 else:
                     self.cfg_data = data
 
-            elif field[0][0] == "E":
-                self.feature_row = line_to_int(field[0][1:])
-                self.feature_bits = line_to_int(field[1][:-1])
-
+            elif field[0:1] == b"E":
+                tokens = field[1:].split()
+                self.feature_row = line_to_int(tokens[0])
+                self.feature_bits = line_to_int(tokens[1])
 
-
-        lines = iter(jed)
+        try:
+            contents = mmap.mmap(jed.fileno(), 0, access = mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            contents = jed.read()
+            if isinstance(contents, str):
+                contents = contents.encode("latin-1")
 
         try:
-            line = next(lines).strip()
+            end_of_file = contents.find(b"\x03")
+            if end_of_file < 0:
+                end_of_file = len(contents)
 
-            while True:
-                current_field = [line]
+            for match in JEDEC_FIELD_RE.finditer(contents, 0, end_of_file):
+                field = match.group(1).strip()
 
-                while not line_is_end_of_field(line):
-                    line = next(lines).strip()
-                    current_field.append(line)
+                if len(field) > 0:
+                    process_field(field)
 
-                process_field(current_field)
+        finally:
+            if isinstance(contents, mmap.mmap):
+                contents.close()
 
-                line = next(lines).strip()
 
-        except StopIteration:
-            pass
 
 
+# BIT_REVERSE_TABLE[b] is b with its bit order reversed.
+BIT_REVERSE_TABLE = bytes(int(format(i, '08b')[::-1], 2) for i in range(256))
+
 
 
 class BitstreamFile(object):
@@ -1128,59 +1619,40 @@ class BitstreamFile(object):
         return toInt(self.cfg_data) + toInt(self.ebr_data) + toInt(self.ufm_data)
 
     def _parse(self, bit):
-        def bytestring_reverse_to_int(bytestr):
-            rev_line = []
-            for l in reversed(bytestr):
-                b = bin(l)
-                b_rev = b[-1:1:-1]
-                b_rev = b_rev + (8 - len(b_rev))*'0'
-                rev_line.append(int(b_rev, 2))
-
-            return int.from_bytes(rev_line, byteorder='big')
-
-        def line_to_int(line):
-            try:
-                return int(line[::-1], 16)
-            except:
-                traceback.print_exc()
-                return None
+        contents = bit.read()
 
         # Validate we have a bitstream.
-        if bit.read(2) != b"\xff\x00":
+        if contents[0:2] != b"\xff\x00":
             raise ValueError("Bitstream file does not begin with 0xFF00.")
 
-        while True:
-            val = bit.read(1)
-            if bit.peek(4)[:4] == b"\xff\xff\xbd\xb3":
-                break
-            if not val:
-                raise ValueError("Could not find bitstream preamble.")
-
-        start_of_data = bit.tell()
+        start_of_data = contents.find(b"\xff\xff\xbd\xb3", 3)
+        if start_of_data < 0:
+            raise ValueError("Could not find bitstream preamble.")
 
         # Eat characters and commands until we find a compressed bitstream.
-        bit.read(4)
+        pos = start_of_data + 4
         while True:
-            cmd = bit.read(1)
+            cmd = contents[pos:pos + 1]
+            pos += 1
 
             # BYPASS
             if cmd == b"\xff":
                 pass
             # LSC_RESET_CRC
             elif cmd == b"\x3b":
-                bit.read(3)
+                pos += 3
             # VERIFY_ID
             elif cmd == b"\xe2":
-                bit.read(7)
+                pos += 7
             # LSC_WRITE_COMP_DIC
             elif cmd == b"\x02":
-                bit.read(11)
+                pos += 11
             # LSC_PROG_CNTRL0
             elif cmd == b"\x22":
-                bit.read(7)
+                pos += 7
             # LSC_INIT_ADDRESS
             elif cmd == b"\x46":
-                bit.read(3)
+                pos += 3
             # LSC_PROG_INCR_CMP
             elif cmd == b"\xb8":
                 break
@@ -1190,18 +1662,15 @@ class BitstreamFile(object):
             else:
                 assert False, "Unknown command type {}.".format(cmd)
 
-        bit.seek(start_of_data)
-
-        data = []
-        done = False
-        while not done:
-            line = bit.read(16)
+        # Rows are 16 bytes from the preamble on, with the last row padded
+        # with 0xFF.  Each row is sent LSB first with the bits of every byte
+        # reversed, so a row is the little endian value of its bit reversed
+        # bytes.
+        frames = contents[start_of_data:]
+        frames += b"\xff" * (16 - len(frames) % 16)
+        frames = memoryview(frames.translate(BIT_REVERSE_TABLE))
 
-            if len(line) < 16:
-                line = line + b"\xff" * (16 - len(line))
-                done = True
-
-            data.append(bytestring_reverse_to_int(line))
+        data = [int.from_bytes(frames[i:i + 16], 'little') for i in range(0, len(frames), 16)]
 
         self.cfg_data = data
         self.feature_row = 0
@@ -1209,195 +1678,1126 @@ class BitstreamFile(object):
 
 
 
+def image_fingerprint(image):
+    """
+    32-bit fingerprint of the flash contents of a JedecFile or BitstreamFile,
+    suitable for storing in the USERCODE.  Never returns 0, the USERCODE of
+    an erased device.
+    """
+    digest = hashlib.sha256()
 
-class JtagCustomProgrammer(object):
-    def __init__(self, jtag):
-        self.jtag = jtag
-        self.enddr = "DRPAUSE"
-        self.endir = "IRPAUSE"
-        self.config_data = None
+    for rows in (image.cfg_data, image.ebr_data, image.ufm_data):
+        if rows is None:
+            digest.update(b"\x00")
+        else:
+            digest.update(b"\x01" + len(rows).to_bytes(4, 'little'))
+            digest.update(b"".join(row.to_bytes(16, 'little') for row in rows))
 
-    def write_ir(self, num_bits, write_data):
-         self.jtag.goto_state("IRSHIFT")
-         self.jtag.pins.shift_tdi(num_bits, write_data)
-         self.jtag.current_state = self.jtag.sm.states[self.jtag.current_state][1]
-         self.jtag.goto_state("IRPAUSE")
+    digest.update(image.feature_row.to_bytes(8, 'little'))
+    digest.update(image.feature_bits.to_bytes(2, 'little'))
 
-    def read_dr(self, num_bits, read_callback, blocking = False):
-         self.jtag.goto_state("DRSHIFT")
-         self.jtag.pins.shift_tdo(num_bits, read_callback, blocking = blocking)
-         self.jtag.current_state = self.jtag.sm.states[self.jtag.current_state][1]
-         self.jtag.goto_state("DRPAUSE")
+    return int.from_bytes(digest.digest()[:4], 'little') or 1
 
-    def write_dr(self, num_bits, write_data):
-         self.jtag.goto_state("DRSHIFT")
-         self.jtag.pins.shift_tdi(num_bits, write_data)
-         self.jtag.current_state = self.jtag.sm.states[self.jtag.current_state][1]
-         self.jtag.goto_state("DRPAUSE")
 
-    def check_dr(self, num_bits, check_data, check_mask, status_callback = None):
-         self.jtag.goto_state("DRSHIFT")
-         self.jtag.pins.shift_tdo_poll(num_bits, check_data, check_mask, status_callback)
-         self.jtag.current_state = self.jtag.sm.states[self.jtag.current_state][1]
-         self.jtag.goto_state("DRPAUSE")
 
-    def runtest(self, clks, state = "IDLE"):
-        self.jtag.goto_state(state)
+# MachXO2 configuration and user flash sizes in rows, by IDCODE with the
+# version nibble masked off.  The ZE parts have the HC geometry.
+MACHXO2_DEVICES = {
+    0x012B0043: ("LCMXO2-256ZE", 575, 0),
+    0x012B1043: ("LCMXO2-640ZE", 1151, 191),
+    0x012B2043: ("LCMXO2-1200ZE", 2175, 511),
+    0x012B3043: ("LCMXO2-2000ZE", 3198, 639),
+    0x012B4043: ("LCMXO2-4000ZE", 5758, 767),
+    0x012B5043: ("LCMXO2-7000ZE", 9212, 2046),
+    0x012B8043: ("LCMXO2-256HC", 575, 0),
+    0x012B9043: ("LCMXO2-640HC", 1151, 191),
+    0x012BA043: ("LCMXO2-1200HC", 2175, 511),
+    0x012BB043: ("LCMXO2-2000HC", 3198, 639),
+    0x012BC043: ("LCMXO2-4000HC", 5758, 767),
+    0x012BD043: ("LCMXO2-7000HC", 9212, 2046),
+}
 
-        while clks > 0:
-            clks_now = min(clks, 1000)
-            self.jtag.pins.run_tck(clks_now)
-            clks -= clks_now
 
-    def loop(self, loop_count):
-        self.jtag.pins.loop(loop_count)
+def machxo2_device(idcode):
+    """
+    Return (name, cfg_rows, ufm_rows) of the MachXO2 with idcode, or None.
+    """
+    return MACHXO2_DEVICES.get(idcode & 0x0FFFFFFF)
 
-    def endloop(self):
-        self.jtag.pins.end_loop(None)
 
 
+class FlashImage(object):
+    """
+    Flash contents read back from a device by JtagCustomProgrammer.dump(),
+    with the same rows and feature fields as a JedecFile.  Configuration
+    flash rows are kept in cfg_data whether they came from the JEDEC
+    configuration or EBR initialization data, as the flash does not tell
+    them apart.
+    """
+    def __init__(self, cfg_data, ufm_data = None, feature_row = 0, feature_bits = 0, idcode = None, usercode = None):
+        self.cfg_data = cfg_data
+        self.ebr_data = None
+        self.ufm_data = ufm_data
+        self.feature_row = feature_row
+        self.feature_bits = feature_bits
+        self.idcode = idcode
+        self.usercode = usercode
+        self.last_note = ""
 
-    def program(self, jed_file, progress = None):
-        num_rows = jed_file.numRows()
-        prog_update_freq = 20
-        prog_update_cnt = 0
+    def numRows(self):
+        return len(self.cfg_data) + len(self.ufm_data or [])
 
-        def default_progress(v):
-            pass
 
-        if progress is None:
-            progress = default_progress
 
-        def status(description, amount):
-            def status_callback(status):
-                if len(status) == 0:
-                    progress(description)
-                    progress(amount)
+def _jedec_rows(rows):
+    # first fuse first, the reverse of fuse_rows_to_ints
+    return [format(row, '0128b')[::-1] for row in rows]
 
-                elif status[0] == 0:
-                    progress(description)
-                    progress(amount)
 
-                else:
-                    progress(description + " - Failed!")
+def write_jedec(image, f, notes = ()):
+    """
+    Write the rows and feature fields of a JedecFile, BitstreamFile or
+    FlashImage to the text file f in the JEDEC layout JedecFile parses,
+    with fuse and transmission checksums.  notes are written as NOTE
+    fields at the top.
+    """
+    rows = list(image.cfg_data) + list(image.ebr_data or [])
+    ufm_rows = image.ufm_data or []
 
-            return status_callback
+    fuse_checksum = 0
+    for row in itertools.chain(rows, ufm_rows):
+        fuse_checksum += sum(row.to_bytes(16, 'little'))
 
-        # drain any lingering read data before continuing
-        if self.jtag.pins.ser.ser.inWaiting() > 0:
-            print(str([x for x in array.array('B', self.jtag.pins.ser.ser.read(size = self.jtag.pins.ser.ser.inWaiting())).tolist()]))
+    fields = ["\x02*"]
+    fields += ["NOTE {}*".format(note) for note in notes]
+    fields += ["QF{}*".format(128 * (len(rows) + len(ufm_rows))), "G0*", "F0*"]
+    fields += ["L{:06d}".format(0)] + _jedec_rows(rows) + ["*"]
 
-        self.jtag.pins.clear_status()
+    if ufm_rows:
+        fields += ["NOTE TAG DATA*", "L{:06d}".format(128 * len(rows))] + _jedec_rows(ufm_rows) + ["*"]
 
-        ### read idcode
-        # This is constantly being checked in the GUI
-        #self.write_ir(8, 0xE0)
-        #self.check_dr(32, 0x012BA043, 0xFFFFFFFF)
+    fields += ["C{:04X}*".format(fuse_checksum & 0xFFFF)]
+    fields += ["NOTE FEATURE_ROW*", "E" + format(image.feature_row, '064b')[::-1], format(image.feature_bits, '016b')[::-1] + "*"]
 
-        ### program bscan register
-        self.write_ir(8, 0x1C)
-        self.write_dr(208, 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF)
+    text = "\n".join(fields) + "\n\x03"
+    f.write(text + "{:04X}\n".format(sum(text.encode("latin-1")) & 0xFFFF))
 
-        ### check key protection fuses
-        self.write_ir(8, 0x3C)
-        self.runtest(1000)
-        self.check_dr(32, 0x00000000, 0x00010000)
 
-        ### enable the flash
-        # ISC ENABLE
-        self.write_ir(8, 0xC6)
-        self.write_dr(8, 0x00)
-        self.runtest(1000)
-        # ISC ERASE
-        self.write_ir(8, 0x0E)
-        self.write_dr(8, 0x01)
-        self.runtest(1000)
-        # BYPASS
-        self.write_ir(8, 0xFF)
-        # ISC ENABLE
-        self.write_ir(8, 0xC6)
-        self.write_dr(8, 0x08)
-        self.runtest(1000)
+def write_rows(image, f):
+    """
+    Write the configuration flash rows and then the user flash rows of an
+    image to the binary file f, 16 bytes per row with the first fuse in the
+    LSB of the first byte.
+    """
+    rows = list(image.cfg_data) + list(image.ebr_data or []) + list(image.ufm_data or [])
+    f.write(b"".join(row.to_bytes(16, 'little') for row in rows))
 
-        ### check the OTP fuses
-        # LSC_READ_STATUS
-        self.write_ir(8, 0x3C)
-        self.runtest(1000)
-        self.check_dr(32, 0x00000000, 0x00024040)
 
-        progress("Erasing configuration flash")
-        ### erase the flash
-        # ISC ERASE
-        self.write_ir(8, 0x0E)
-        self.write_dr(8, 0x0E)
-        self.runtest(1000)
-        # LSC_CHECK_BUSY
-        self.write_ir(8, 0xF0)
-        self.loop(10000)
-        self.runtest(1000)
-        self.check_dr(1, 0, 1)
-        self.endloop()
-        self.jtag.pins.get_status(status("Writing bitstream", num_rows), blocking = True)
 
-        ### read the status bit
-        # LSC_READ_STATUS
-        self.write_ir(8, 0x3C)
-        self.runtest(1000)
-        self.check_dr(32, 0x00000000, 0x00003000)
 
-        ### program config flash
-        # LSC_INIT_ADDRESS
-        self.write_ir(8, 0x46)
-        self.write_dr(8, 0x04)
-        self.runtest(1000)
+class CommandRecorder(object):
+    """
+    Stand-in transport that records the command bytes written to it instead
+    of sending them.  The bytes are split into segments at every
+    fit_packet() call, and each segment holds the size passed to the call
+    that began it, or zero.  Reads are not allowed while recording.  It can
+    also stand in for a ProgrammingStats and collects the counts reported
+    while recording.
+    """
+    def __init__(self):
+        self.segments = [(0, bytearray())]
+        self.counts = {}
 
-        row_count = num_rows
-        combined_cfg_data = jed_file.cfg_data
+    def count(self, name, amount = 1):
+        self.counts[name] = self.counts.get(name, 0) + amount
 
-        if jed_file.ebr_data is not None:
-            combined_cfg_data += jed_file.ebr_data
+    def write(self, data):
+        if isinstance(data, int):
+            self.segments[-1][1].append(data)
+        else:
+            self.segments[-1][1].extend(data)
 
-        for line in combined_cfg_data:
-            # LSC_PROG_INCR_NV
-            self.write_ir(8, 0x70)
-            self.write_dr(128, line)
-            self.runtest(2)
-            # LSC_CHECK_BUSY
-            self.write_ir(8, 0xF0)
-            self.loop(10000)
-            self.runtest(100)
-            self.check_dr(1, 0, 1)
-            self.endloop()
+    def fit_packet(self, num_bytes):
+        self.segments.append((num_bytes, bytearray()))
+
+    def read(self, num_bytes, callback, blocking = False, expected = None):
+        raise ValueError("Command sequences that read data cannot be recorded.")
+
+    def task(self):
+        return 0
+
+    def flush(self):
+        pass
+
+
+
+class CommandTemplate(object):
+    """
+    Pre-encoded command byte sequence with a single slot for a data payload.
+    The payload bytes sit at every step'th byte from start in one segment,
+    LSB first, exactly as TinyFpgaProgrammer.shift encodes them.
+    """
+    def __init__(self, segments, slot_segment, slot_start, slot_step, num_bytes):
+        self.segments = segments
+        self.slot = segments[slot_segment][1]
+        self.slot_range = slice(slot_start, slot_start + slot_step * num_bytes, slot_step)
+        self.num_bytes = num_bytes
+        # instrumentation counts of one emitted sequence
+        self.counts = {}
+
+    @classmethod
+    def from_recordings(cls, zeros, ones, num_bytes):
+        """
+        Build a template from two recordings of the same sequence, one with an
+        all zeros payload and one with an all ones payload.  Returns None if
+        they differ anywhere except a single evenly spaced payload slot.
+        """
+        if len(zeros) != len(ones):
+            return None
+
+        slot = None
+
+        for index, ((fit0, segment0), (fit1, segment1)) in enumerate(zip(zeros, ones)):
+            if fit0 != fit1 or len(segment0) != len(segment1):
+                return None
+
+            diff = [i for i, (a, b) in enumerate(zip(segment0, segment1)) if a != b]
+
+            if len(diff) == 0:
+                continue
+
+            if slot is not None or len(diff) != num_bytes:
+                return None
+
+            step = diff[1] - diff[0] if num_bytes > 1 else 1
+            if diff != list(range(diff[0], diff[0] + step * num_bytes, step)):
+                return None
+
+            if any(segment1[i] != 0xff or segment0[i] != 0x00 for i in diff):
+                return None
+
+            slot = (index, diff[0], step)
+
+        if slot is None:
+            return None
+
+        return cls(zeros, slot[0], slot[1], slot[2], num_bytes)
+
+    def emit(self, ser, data):
+        """
+        Write the sequence to ser with data spliced into the payload slot.
+        """
+        self.slot[self.slot_range] = data.to_bytes(self.num_bytes, 'little')
+
+        for fit, segment in self.segments:
+            if fit:
+                ser.fit_packet(fit)
+            ser.write(segment)
+
+
+
+class StatusWindow(object):
+    """
+    Flow control for long runs of flash rows.  Instead of a blocking status
+    request, which drains the command pipe for a full USB round trip, status
+    requests are issued without blocking and up to window of them may be in
+    flight.  Unless a fixed window is given, the window is sized from the
+    measured round trip time of the requests divided by the time between
+    them, so the programmer always has commands queued while a failure is
+    still reported within window requests.
+
+    If given, resized is called with every window size picked and returns
+    the size to use, so a session recorder can log the sizes and a replay
+    can reproduce them.
+    """
+    def __init__(self, pins, window = None, max_window = 8, resized = None):
+        self.pins = pins
+        self.resized = resized
+        self.fixed = window is not None
+        self.window = window if window is not None else 2
+        self.max_window = max_window
+        self.outstanding = 0
+        self.last_request = None
+        self.interval = None
+        self.rtt = None
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return 0.75 * average + 0.25 * sample
+
+    def request(self, status_callback):
+        now = time.perf_counter()
+
+        if self.last_request is not None:
+            self.interval = self._average(self.interval, now - self.last_request)
+
+        self.last_request = now
+        self.outstanding += 1
+
+        def window_callback(status):
+            self.outstanding -= 1
+            self.rtt = self._average(self.rtt, time.perf_counter() - now)
+
+            if not self.fixed and self.interval:
+                self.window = max(1, min(self.max_window, int(math.ceil(self.rtt / self.interval)) + 1))
+
+                if self.resized is not None:
+                    self.window = self.resized(self.window)
+
+            status_callback(status)
+
+        self.pins.get_status(window_callback, blocking = False)
+
+    def full(self):
+        return self.outstanding >= self.window
+
+    def ready(self):
+        return self.outstanding < self.window
+
+
+
+# MachXO2 instructions that only select the data register for the next DR
+# scan.  Loading one has no effect of its own, so it is dead if another
+# instruction is loaded before any DR scan or idle clocks.
+SELECT_ONLY_INSTRUCTIONS = frozenset([
+    0x1C, # SAMPLE
+    0x3C, # LSC_READ_STATUS
+    0xC0, # USERCODE
+    0xE0, # IDCODE
+    0xE7, # LSC_READ_FEATURE
+    0xF0, # LSC_CHECK_BUSY
+    0xFB, # LSC_READ_FEABITS
+    0xFF, # BYPASS
+])
+
+
+def optimize_ops(ops):
+    """
+    Peephole pass over a list of JtagCustomProgrammer operations.  Returns
+    a new list that drives the device through the same sequence of effects:
+
+    - an IR scan of a select-only instruction that is immediately replaced
+      by another IR scan is dropped;
+    - an IR scan of a select-only instruction that is already loaded is
+      dropped;
+    - consecutive runtests in the same state are merged.
+
+    Loop bodies are repeated by the firmware and are left untouched, and
+    nothing is moved across a loop boundary.
+    """
+    result = []
+    loaded_ir = None
+    depth = 0
+
+    for op in ops:
+        kind = op[0]
+        prev = result[-1] if result else None
+
+        if kind == "loop":
+            depth += 1
+        elif kind == "endloop":
+            depth -= 1
+            loaded_ir = None
+
+        elif depth > 0:
+            if kind == "ir" or kind == "goto" or (kind == "runtest" and op[2] == "RESET"):
+                loaded_ir = None
+
+        elif kind == "ir":
+            if op[2] == loaded_ir and op[2] in SELECT_ONLY_INSTRUCTIONS:
+                continue
+
+            if prev is not None and prev[0] == "ir" and prev[2] in SELECT_ONLY_INSTRUCTIONS:
+                result.pop()
+
+            loaded_ir = op[2]
+
+        elif kind == "runtest":
+            if prev is not None and prev[0] == "runtest" and prev[2] == op[2]:
+                result[-1] = ("runtest", prev[1] + op[1], op[2])
+                continue
+
+            if op[2] == "RESET":
+                loaded_ir = None
+
+        elif kind == "goto" and op[1] == "RESET":
+            loaded_ir = None
+
+        result.append(op)
+
+    return result
+
+
+
+class JtagCustomProgrammer(object):
+    def __init__(self, jtag):
+        self.jtag = jtag
+        self.enddr = "DRPAUSE"
+        self.endir = "IRPAUSE"
+        self.config_data = None
+
+        # program() requests status every status_interval rows and keeps up
+        # to status_window requests in flight, or sizes the window from the
+        # measured round trip time, up to max_status_window, if it is None.
+        self.status_interval = 20
+        self.status_window = None
+        self.max_status_window = 8
+        # passed to StatusWindow as resized, see record.py
+        self.status_window_resized = None
+        self.poll_interval = 0.0002
+
+        # dump() keeps up to dump_window row reads in flight
+        self.dump_window = 64
+
+        # operations are appended here instead of sent while recording a
+        # batch; see optimized()
+        self.ops = None
+        self.optimize = True
+        self.optimizer_stats = {"ops_in": 0, "ops_out": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def write_ir(self, num_bits, write_data):
+         if self.ops is not None:
+             self.ops.append(("ir", num_bits, write_data))
+             return
+
+         self.jtag.goto_state("IRSHIFT")
+         self.jtag.pins.shift_tdi(num_bits, write_data)
+         self.jtag.current_state = self.jtag.sm.states[self.jtag.current_state][1]
+         self.jtag.goto_state("IRPAUSE")
+
+    def read_dr(self, num_bits, read_callback, blocking = False):
+         if self.ops is not None:
+             self.ops.append(("read", num_bits, read_callback, blocking))
+             return None
+
+         self.jtag.goto_state("DRSHIFT")
+         read = self.jtag.pins.shift_tdo(num_bits, read_callback, blocking = blocking)
+         self.jtag.current_state = self.jtag.sm.states[self.jtag.current_state][1]
+         self.jtag.goto_state("DRPAUSE")
+         return read
+
+    def write_dr(self, num_bits, write_data):
+         if self.ops is not None:
+             self.ops.append(("dr", num_bits, write_data))
+             return
+
+         self.jtag.goto_state("DRSHIFT")
+         self.jtag.pins.shift_tdi(num_bits, write_data)
+         self.jtag.current_state = self.jtag.sm.states[self.jtag.current_state][1]
+         self.jtag.goto_state("DRPAUSE")
+
+    def check_dr(self, num_bits, check_data, check_mask, status_callback = None):
+         if self.ops is not None:
+             self.ops.append(("check", num_bits, check_data, check_mask, status_callback))
+             return
+
+         self.jtag.goto_state("DRSHIFT")
+         self.jtag.pins.shift_tdo_poll(num_bits, check_data, check_mask, status_callback)
+         self.jtag.current_state = self.jtag.sm.states[self.jtag.current_state][1]
+         self.jtag.goto_state("DRPAUSE")
+
+    def runtest(self, clks, state = "IDLE"):
+        if self.ops is not None:
+            self.ops.append(("runtest", clks, state))
+            return
+
+        self.jtag.goto_state(state)
+
+        while clks > 0:
+            clks_now = min(clks, MAX_SHIFT_BITS)
+            self.jtag.pins.run_tck(clks_now)
+            clks -= clks_now
+
+    def loop(self, loop_count):
+        if self.ops is not None:
+            self.ops.append(("loop", loop_count))
+            return
+
+        self.jtag.pins.loop(loop_count)
+
+    def endloop(self):
+        if self.ops is not None:
+            self.ops.append(("endloop",))
+            return
+
+        self.jtag.pins.end_loop(None)
+
+    def goto_state(self, state):
+        if self.ops is not None:
+            self.ops.append(("goto", state))
+            return
+
+        self.jtag.goto_state(state)
+
+    OP_METHODS = {
+        "ir": "write_ir",
+        "dr": "write_dr",
+        "read": "read_dr",
+        "check": "check_dr",
+        "runtest": "runtest",
+        "loop": "loop",
+        "endloop": "endloop",
+        "goto": "goto_state",
+    }
+
+    def send_ops(self, ops):
+        """
+        Encode and send a list of operations as recorded by optimized().
+        """
+        for op in ops:
+            getattr(self, self.OP_METHODS[op[0]])(*op[1:])
+
+    def _encoded_size(self, ops):
+        """
+        Number of command bytes send_ops(ops) would send from the current
+        JTAG state, or None if ops read data and cannot be recorded.
+        """
+        pins = self.jtag.pins
+        ser = pins.ser
+        stats = pins.stats
+        start_state = self.jtag.current_state
+
+        try:
+            pins.ser = pins.stats = CommandRecorder()
+            self.send_ops(ops)
+            return sum(len(data) for new_packet, data in pins.ser.segments)
+        except ValueError:
+            return None
+        finally:
+            pins.ser = ser
+            pins.stats = stats
+            self.jtag.current_state = start_state
+
+    @contextlib.contextmanager
+    def optimized(self):
+        """
+        Record the operations issued inside the with block instead of
+        sending them, run optimize_ops() over them and send the result when
+        the block exits.  Operations return nothing while recording, so the
+        block must not depend on read results or talk to the pins directly.
+        Eliminated operations are added to optimizer_stats and counted as
+        "ops_eliminated".  Measuring the command bytes saved, not counting
+        packet padding, takes two extra encodings of the block, so it is
+        only done while a stats object is attached to the pins; they are
+        then added to optimizer_stats and counted as "bytes_eliminated".
+        Nested blocks join the outermost one.
+        """
+        if self.ops is not None:
+            yield
+            return
+
+        self.ops = []
+
+        try:
+            yield
+            ops = self.ops
+        finally:
+            self.ops = None
+
+        if self.optimize:
+            optimized_ops = optimize_ops(ops)
+        else:
+            optimized_ops = ops
+
+        if self.optimize and self.jtag.pins.stats is not None:
+            bytes_in = self._encoded_size(ops)
+            bytes_out = self._encoded_size(optimized_ops)
+        else:
+            bytes_in = bytes_out = None
+
+        stats = self.optimizer_stats
+        stats["ops_in"] += len(ops)
+        stats["ops_out"] += len(optimized_ops)
+        self.jtag.pins._count("ops_eliminated", len(ops) - len(optimized_ops))
+
+        if bytes_in is not None and bytes_out is not None:
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            self.jtag.pins._count("bytes_eliminated", bytes_in - bytes_out)
+
+        self.send_ops(optimized_ops)
+
+    def program_row(self, line):
+        # LSC_PROG_INCR_NV
+        self.write_ir(8, 0x70)
+        self.write_dr(128, line)
+        self.runtest(2)
+        # LSC_CHECK_BUSY
+        self.write_ir(8, 0xF0)
+        self.loop(10000)
+        self.runtest(100)
+        self.check_dr(1, 0, 1)
+        self.endloop()
+
+    def verify_row(self, line):
+        self.runtest(2)
+        self.check_dr(128, line, 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF)
+
+    def compile_row(self, row_function, num_bits = 128):
+        """
+        Record the commands row_function(data) sends from the current JTAG
+        state and turn them into a CommandTemplate.  Nothing is sent to the
+        programmer.  Returns None if the sequence does not end in the state it
+        started from, since it then cannot be repeated row after row.
+        """
+        pins = self.jtag.pins
+        ser = pins.ser
+        stats = pins.stats
+        start_state = self.jtag.current_state
+        recordings = []
+
+        try:
+            for data in (0, (1 << num_bits) - 1):
+                pins.ser = pins.stats = CommandRecorder()
+                self.jtag.current_state = start_state
+                row_function(data)
+                recordings.append(pins.ser.segments)
+
+            end_state = self.jtag.current_state
+            counts = pins.ser.counts
+
+        finally:
+            pins.ser = ser
+            pins.stats = stats
+            self.jtag.current_state = start_state
+
+        if end_state != start_state:
+            return None
+
+        template = CommandTemplate.from_recordings(recordings[0], recordings[1], num_bits // 8)
+
+        if template is not None:
+            template.counts = counts
+
+        return template
+
+    def row_writer(self, row_function, num_bits = 128):
+        """
+        Returns a function that sends row_function(data) for each row it is
+        called with.  Once the JTAG state repeats from row to row the sequence
+        is compiled with compile_row and later rows are stamped out of the
+        template instead of being encoded again.
+        """
+        template = None
+        failed_states = set()
+
+        def write_row(data):
+            nonlocal template
+
+            if template is None and self.jtag.current_state not in failed_states:
+                template = self.compile_row(row_function, num_bits)
+                if template is None:
+                    failed_states.add(self.jtag.current_state)
+
+            if template is None:
+                row_function(data)
+            else:
+                template.emit(self.jtag.pins.ser, data)
+
+                if self.jtag.pins.stats is not None:
+                    for name, amount in template.counts.items():
+                        self.jtag.pins.stats.count(name, amount)
+
+        return write_row
+
+
+
+    def _run(self, steps):
+        """
+        Run a generator of programming steps to completion.  Steps yield
+        None after every blocking read; with the blocking transports the read
+        has already completed, so there is nothing to wait for.  Steps yield
+        a function to wait until it returns True while non-blocking reads
+        complete.
+        """
+        ser = self.jtag.pins.ser
+
+        try:
+            while True:
+                done = next(steps)
+
+                if done is not None:
+                    ser.flush()
+                    ser.task()
+
+                    while not done():
+                        time.sleep(self.poll_interval)
+                        ser.task()
+
+        except StopIteration as e:
+            return e.value
+
+    async def _run_async(self, steps):
+        """
+        Run a generator of programming steps on an AsyncioSerial transport,
+        waiting for queued reads wherever a step needs their results.
+        """
+        ser = self.jtag.pins.ser
+
+        try:
+            while True:
+                done = next(steps)
+
+                if done is None:
+                    await ser.drain()
+                else:
+                    await ser.wait_until(done)
+
+        except StopIteration as e:
+            return e.value
+
+    def read_usercode(self):
+        """
+        Read the USERCODE and status register in a single round trip.
+        Returns (usercode, status), or None if the programmer did not answer.
+        """
+        return self._run(self._read_usercode())
+
+    async def read_usercode_async(self):
+        """
+        Coroutine version of read_usercode() for AsyncioSerial transports.
+        """
+        return await self._run_async(self._read_usercode())
+
+    def _read_usercode(self):
+        data = bytearray()
+
+        # USERCODE
+        self.write_ir(8, 0xC0)
+        self.read_dr(32, data.extend)
+        # LSC_READ_STATUS
+        self.write_ir(8, 0x3C)
+        self.read_dr(32, data.extend, blocking = True)
+        yield
+
+        if len(data) < 8:
+            return None
+
+        return int.from_bytes(data[0:4], 'little'), int.from_bytes(data[4:8], 'little')
+
+    def compare(self, jed_file):
+        """
+        Read back the configuration flash, user flash, feature row and
+        feature bits and compare them against a JedecFile or BitstreamFile.
+        Flash access must already be enabled.  The comparison runs in the
+        programmer firmware, so only a single status byte is read back.
+        User flash is only compared when the image contains UFM data.
+        Returns True if everything matches.
+        """
+        return self._run(self._compare(jed_file))
+
+    async def compare_async(self, jed_file):
+        """
+        Coroutine version of compare() for AsyncioSerial transports.
+        """
+        return await self._run_async(self._compare(jed_file))
+
+    def _compare(self, jed_file):
+        self.jtag.pins.clear_status()
+
+        # LSC_INIT_ADDRESS
+        self.write_ir(8, 0x46)
+        self.write_dr(8, 0x04)
+        self.runtest(1000)
+
+        # LSC_READ_INCR_NV
+        self.write_ir(8, 0x73)
+
+        verify_row = self.row_writer(self.verify_row)
+
+        for rows in (jed_file.cfg_data, jed_file.ebr_data):
+            for line in rows or []:
+                verify_row(line)
+
+        if jed_file.ufm_data is not None:
+            # LSC_INIT_ADDRESS
+            self.write_ir(8, 0x47)
+            self.runtest(1000)
+
+            # LSC_READ_INCR_NV
+            self.write_ir(8, 0x73)
+
+            verify_row = self.row_writer(self.verify_row)
+
+            for line in jed_file.ufm_data:
+                verify_row(line)
+
+        # LSC_READ_FEATURE
+        self.write_ir(8, 0xE7)
+        self.runtest(2)
+        self.check_dr(64, jed_file.feature_row, 0xFFFFFFFFFFFFFFFF)
+        # LSC_READ_FEABITS
+        self.write_ir(8, 0xFB)
+        self.runtest(2)
+        self.check_dr(16, jed_file.feature_bits, 0xFFFF)
+
+        status = bytearray()
+        self.jtag.pins.get_status(status.extend, blocking = True)
+        yield
+
+        if len(status) > 0 and status[0] != 0:
+            # the first mismatch already sent an unsolicited failure byte,
+            # so the reply to get_status is still waiting to be read
+            self.jtag.pins.ser.read(1, status.extend, blocking = True)
+            yield
+
+        self.jtag.pins.clear_status()
+
+        return len(status) > 0 and status[0] == 0
+
+    def dump(self, progress = None, cfg_rows = None, ufm_rows = None):
+        """
+        Read back the configuration flash, user flash, feature row and
+        feature bits into a FlashImage.  Flash access is enabled in
+        transparent mode, so a configured device keeps running.  The flash
+        sizes are looked up from the IDCODE unless cfg_rows and ufm_rows are
+        given.  Row reads are issued without blocking and up to dump_window
+        of them are kept in flight, so the read back runs close to the link
+        bandwidth instead of waiting a round trip per row.  progress is
+        called with status strings and row counts.  Returns None if the
+        programmer did not answer every read.
+        """
+        return self._run(self._dump(progress, cfg_rows, ufm_rows))
+
+    async def dump_async(self, progress = None, cfg_rows = None, ufm_rows = None):
+        """
+        Coroutine version of dump() for AsyncioSerial transports.
+        """
+        return await self._run_async(self._dump(progress, cfg_rows, ufm_rows))
+
+    def _read_rows(self, rows, progress, description):
+        # LSC_READ_INCR_NV
+        self.write_ir(8, 0x73)
+
+        pins = self.jtag.pins
+        window = self.dump_window
+        completed = [0]
+        issued = 0
+
+        def row_reader(index):
+            def read_callback(data):
+                if len(data) == 16:
+                    rows[index] = int.from_bytes(bytes(data), 'little')
+                completed[0] += 1
+
+            return read_callback
+
+        for index in range(len(rows)):
+            self.runtest(2)
+            self.read_dr(128, row_reader(index))
+            pins._count("rows")
+            issued += 1
+
+            if issued - completed[0] >= window:
+                # refill once half the window has drained
+                target = issued - window // 2
+                yield lambda: completed[0] >= target
+                progress(description)
+                progress(completed[0])
+
+    def _dump(self, progress, cfg_rows, ufm_rows):
+        if progress is None:
+            progress = lambda v: None
+
+        self.jtag.pins.clear_status()
+        ids = bytearray()
+
+        # IDCODE
+        self.write_ir(8, 0xE0)
+        self.read_dr(32, ids.extend)
+        # USERCODE
+        self.write_ir(8, 0xC0)
+        self.read_dr(32, ids.extend, blocking = True)
+        yield
+
+        if len(ids) < 8:
+            return None
+
+        idcode = int.from_bytes(ids[0:4], 'little')
+        usercode = int.from_bytes(ids[4:8], 'little')
+
+        if cfg_rows is None:
+            device = machxo2_device(idcode)
+
+            if device is None:
+                raise ValueError("Unknown device IDCODE 0x%08X, give the flash sizes." % idcode)
+
+            cfg_rows = device[1]
+
+            if ufm_rows is None:
+                ufm_rows = device[2]
+
+        cfg_data = [None] * cfg_rows
+        ufm_data = [None] * (ufm_rows or 0)
+        features = bytearray()
+
+        self.jtag.pins._count("rows_expected", len(cfg_data) + len(ufm_data))
+
+        with self.optimized():
+            # ISC_ENABLE_X
+            self.write_ir(8, 0x74)
+            self.write_dr(8, 0x08)
+            self.runtest(1000)
+
+            # LSC_INIT_ADDRESS
+            self.write_ir(8, 0x46)
+            self.write_dr(8, 0x04)
+            self.runtest(1000)
+
+        progress("Reading configuration flash")
+        yield from self._read_rows(cfg_data, progress, "Reading configuration flash")
+
+        if ufm_data:
+            # LSC_INIT_ADDRESS
+            self.write_ir(8, 0x47)
+            self.runtest(1000)
+
+            progress("Reading user flash")
+            yield from self._read_rows(ufm_data, progress, "Reading user flash")
+
+        # LSC_READ_FEATURE
+        self.write_ir(8, 0xE7)
+        self.runtest(2)
+        self.read_dr(64, features.extend)
+        # LSC_READ_FEABITS
+        self.write_ir(8, 0xFB)
+        self.runtest(2)
+        self.read_dr(16, features.extend)
+
+        with self.optimized():
+            # ISC_DISABLE
+            self.write_ir(8, 0x26)
+            self.runtest(1000)
+            # BYPASS
+            self.write_ir(8, 0xFF)
+            self.runtest(1000)
+            self.goto_state("RESET")
+
+        # waits for every read still in flight
+        status = bytearray()
+        self.jtag.pins.get_status(status.extend, blocking = True)
+        yield
+
+        if len(status) == 0 or len(features) < 10 or None in cfg_data or None in ufm_data:
+            return None
+
+        progress("Done")
+
+        return FlashImage(cfg_data, ufm_data or None,
+            feature_row = int.from_bytes(features[0:8], 'little'),
+            feature_bits = int.from_bytes(features[8:10], 'little'),
+            idcode = idcode, usercode = usercode)
+
+    def program(self, jed_file, progress = None, phase = None, skip_if_identical = False, fingerprint = False):
+        """
+        Erase, program and verify the configuration flash, user flash and
+        feature rows from a JedecFile or BitstreamFile.  progress is called
+        with status strings and row counts.  phase, if given, is called with
+        the name of each programming phase as it begins: "check", "enable",
+        "compare", "erase", "write_cfg", "write_ufm", "verify",
+        "feature_rows" and "done".
+
+        With fingerprint the image_fingerprint() of the image is programmed
+        into the USERCODE, and programming is skipped altogether if the
+        device is configured and its USERCODE already holds it.  With
+        skip_if_identical the flash is first compared against the image and,
+        if it already matches, erase, write and verify are skipped.
+        Returns True if the device was programmed and False if it was skipped.
+        """
+        return self._run(self._program(jed_file, progress, phase, skip_if_identical, fingerprint))
+
+    async def program_async(self, jed_file, progress = None, phase = None, skip_if_identical = False, fingerprint = False):
+        """
+        Coroutine version of program() for AsyncioSerial transports.  The
+        event loop is free to run other tasks whenever programming waits for
+        status from the programmer.
+        """
+        return await self._run_async(self._program(jed_file, progress, phase, skip_if_identical, fingerprint))
+
+    def _program(self, jed_file, progress, phase, skip_if_identical, fingerprint):
+        num_rows = jed_file.numRows()
+        prog_update_freq = self.status_interval
+        prog_update_cnt = 0
+        status_window = StatusWindow(self.jtag.pins, self.status_window, self.max_status_window, self.status_window_resized)
+
+        def default_progress(v):
+            pass
+
+        if progress is None:
+            progress = default_progress
+
+        if phase is None:
+            phase = default_progress
+
+        def status(description, amount):
+            def status_callback(status):
+                if len(status) == 0:
+                    progress(description)
+                    progress(amount)
+
+                elif status[0] == 0:
+                    progress(description)
+                    progress(amount)
+
+                else:
+                    progress(description + " - Failed!")
+
+            return status_callback
+
+        # drain any lingering read data before continuing
+        stray = self.jtag.pins.ser.discard_input()
+        if len(stray) > 0:
+            print(str(list(stray)))
+
+        self.jtag.pins.clear_status()
+
+        usercode = None
+
+        if fingerprint:
+            phase("check")
+            usercode = image_fingerprint(jed_file)
+            current = yield from self._read_usercode()
+
+            if current is not None:
+                current_usercode, current_status = current
+
+                # DONE set and FAIL clear
+                if current_usercode == usercode and (current_status & 0x00002100) == 0x00000100:
+                    progress("USERCODE matches image fingerprint, skipping programming")
+                    phase("done")
+                    self.goto_state("RESET")
+                    self.jtag.pins.get_status(status("Done", 0), blocking = True)
+                    yield
+                    return False
+
+        phase("enable")
+
+        with self.optimized():
+            ### read idcode
+            # This is constantly being checked in the GUI
+            #self.write_ir(8, 0xE0)
+            #self.check_dr(32, 0x012BA043, 0xFFFFFFFF)
+
+            ### program bscan register
+            self.write_ir(8, 0x1C)
+            self.write_dr(208, 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF)
+
+            ### check key protection fuses
+            self.write_ir(8, 0x3C)
+            self.runtest(1000)
+            self.check_dr(32, 0x00000000, 0x00010000)
+
+            ### enable the flash
+            # ISC ENABLE
+            self.write_ir(8, 0xC6)
+            self.write_dr(8, 0x00)
+            self.runtest(1000)
+            # ISC ERASE
+            self.write_ir(8, 0x0E)
+            self.write_dr(8, 0x01)
+            self.runtest(1000)
+            # BYPASS
+            self.write_ir(8, 0xFF)
+            # ISC ENABLE
+            self.write_ir(8, 0xC6)
+            self.write_dr(8, 0x08)
+            self.runtest(1000)
+
+            ### check the OTP fuses
+            # LSC_READ_STATUS
+            self.write_ir(8, 0x3C)
+            self.runtest(1000)
+            self.check_dr(32, 0x00000000, 0x00024040)
+
+        if skip_if_identical:
+            progress("Comparing flash with image")
+            phase("compare")
+
+            if (yield from self._compare(jed_file)):
+                progress("Flash already matches image, skipping erase and program")
+                phase("done")
+                self.finish()
+                self.jtag.pins.get_status(status("Done", 0), blocking = True)
+                yield
+                return False
+
+        progress("Erasing configuration flash")
+        phase("erase")
+        # every row is written and then verified
+        self.jtag.pins._count("rows_expected", 2 * num_rows)
+        with self.optimized():
+            ### erase the flash
+            # ISC ERASE
+            self.write_ir(8, 0x0E)
+            self.write_dr(8, 0x0E)
+            self.runtest(1000)
+            # LSC_CHECK_BUSY
+            self.write_ir(8, 0xF0)
+            self.loop(10000)
+            self.runtest(1000)
+            self.check_dr(1, 0, 1)
+            self.endloop()
+        self.jtag.pins.get_status(status("Writing bitstream", num_rows), blocking = True)
+        yield
+
+        with self.optimized():
+            ### read the status bit
+            # LSC_READ_STATUS
+            self.write_ir(8, 0x3C)
+            self.runtest(1000)
+            self.check_dr(32, 0x00000000, 0x00003000)
+
+        ### program config flash
+        phase("write_cfg")
+        with self.optimized():
+            # LSC_INIT_ADDRESS
+            self.write_ir(8, 0x46)
+            self.write_dr(8, 0x04)
+            self.runtest(1000)
+
+        row_count = num_rows
+        combined_cfg_data = jed_file.cfg_data
+
+        if jed_file.ebr_data is not None:
+            # don't extend cfg_data in place, the image may be shared
+            combined_cfg_data = combined_cfg_data + jed_file.ebr_data
+
+        program_row = self.row_writer(self.program_row)
+
+        for line in combined_cfg_data:
+            program_row(line)
+            self.jtag.pins._count("rows")
 
             prog_update_cnt += 1
 
             if prog_update_cnt % prog_update_freq == 0:
-                self.jtag.pins.get_status(status("Writing bitstream", prog_update_freq), blocking = True)
+                status_window.request(status("Writing bitstream", prog_update_freq))
+                if status_window.full():
+                    yield status_window.ready
 
         if jed_file.ufm_data is not None:
             ### program user flash
+            phase("write_ufm")
             # LSC_INIT_ADDRESS
             self.write_ir(8, 0x47)
             self.runtest(1000)
 
+            program_row = self.row_writer(self.program_row)
+
             for line in jed_file.ufm_data:
-                # LSC_PROG_INCR_NV
-                self.write_ir(8, 0x70)
-                self.write_dr(128, line)
-                self.runtest(2)
-                # LSC_CHECK_BUSY
-                self.write_ir(8, 0xF0)
-                self.loop(10000)
-                self.runtest(100)
-                self.check_dr(1, 0, 1)
-                self.endloop()
+                program_row(line)
+                self.jtag.pins._count("rows")
 
                 prog_update_cnt += 1
 
                 if prog_update_cnt % prog_update_freq == 0:
-                    self.jtag.pins.get_status(status("Writing bitstream", prog_update_freq), blocking = True)
+                    status_window.request(status("Writing bitstream", prog_update_freq))
+                    if status_window.full():
+                        yield status_window.ready
 
         ### verify config flash
+        phase("verify")
         # LSC_INIT_ADDRESS
         self.write_ir(8, 0x46)
         self.write_dr(8, 0x04)
@@ -1408,14 +2808,18 @@ class JtagCustomProgrammer(object):
         self.feature_row = None
         self.feature_bits = None
 
+        verify_row = self.row_writer(self.verify_row)
+
         for line in combined_cfg_data:
-            self.runtest(2)
-            self.check_dr(128, line, 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF)
+            verify_row(line)
+            self.jtag.pins._count("rows")
 
             prog_update_cnt += 1
 
             if prog_update_cnt % prog_update_freq == 0:
-                self.jtag.pins.get_status(status("Verifying bitstream", prog_update_freq), blocking = True)
+                status_window.request(status("Verifying bitstream", prog_update_freq))
+                if status_window.full():
+                    yield status_window.ready
 
         if jed_file.ufm_data is not None:
             ### verify user flash
@@ -1426,87 +2830,122 @@ class JtagCustomProgrammer(object):
             # LSC_READ_INCR_NV
             self.write_ir(8, 0x73)
 
+            verify_row = self.row_writer(self.verify_row)
+
             for line in jed_file.ufm_data:
-                self.runtest(2)
-                self.check_dr(128, line, 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF)
+                verify_row(line)
+                self.jtag.pins._count("rows")
 
                 prog_update_cnt += 1
 
                 if prog_update_cnt % prog_update_freq == 0:
-                    self.jtag.pins.get_status(status("Verifying bitstream", prog_update_freq), blocking = True)
+                    status_window.request(status("Verifying bitstream", prog_update_freq))
+                    if status_window.full():
+                        yield status_window.ready
 
 
         self.jtag.pins.get_status(status("Writing and verifying feature rows", 0), blocking = True)
+        yield
         ### program feature rows
-        # LSC_INIT_ADDRESS
-        self.write_ir(8, 0x46)
-        self.write_dr(8, 0x02)
-        self.runtest(2)
-        # LSC_PROG_FEATURE
-        self.write_ir(8, 0xE4)
-        self.write_dr(64, jed_file.feature_row)
-        self.runtest(2)
-        # LSC_CHECK_BUSY
-        self.write_ir(8, 0xF0)
-        self.loop(10000)
-        self.runtest(100)
-        self.check_dr(1, 0, 1)
-        self.endloop()
-        # LSC_READ_FEATURE
-        self.write_ir(8, 0xE7)
-        self.runtest(2)
-        self.check_dr(64, jed_file.feature_row, 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF)
-        # LSC_PROG_FEABITS
-        self.write_ir(8, 0xF8)
-        self.write_dr(16, jed_file.feature_bits)
-        self.runtest(2)
-        # LSC_CHECK_BUSY
-        self.write_ir(8, 0xF0)
-        self.loop(10000)
-        self.runtest(100)
-        self.check_dr(1, 0, 1)
-        self.endloop()
-        # LSC_READ_FEABITS
-        self.write_ir(8, 0xFB)
-        self.runtest(2)
-        self.check_dr(16, jed_file.feature_bits, 0xFFFF)
+        phase("feature_rows")
+        with self.optimized():
+            # LSC_INIT_ADDRESS
+            self.write_ir(8, 0x46)
+            self.write_dr(8, 0x02)
+            self.runtest(2)
+            # LSC_PROG_FEATURE
+            self.write_ir(8, 0xE4)
+            self.write_dr(64, jed_file.feature_row)
+            self.runtest(2)
+            # LSC_CHECK_BUSY
+            self.write_ir(8, 0xF0)
+            self.loop(10000)
+            self.runtest(100)
+            self.check_dr(1, 0, 1)
+            self.endloop()
+            # LSC_READ_FEATURE
+            self.write_ir(8, 0xE7)
+            self.runtest(2)
+            self.check_dr(64, jed_file.feature_row, 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF)
+            # LSC_PROG_FEABITS
+            self.write_ir(8, 0xF8)
+            self.write_dr(16, jed_file.feature_bits)
+            self.runtest(2)
+            # LSC_CHECK_BUSY
+            self.write_ir(8, 0xF0)
+            self.loop(10000)
+            self.runtest(100)
+            self.check_dr(1, 0, 1)
+            self.endloop()
+            # LSC_READ_FEABITS
+            self.write_ir(8, 0xFB)
+            self.runtest(2)
+            self.check_dr(16, jed_file.feature_bits, 0xFFFF)
 
-        ### read the status bit
-        self.write_ir(8, 0x3C)
-        self.runtest(2)
-        self.check_dr(32, 0x00000000, 0x00003000)
+            if usercode is not None:
+                # ISC_PROGRAM_USERCODE
+                self.write_ir(8, 0xC2)
+                self.write_dr(32, usercode)
+                self.runtest(2)
+                # LSC_CHECK_BUSY
+                self.write_ir(8, 0xF0)
+                self.loop(10000)
+                self.runtest(100)
+                self.check_dr(1, 0, 1)
+                self.endloop()
+                # USERCODE
+                self.write_ir(8, 0xC0)
+                self.runtest(2)
+                self.check_dr(32, usercode, 0xFFFFFFFF)
 
-        ### program done bit
-        # ISC PROGRAM DONE
-        self.write_ir(8, 0x5E)
-        self.runtest(2)
-        self.write_dr(8, 0xF0)
-        # LSC_CHECK_BUSY
-        self.write_ir(8, 0xF0)
-        self.loop(10000)
-        self.runtest(100)
-        self.check_dr(1, 0, 1)
-        self.endloop()
-        # BYPASS
-        self.write_ir(8, 0xFF)
+            ### read the status bit
+            self.write_ir(8, 0x3C)
+            self.runtest(2)
+            self.check_dr(32, 0x00000000, 0x00003000)
 
-        ### exit programming mode
-        # ISC DISABLE
-        self.write_ir(8, 0x26)
-        self.runtest(1000)
-        # ISC BYPASS
-        self.write_ir(8, 0xFF)
-        self.runtest(1000)
+        phase("done")
+        self.finish()
 
-        ### verify sram done bit
-        self.runtest(10000)
-        # LSC_READ_STATUS
-        self.write_ir(8, 0x3C)
-        self.check_dr(32, 0x00000100, 0x00002100)
+        self.jtag.pins.get_status(status("Done", 0), blocking = True)
+        yield
 
-        self.jtag.goto_state("RESET")
+        return True
 
-        self.jtag.pins.get_status(status("Done", 0), blocking = True)
+    def finish(self):
+        """
+        Program the DONE bit, leave programming mode so the device configures
+        itself from flash, and check that it did.
+        """
+        with self.optimized():
+            ### program done bit
+            # ISC PROGRAM DONE
+            self.write_ir(8, 0x5E)
+            self.runtest(2)
+            self.write_dr(8, 0xF0)
+            # LSC_CHECK_BUSY
+            self.write_ir(8, 0xF0)
+            self.loop(10000)
+            self.runtest(100)
+            self.check_dr(1, 0, 1)
+            self.endloop()
+            # BYPASS
+            self.write_ir(8, 0xFF)
+
+            ### exit programming mode
+            # ISC DISABLE
+            self.write_ir(8, 0x26)
+            self.runtest(1000)
+            # ISC BYPASS
+            self.write_ir(8, 0xFF)
+            self.runtest(1000)
+
+            ### verify sram done bit
+            self.runtest(10000)
+            # LSC_READ_STATUS
+            self.write_ir(8, 0x3C)
+            self.check_dr(32, 0x00000100, 0x00002100)
+
+            self.goto_state("RESET")
 
 
 
@@ -1,56 +1,305 @@
 import sys
+import time
+import json
+import threading
 import traceback
 import argparse
+import contextlib
 import serial
+from concurrent.futures import ThreadPoolExecutor
 from serial.tools.list_ports import comports
 import tinyfpgaa
+from tinyfpgaa.record import RecordingSerial
+from tinyfpgaa import batch
+
+def find_ports():
+    """
+    Return the serial devices of all attached TinyFPGA A programmers.
+    """
+    return [port[0] for port in comports() if "1209:2101" in port[2]]
+
+
+def program_port(port, input_file, args, log, stats = None, record = None):
+    """
+    Program input_file into the board on port.  Returns a list of failure
+    messages, empty on success.  If given, stats is a ProgrammingStats that
+    records the run, and record is the file name to log the session to.
+    """
+    failures = []
+    last_message = [None]
+
+    def progress(v):
+        # status is polled every few rows; only report changes
+        if isinstance(v, str) and v != last_message[0]:
+            last_message[0] = v
+            if v.endswith("Failed!"):
+                failures.append(v)
+            log(v)
+
+    try:
+        with serial.Serial(port, 12000000, timeout=10, writeTimeout=5) as ser, contextlib.ExitStack() as stack:
+            if record is not None:
+                ser = RecordingSerial(ser, stack.enter_context(open(record, "wb")), "buffered")
+
+            buffered_serial = tinyfpgaa.BufferedSerial(ser)
+            pins = tinyfpgaa.JtagTinyFpgaProgrammer(buffered_serial)
+            jtag = tinyfpgaa.Jtag(pins)
+            programmer = tinyfpgaa.JtagCustomProgrammer(jtag)
+
+            if record is not None:
+                programmer.status_window_resized = ser.status_window
+
+            if stats is not None:
+                stats.attach(programmer)
+
+            log("Programming TinyFPGA A on {}...".format(port))
+            if not programmer.program(input_file, progress = progress, phase = stats, skip_if_identical = args.s, fingerprint = args.u):
+                log("Device already programmed with input file, skipped programming.")
+    except:
+        failures.append(traceback.format_exc())
+
+    if stats is not None:
+        stats.finish()
+
+    return failures
+
+
+def dump_port(port, output_file, raw, log):
+    """
+    Read back the flash of the board on port and write it to output_file,
+    as JEDEC or, with raw, as 16 byte rows.  Returns a list of failure
+    messages, empty on success.
+    """
+    try:
+        with serial.Serial(port, 12000000, timeout=10, writeTimeout=5) as ser:
+            programmer = tinyfpgaa.JtagCustomProgrammer(tinyfpgaa.Jtag(tinyfpgaa.JtagTinyFpgaProgrammer(tinyfpgaa.BufferedSerial(ser))))
+
+            log("Reading flash of TinyFPGA A on {}...".format(port))
+            start = time.perf_counter()
+            image = programmer.dump()
+            elapsed = time.perf_counter() - start
+
+        if image is None:
+            return ["Programmer did not answer every read, dump is incomplete."]
+
+        if raw:
+            with open(output_file, "wb") as f:
+                tinyfpgaa.write_rows(image, f)
+        else:
+            with open(output_file, "w", newline = "") as f:
+                tinyfpgaa.write_jedec(image, f, [
+                    "Read back from {} by tinyproga".format(port),
+                    "IDCODE 0x{:08X} USERCODE 0x{:08X}".format(image.idcode, image.usercode)])
+
+        log("Read {} rows in {:.2f}s into {}.".format(image.numRows(), elapsed, output_file))
+    except:
+        return [traceback.format_exc()]
+
+    return []
+
+
+def run_batch(args):
+    """
+    Program the jobs of the manifest args.manifest across all programmers
+    given with -p, or all attached ones.  Returns the exit code.
+    """
+    if args.u:
+        verify = "fingerprint"
+    elif args.s:
+        verify = "compare"
+    else:
+        verify = "always"
+
+    try:
+        jobs = batch.load_manifest(args.manifest, {"bitstream": args.b, "verify": verify})
+    except (batch.ManifestError, OSError, TypeError) as e:
+        print("Cannot load manifest: {}".format(e))
+        return 1
+
+    ports = args.p if args.p else find_ports()
+    print_lock = threading.Lock()
+
+    def say(message):
+        with print_lock:
+            print(message)
+
+    def log(message):
+        if not args.q:
+            say(message)
+
+    batch.resolve_serial_numbers(jobs)
+
+    log("Parsing images...")
+    images = batch.load_images(jobs, use_cache = not args.no_cache)
+
+    def run(job, port):
+        options = argparse.Namespace(s = job.skip_if_identical, u = job.fingerprint)
+        stats = tinyfpgaa.ProgrammingStats() if args.stats else None
+        prefix = "[{}] ".format(port)
+
+        failures = program_port(port, images[job.image_key], options, lambda message: log(prefix + message), stats)
+
+        if args.stats == "json":
+            say(json.dumps(dict(stats.report(), port = port, job = job.index)))
+        elif args.stats == "text":
+            say("Statistics for {} on {}:\n{}".format(job.name(), port, stats.format()))
+
+        return failures
+
+    scheduler = batch.BatchScheduler(jobs, ports, run, log)
+    scheduler.run()
+
+    failed = [job for job in jobs if not job.ok]
+
+    for job in failed:
+        for port, failures in job.attempts:
+            for failure in failures:
+                # progress failures were already logged unless silent
+                if args.q or port is None or not failure.endswith("Failed!"):
+                    print("[{}] {}: {}".format(port or "-", job.name(), failure.rstrip()))
+
+    if failed:
+        print("Programming Failed for {} of {} jobs: {}".format(len(failed), len(jobs), ", ".join(job.name() for job in failed)))
+        return 2
+
+    print("Programming finished without error for {} jobs on {} boards.".format(len(jobs), len(set(job.attempts[-1][0] for job in jobs))))
+    return 0
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-q", action="store_true", help="Silent mode.")
-    parser.add_argument("-p", type=str, help="Manually specify serial device.")
+    parser.add_argument("-p", type=str, action="append", help="Manually specify serial device.  Repeat to program several boards concurrently.")
+    parser.add_argument("-a", action="store_true", help="Program every attached TinyFPGA A concurrently.")
     parser.add_argument("-b", action="store_true", help="Input is bitstream file.")
-    parser.add_argument("jed", type=str, help="JEDEC or bitstream file to program.")
+    parser.add_argument("-s", action="store_true", help="Skip programming if the flash already matches the input file.")
+    parser.add_argument("-u", action="store_true", help="Store an image fingerprint in the USERCODE and skip programming if it already matches.")
+    parser.add_argument("--stats", type=str, choices=["text", "json"], help="Report per-phase timing and traffic, and show a live ETA.")
+    parser.add_argument("--no-cache", action="store_true", help="Always parse the input file instead of using the parsed image cache.")
+    parser.add_argument("--record", type=str, help="Log every serial port call of the session to this file, for python -m tinyfpgaa.record.  The port name is appended when programming several boards.")
+    parser.add_argument("--manifest", type=str, help="Program the jobs listed in this JSON manifest across all programmers, see tinyfpgaa.batch.  -b, -s and -u set the job defaults.")
+    parser.add_argument("--dump", type=str, metavar="FILE", help="Read the flash back into this JEDEC file instead of programming.  The port name is appended when reading several boards.")
+    parser.add_argument("--raw", action="store_true", help="With --dump, write the flash rows as raw 16 byte rows instead of JEDEC.")
+    parser.add_argument("jed", type=str, nargs="?", help="JEDEC or bitstream file to program.")
     args = parser.parse_args()
 
-    if not args.p:
-        for port in comports():
-            if "1209:2101" in port[2]:
-                a_port = port[0]
-                break
-        else:
+    if args.manifest:
+        if args.jed or args.record:
+            parser.error("--manifest takes the input files from the manifest and cannot be recorded")
+        sys.exit(run_batch(args))
+
+    if args.dump and args.jed:
+        parser.error("--dump reads the flash back and takes no input file")
+
+    if not args.jed and not args.dump:
+        parser.error("the input file is required")
+
+    if args.p:
+        ports = args.p
+    else:
+        ports = find_ports()
+
+        if not ports:
             print("TinyFPGA A not detected! Is it plugged in?")
             sys.exit(1)
-    else:
-        a_port = args.p
 
-    with serial.Serial(a_port, 12000000, timeout=10, writeTimeout=5) as ser:
-        async_serial = tinyfpgaa.SyncSerial(ser)
-        pins = tinyfpgaa.JtagTinyFpgaProgrammer(async_serial)
-        jtag = tinyfpgaa.Jtag(pins)
-        programmer = tinyfpgaa.JtagCustomProgrammer(jtag)
+        if not args.a:
+            ports = ports[:1]
 
-        if not args.q:
-            if args.b:
-                print("Parsing bitstream file...")
-            else:
-                print("Parsing JEDEC file...")
+    if args.dump:
+        failed = False
+
+        for port in ports:
+            output_file = args.dump if len(ports) == 1 else "{}.{}".format(args.dump, port.replace("/", "_").strip("_"))
+            failures = dump_port(port, output_file, args.raw, print if not args.q else (lambda message: None))
+
+            for failure in failures:
+                print("[{}] {}".format(port, failure.rstrip()))
+            failed = failed or bool(failures)
+
+        if failed:
+            print("Reading flash Failed!")
+            sys.exit(2)
+
+        return
+
+    if not args.q:
+        if args.b:
+            print("Parsing bitstream file...")
+        else:
+            print("Parsing JEDEC file...")
 
+    if args.no_cache:
         if args.b:
             input_file = tinyfpgaa.BitstreamFile(open(args.jed, 'rb'))
         else:
             input_file = tinyfpgaa.JedecFile(open(args.jed, 'r'))
+    else:
+        input_file = tinyfpgaa.ImageCache().load(args.jed, bitstream = args.b)
+
+    print_lock = threading.Lock()
+
+    def logger(port):
+        prefix = "[{}] ".format(port) if len(ports) > 1 else ""
 
-        try:
+        def log(message):
             if not args.q:
-                print("Programming TinyFPGA A on {}...".format(a_port))
-            programmer.program(input_file)
-        except:
-            print("Programming Failed!")
-            traceback.print_exc()
-            sys.exit(2)
+                with print_lock:
+                    print(prefix + message)
+
+        return log
+
+    def make_stats(port):
+        if not args.stats:
+            return None
+
+        log = logger(port)
+        last_update = [time.perf_counter()]
+
+        def show_eta(stats):
+            now = time.perf_counter()
+            eta = stats.eta()
+
+            if eta is not None and now - last_update[0] >= 1.0:
+                last_update[0] = now
+                log("{:.0f}% done, ETA {:.0f}s".format(100.0 * stats.rows_done() / stats.rows_expected, eta))
 
-    print("Programming finished without error.")
+        return tinyfpgaa.ProgrammingStats(on_update = show_eta)
+
+    all_stats = {port: make_stats(port) for port in ports}
+
+    def record_file(port):
+        if not args.record or len(ports) == 1:
+            return args.record
+        return "{}.{}".format(args.record, port.replace("/", "_").strip("_"))
+
+    with ThreadPoolExecutor(max_workers = len(ports)) as pool:
+        futures = [(port, pool.submit(program_port, port, input_file, args, logger(port), all_stats[port], record_file(port))) for port in ports]
+        results = [(port, future.result()) for port, future in futures]
+
+    for port in ports:
+        if args.stats == "json":
+            print(json.dumps(dict(all_stats[port].report(), port = port)))
+        elif args.stats == "text":
+            print("Statistics for {}:".format(port))
+            print(all_stats[port].format())
+
+    failed_ports = [port for port, failures in results if failures]
+
+    if failed_ports:
+        for port, failures in results:
+            for failure in failures:
+                # progress failures were already logged unless silent
+                if args.q or not failure.endswith("Failed!"):
+                    print("[{}] {}".format(port, failure.rstrip()))
+
+        print("Programming Failed on {}!".format(", ".join(failed_ports)))
+        sys.exit(2)
+
+    if len(ports) > 1:
+        print("Programming finished without error on {} boards.".format(len(ports)))
+    else:
+        print("Programming finished without error.")
 
 if __name__ == "__main__":
     main()
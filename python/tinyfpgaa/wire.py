@@ -0,0 +1,306 @@
+"""
+Pre-compiled programmer wire streams.
+
+A WireStream is the exact command byte stream a programming session sends
+to the TinyFPGA Programmer, padded so that no firmware loop straddles two
+USB packets when WirePlayer sends it, plus a record of every read the
+session makes: where in the stream it is issued, how many bytes come back
+and the expected value under a mask.  Compiling an SVF
+file or a JedecFile/BitstreamFile once lets a production station replay
+the stream with large writes and almost no host CPU, and the packed stream
+doubles as a byte-for-byte regression artifact.
+
+    python -m tinyfpgaa.wire compile blinky.jed -o blinky.tfw
+    python -m tinyfpgaa.wire compile blinky.svf -o blinky.tfw
+    python -m tinyfpgaa.wire play -p /dev/ttyACM0 blinky.tfw
+"""
+import sys
+import struct
+import argparse
+import serial
+from .tinyfpgaa import BufferedSerial, JtagTinyFpgaProgrammer, Jtag, JtagCustomProgrammer, JedecFile, BitstreamFile
+from .svf import SvfPlayer
+
+
+WIRE_FORMAT = 1
+
+_MAGIC = b"TFAW"
+_HEADER = struct.Struct("<4sBII")
+_RECORD = struct.Struct("<IH")
+
+
+class WireRead(object):
+    """
+    A read made by a compiled session: length bytes are expected back once
+    the stream up to offset has been sent, and must equal expected wherever
+    mask has a bit set.
+    """
+    def __init__(self, offset, expected, mask):
+        self.offset = offset
+        self.expected = bytes(expected)
+        self.mask = bytes(mask)
+
+    @property
+    def length(self):
+        return len(self.expected)
+
+    def matches(self, actual):
+        return ((int.from_bytes(actual, 'little') ^ int.from_bytes(self.expected, 'little')) &
+            int.from_bytes(self.mask, 'little')) == 0
+
+
+class WireStream(object):
+    def __init__(self, data = b"", reads = None):
+        self.data = bytes(data)
+        self.reads = reads if reads is not None else []
+
+    def pack(self):
+        parts = [_HEADER.pack(_MAGIC, WIRE_FORMAT, len(self.data), len(self.reads)), self.data]
+
+        for read in self.reads:
+            parts.append(_RECORD.pack(read.offset, read.length))
+            parts.append(read.expected)
+            parts.append(read.mask)
+
+        return b"".join(parts)
+
+    @classmethod
+    def unpack(cls, data):
+        view = memoryview(data)
+        magic, wire_format, data_length, num_reads = _HEADER.unpack_from(view, 0)
+
+        if magic != _MAGIC or wire_format != WIRE_FORMAT:
+            raise ValueError("Not a wire stream of this format.")
+
+        pos = _HEADER.size
+        stream = bytes(view[pos:pos + data_length])
+        pos += data_length
+        reads = []
+
+        for i in range(num_reads):
+            offset, length = _RECORD.unpack_from(view, pos)
+            pos += _RECORD.size
+            reads.append(WireRead(offset, view[pos:pos + length], view[pos + length:pos + 2 * length]))
+            pos += 2 * length
+
+        return cls(stream, reads)
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            f.write(self.pack())
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as f:
+            return cls.unpack(f.read())
+
+
+class WireRecorder(object):
+    """
+    Transport that compiles a session into a WireStream instead of talking
+    to a programmer.  Every read completes at once with the value the
+    session expects: the expected value passed with the read, such as a
+    TDO check of Jtag.shift(), or zero, which is a passing status byte.
+    """
+    PACKET_SIZE = BufferedSerial.PACKET_SIZE
+    PAD_BYTE = BufferedSerial.PAD_BYTE
+
+    def __init__(self):
+        self.data = bytearray()
+        self.reads = []
+
+    def write(self, data):
+        if isinstance(data, int):
+            self.data.append(data)
+        else:
+            self.data.extend(data)
+
+    def fit_packet(self, num_bytes):
+        # WirePlayer writes whole packets, so they start every PACKET_SIZE
+        # bytes of the stream
+        partial = len(self.data) % self.PACKET_SIZE
+
+        if partial + num_bytes > self.PACKET_SIZE:
+            self.data.extend(bytes([self.PAD_BYTE]) * (self.PACKET_SIZE - partial))
+
+    def discard_input(self):
+        return b""
+
+    def read(self, num_bytes, callback, blocking = False, expected = None):
+        if expected is None:
+            expected, mask = bytes(num_bytes), b"\xff" * num_bytes
+        else:
+            expected, mask = bytes(expected[0]), bytes(expected[1])
+
+        self.reads.append(WireRead(len(self.data), expected, mask))
+
+        if callback is not None:
+            callback(expected)
+
+    def task(self):
+        return 0
+
+    def flush(self):
+        pass
+
+    def stream(self):
+        return WireStream(self.data, self.reads)
+
+
+def compile_image(image):
+    """
+    Compile JtagCustomProgrammer.program() of a JedecFile or BitstreamFile
+    into a WireStream.
+    """
+    recorder = WireRecorder()
+    programmer = JtagCustomProgrammer(Jtag(JtagTinyFpgaProgrammer(recorder)))
+    programmer.program(image)
+    return recorder.stream()
+
+
+def compile_svf(svf_file, tck_frequency = 100000):
+    """
+    Compile playing an SVF file into a WireStream.  Every TDO check is
+    recorded as an expected read.  Raises SvfError for LOOPs that cannot
+    run as firmware loops.
+    """
+    recorder = WireRecorder()
+    player = SvfPlayer(Jtag(JtagTinyFpgaProgrammer(recorder)), tck_frequency)
+    # a loop on the host decides what to send from what it reads
+    player.host_loops_allowed = False
+    player.play(svf_file)
+    return recorder.stream()
+
+
+class WireMismatch(Exception):
+    """
+    A read of a replayed WireStream did not return the expected data.
+    actual is None if the programmer did not answer in time.
+    """
+    def __init__(self, index, read, actual):
+        if actual is None:
+            message = "read %d at stream offset %d timed out" % (index, read.offset)
+        else:
+            message = "read %d at stream offset %d returned %s, expected %s under mask %s" % (
+                index, read.offset, bytes(actual).hex(), read.expected.hex(), read.mask.hex())
+
+        Exception.__init__(self, message)
+        self.index = index
+        self.read = read
+        self.actual = actual
+
+
+class WirePlayer(object):
+    """
+    Sends a WireStream to a pyserial port in chunk_size writes, a multiple
+    of the USB packet size, and checks the read data as it arrives.
+    Raises WireMismatch at the first read that differs, and stops sending.
+    """
+    def __init__(self, ser, chunk_size = 4096):
+        assert chunk_size % BufferedSerial.PACKET_SIZE == 0
+
+        self.ser = ser
+        self.chunk_size = chunk_size
+
+    def play(self, stream, progress = None):
+        """
+        Replay stream.  progress, if given, is called with the number of
+        stream bytes sent after every write.
+        """
+        ser = self.ser
+        data = memoryview(stream.data)
+        reads = stream.reads
+        received = bytearray()
+        next_read = 0
+        pos = 0
+        drained = False
+
+        while next_read < len(reads) or pos < len(data):
+            if pos < len(data):
+                end = min(pos + self.chunk_size, len(data))
+                ser.write(data[pos:end])
+                pos = end
+
+                if progress is not None:
+                    progress(pos)
+
+                waiting = ser.inWaiting()
+                if waiting > 0:
+                    received.extend(ser.read(size = waiting))
+
+            else:
+                # everything is sent, wait for the rest of the answers
+                ser.flush()
+                needed = sum(read.length for read in reads[next_read:]) - len(received)
+                received.extend(ser.read(size = needed))
+                drained = True
+
+            consumed = 0
+
+            while next_read < len(reads) and len(received) - consumed >= reads[next_read].length:
+                read = reads[next_read]
+                actual = received[consumed:consumed + read.length]
+
+                if not read.matches(actual):
+                    raise WireMismatch(next_read, read, actual)
+
+                consumed += read.length
+                next_read += 1
+
+            del received[:consumed]
+
+            if drained and next_read < len(reads):
+                raise WireMismatch(next_read, reads[next_read], None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compile and replay TinyFPGA A programmer wire streams.")
+    commands = parser.add_subparsers(dest = "command")
+
+    compile_parser = commands.add_parser("compile", help = "Compile a JEDEC, bitstream or SVF file.")
+    compile_parser.add_argument("input", type=str, help="File to compile; .svf and .bit files are recognized by extension.")
+    compile_parser.add_argument("-o", type=str, required=True, help="Output wire stream file.")
+
+    play_parser = commands.add_parser("play", help = "Replay a wire stream to a programmer.")
+    play_parser.add_argument("-p", type=str, required=True, help="Serial device of the programmer.")
+    play_parser.add_argument("stream", type=str, help="Wire stream file.")
+
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        name = args.input.lower()
+
+        if name.endswith(".svf"):
+            with open(args.input, "r") as f:
+                stream = compile_svf(f)
+        elif name.endswith(".bit"):
+            with open(args.input, "rb") as f:
+                stream = compile_image(BitstreamFile(f))
+        else:
+            with open(args.input, "r") as f:
+                stream = compile_image(JedecFile(f))
+
+        stream.save(args.o)
+        print("{} bytes, {} reads".format(len(stream.data), len(stream.reads)))
+
+    elif args.command == "play":
+        stream = WireStream.load(args.stream)
+
+        with serial.Serial(args.p, 12000000, timeout=10, writeTimeout=5) as ser:
+            try:
+                WirePlayer(ser).play(stream)
+            except WireMismatch as e:
+                print("Programming Failed! {}".format(e))
+                return 2
+
+        print("Programming finished without error.")
+
+    else:
+        parser.print_help()
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())